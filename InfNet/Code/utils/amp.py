@@ -0,0 +1,90 @@
+import contextlib
+import functools
+import torch
+
+
+def device_type(device):
+    return 'cuda' if str(device).startswith('cuda') else 'cpu'
+
+
+def autocast(enabled, device='cpu'):
+    """
+    Usage:
+        with autocast(opt.bf16, device):
+            lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
+    bfloat16 autocast for the forward pass and the losses, a no-op when not enabled. The weights and the gradients stay
+    float32, so no loss scaling is needed.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type(device), dtype=torch.bfloat16)
+
+
+def to_float(value):
+    if torch.is_tensor(value) and value.is_floating_point():
+        return value.float()
+    return value
+
+
+def fp32_island(loss_fn):
+    """
+    Usage:
+        @fp32_island
+        def joint_loss(pred, mask, opt):
+    the wrapped loss runs with autocast disabled on float32 copies of its tensor arguments. Used for the losses whose
+    weighted sums, thresholds and logs lose too much in bfloat16.
+    """
+    @functools.wraps(loss_fn)
+    def wrapper(*args, **kwargs):
+        args = [to_float(arg) for arg in args]
+        kwargs = {key: to_float(value) for key, value in kwargs.items()}
+        devices = {device_type(arg.device) for arg in args if torch.is_tensor(arg)}
+        with contextlib.ExitStack() as stack:
+            for device in devices:
+                stack.enter_context(torch.autocast(device, enabled=False))
+            return loss_fn(*args, **kwargs)
+    return wrapper
+
+
+def dice(pred, gt, threshold=0.5):
+    pred = (pred >= threshold).float()
+    gt = (gt >= 0.5).float()
+    return ((2. * (pred * gt).sum()) / (pred.sum() + gt.sum())).item()
+
+
+@torch.no_grad()
+def dice_parity(predict, loader, device, threshold=0.5, max_batches=None):
+    """
+    Usage:
+        dice_parity(lambda pack: (model(pack[0].to(device))[3].sigmoid(), pack[1].to(device)), val_loader, device)
+    run every batch once in float32 and once under bfloat16 autocast and compare the Dice of the two
+    :param predict: pack -> (probabilities, gt) of a batch, probabilities >= threshold are foreground
+    :return: dict with the mean Dice of both runs, their largest per batch difference and the fraction of pixels whose
+    thresholded prediction flips
+    """
+    fp32_dice, bf16_dice = [], []
+    flipped, pixels = 0, 0
+    for batch_idx, pack in enumerate(loader):
+        if max_batches is not None and batch_idx >= max_batches:
+            break
+        prob_fp32, gt = predict(pack)
+        with autocast(True, device):
+            prob_bf16, _ = predict(pack)
+        prob_fp32, prob_bf16 = prob_fp32.float(), prob_bf16.float()
+
+        fp32_dice.append(dice(prob_fp32, gt, threshold))
+        bf16_dice.append(dice(prob_bf16, gt, threshold))
+        flipped += ((prob_fp32 >= threshold) != (prob_bf16 >= threshold)).sum().item()
+        pixels += prob_fp32.numel()
+
+    pairs = [(a, b) for a, b in zip(fp32_dice, bf16_dice) if a == a and b == b]    # empty gt gives nan
+    report = {
+        'batches': len(fp32_dice),
+        'fp32_dice': sum(a for a, _ in pairs) / max(len(pairs), 1),
+        'bf16_dice': sum(b for _, b in pairs) / max(len(pairs), 1),
+        'max_batch_difference': max((abs(a - b) for a, b in pairs), default=0.),
+        'flipped_pixels': flipped / max(pixels, 1),
+    }
+    print('bf16 parity over {batches} batches: dice fp32 {fp32_dice:.4f}, bf16 {bf16_dice:.4f}, '
+          'largest batch difference {max_batch_difference:.4f}, flipped pixels {flipped_pixels:.5f}'.format(**report))
+    return report
@@ -0,0 +1,85 @@
+import torch
+import torch.nn.functional as F
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class BatchAugmenter:
+    """
+    Usage:
+        augmenter = BatchAugmenter(cutout=opt.random_cutout, seed=opt.seed)
+        images, gts = augmenter(images, gts)
+        img, pseudo, img_mask = augmenter(img, pseudo, img_mask, modes=('bilinear', 'bilinear', 'nearest'))
+    the batch version of the per-sample PIL augmentation of the datasets: a random crop of `crop_scale` of the side
+    resized back to the input size, horizontal/vertical flips and a cutout of a random gray value. Every sample draws
+    its own parameters, all tensors of a call get the same geometry and one `grid_sample` per tensor applies it.
+    The cutout is only pasted into the first tensor (the image), which is expected to be normalized with mean/std.
+    """
+    def __init__(self, crop_prob=0.5, crop_scale=0.8, hflip_prob=0.5, vflip_prob=0.5, cutout=0, cutout_prob=1.0,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD, seed=None):
+        self.crop_prob = crop_prob
+        self.crop_scale = crop_scale
+        self.hflip_prob = hflip_prob
+        self.vflip_prob = vflip_prob
+        self.cutout = cutout
+        self.cutout_prob = cutout_prob
+        self.mean = torch.tensor(mean)
+        self.std = torch.tensor(std)
+        # parameters are drawn on the cpu from an own generator, so runs are reproducible on any device
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def rand(self, n):
+        return torch.rand(n, generator=self.generator)
+
+    def affine_params(self, n):
+        # output -> input sampling grid in normalized coordinates: x_in = scale * flip * x_out + shift
+        crop = self.rand(n) < self.crop_prob
+        scale = torch.where(crop, torch.full((n,), self.crop_scale), torch.ones(n))
+        shift_x = (self.rand(n) * 2 - 1) * (1 - scale)
+        shift_y = (self.rand(n) * 2 - 1) * (1 - scale)
+        flip_x = torch.where(self.rand(n) < self.hflip_prob, -torch.ones(n), torch.ones(n))
+        flip_y = torch.where(self.rand(n) < self.vflip_prob, -torch.ones(n), torch.ones(n))
+
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = scale * flip_x
+        theta[:, 0, 2] = shift_x
+        theta[:, 1, 1] = scale * flip_y
+        theta[:, 1, 2] = shift_y
+        return theta
+
+    def cutout_mask(self, n, height, width):
+        # (n, 1, h, w) boolean box of up to `cutout` of the shorter side, and the gray value of every box
+        cutout_size = int(min(height, width) * self.cutout)
+        box_h = (self.rand(n) * (cutout_size + 1)).long()
+        box_w = (self.rand(n) * (cutout_size + 1)).long()
+        top = (self.rand(n) * (height - box_h + 1).float()).long()
+        left = (self.rand(n) * (width - box_w + 1).float()).long()
+        active = self.rand(n) < self.cutout_prob
+        color = (self.rand(n) * 256).long().clamp(max=255).float() / 255
+
+        rows = torch.arange(height).view(1, height, 1)
+        cols = torch.arange(width).view(1, 1, width)
+        mask = (rows >= top.view(n, 1, 1)) & (rows < (top + box_h).view(n, 1, 1)) & \
+               (cols >= left.view(n, 1, 1)) & (cols < (left + box_w).view(n, 1, 1)) & active.view(n, 1, 1)
+        return mask.unsqueeze(1), color
+
+    def __call__(self, *tensors, modes=None):
+        modes = modes or ('bilinear',) * len(tensors)
+        n, _, height, width = tensors[0].shape
+        device = tensors[0].device
+
+        theta = self.affine_params(n).to(device)
+        grid = F.affine_grid(theta, (n, 1, height, width), align_corners=False)
+        outputs = [F.grid_sample(tensor, grid.to(tensor.dtype), mode=mode, padding_mode='border', align_corners=False)
+                   for tensor, mode in zip(tensors, modes)]
+
+        if self.cutout:
+            mask, color = self.cutout_mask(n, height, width)
+            # gray value in the normalized space of the image
+            fill = (color.view(n, 1, 1, 1) - self.mean.view(1, -1, 1, 1)) / self.std.view(1, -1, 1, 1)
+            outputs[0] = torch.where(mask.to(device), fill.to(device, outputs[0].dtype), outputs[0])
+        return outputs
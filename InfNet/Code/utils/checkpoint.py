@@ -0,0 +1,195 @@
+import os
+import queue
+import random
+import re
+import signal
+import sys
+import threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state.get('cuda') is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(obj):
+    # host copy of every tensor of a (nested) state dict, so training can go on while it is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # written next to `path` and renamed over it, an interrupted write never leaves a truncated checkpoint
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CheckpointManager:
+    """
+    Usage:
+        checkpoints = CheckpointManager(os.path.join(save_path, 'checkpoints'), keep_last=3)
+        checkpoints.save({'net': net.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch,
+                          'rng': rng_state()}, step)
+        ...
+        state = checkpoints.load(args.resume)    # a checkpoint path, or 'latest'
+    full training states are copied to the host on the calling thread and serialized by a background thread, with an
+    atomic rename and only the newest `keep_last` kept. `save_file` writes other files (e.g. the best weights) the
+    same way, without rotation. A failed write is raised by the next `save`, `save_file`, `wait` or `close`.
+    With `handle_sigterm` a SIGTERM (preemption, scancel, torchrun stopping the job) only sets `preempted` until
+    `close`, which puts the previous handler back; the training loop stops at the end of its step and calls
+    `exit_if_preempted`.
+    """
+    def __init__(self, directory, prefix='checkpoint', keep_last=3, handle_sigterm=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.preempted = False
+        self.error = None
+        # steps of the epoch boundary checkpoints written or resumed from by this run
+        self.boundaries = set()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+        self.previous_handler = None
+        if handle_sigterm and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGTERM, self.on_sigterm)
+
+    def on_sigterm(self, signum, frame):
+        print('SIGTERM received, stopping after this step')
+        self.preempted = True
+
+    def path(self, step):
+        return os.path.join(self.directory, f'{self.prefix}-{step:08d}.pt')
+
+    def mid_path(self, step):
+        # state partway through the epoch that starts at checkpoint `step`
+        return os.path.join(self.directory, f'{self.prefix}-{step:08d}-mid.pt')
+
+    def find(self, mid=False):
+        # (step, path) of the checkpoints on disk, oldest first
+        if not os.path.isdir(self.directory):
+            return []
+        pattern = re.compile(re.escape(self.prefix) + (r'-(\d+)-mid\.pt$' if mid else r'-(\d+)\.pt$'))
+        steps = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+        return [(step, self.mid_path(step) if mid else self.path(step)) for step in steps]
+
+    def checkpoints(self):
+        # paths of the epoch boundary checkpoints on disk, oldest first
+        return [path for _, path in self.find()]
+
+    def latest(self):
+        # a mid-epoch checkpoint is newer than the boundary checkpoint of the same step
+        candidates = [(step, 0, path) for step, path in self.find()] + \
+                     [(step, 1, path) for step, path in self.find(mid=True)]
+        return max(candidates)[2] if candidates else None
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, step):
+        self.raise_error()
+        self.boundaries.add(step)
+        self.queue.put((snapshot(state), self.path(step), step))
+
+    def save_file(self, obj, path):
+        self.raise_error()
+        self.queue.put((snapshot(obj), path, None))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, path, step = item
+            try:
+                atomic_save(obj, path)
+                if step is not None:
+                    self.rotate(step)
+            except Exception as error:
+                print(f'could not write {path}: {error!r}')
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def rotate(self, step):
+        # the mid-epoch checkpoints before a new boundary are outdated
+        for mid_step, mid_path in self.find(mid=True):
+            if mid_step < step:
+                os.remove(mid_path)
+        if self.keep_last:
+            for old_path in self.checkpoints()[:-self.keep_last]:
+                os.remove(old_path)
+
+    def load(self, path='latest', map_location='cpu'):
+        if path == 'latest':
+            path = self.latest()
+            if path is None:
+                raise FileNotFoundError(f'no checkpoint in {self.directory} to resume from')
+        print(f'resuming from {path}')
+        for step, boundary_path in self.find():
+            if os.path.abspath(boundary_path) == os.path.abspath(path):
+                self.boundaries.add(step)
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def exit_if_preempted(self, state_fn, step):
+        """
+        after a SIGTERM partway through the epoch that started at checkpoint `step`: flush the writes and exit. If this
+        run wrote or resumed from the boundary checkpoint `step`, --resume goes on from it and nothing else is saved.
+        Otherwise `state_fn()` is saved as the mid-epoch checkpoint of `step`; it has to hold the `batch_index` of the
+        batches trained so far (and the `epoch_rng` to replay their order), so --resume can skip them.
+        """
+        if not self.preempted:
+            return
+        self.wait()
+        if step in self.boundaries and os.path.isfile(self.path(step)):
+            print(f'resume from {self.path(step)}, the partial epoch is not saved, exiting')
+        else:
+            self.queue.put((snapshot(state_fn()), self.mid_path(step), None))
+            print(f'checkpoint {self.mid_path(step)} written, exiting')
+        self.close()
+        sys.exit(128 + signal.SIGTERM)
+
+    def wait(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGTERM, self.previous_handler)
+            self.previous_handler = None
+        self.raise_error()
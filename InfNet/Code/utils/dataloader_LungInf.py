@@ -10,16 +10,38 @@ First Version: Created on 2020-05-13 (@author: Ge-Peng Ji)
 import numpy as np
 import os
 from PIL import Image
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as TF
 
 import random
 
+from Code.utils.tensor_cache import TensorCache
+from Code.utils.image_index import image_sizes
+from Code.utils.loader_factory import make_loader, AUTO
+from Code.utils.multiscale import ScaleBatchSampler
+from Code.utils.distributed import distributed_sampler, get_rank, get_world_size
+
+
+def train_transforms(size):
+    # (image, gt) transforms of the training samples at `size`
+    img_transform = transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+    gt_transform = transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor()])
+    return img_transform, gt_transform
+
 
 class COVIDDataset(data.Dataset):
-    def __init__(self, image_root, gt_root, edge_root, trainsize, is_data_augment=False, random_cutout=0):
+    def __init__(self, image_root, gt_root, edge_root, trainsize, is_data_augment=False, random_cutout=0, cache_path=None):
         self.trainsize = trainsize
+        # images/gts decoded and resized by build_cache.py
+        self.cache = TensorCache(cache_path) if cache_path else None
         self.is_data_augment = is_data_augment
         self.random_cutout = random_cutout
         self.images = [image_root + f for f in os.listdir(image_root) if f.endswith('.jpg') or f.endswith('.png')]
@@ -37,6 +59,8 @@ class COVIDDataset(data.Dataset):
 
         self.filter_files()
         self.size = len(self.images)
+        # samples missing from the cache or changed since build_cache.py are decoded from their files
+        self.cached = [self.cache is not None and path in self.cache for path in self.images]
 
         self.img_transform = transforms.Compose([
             transforms.Resize((self.trainsize, self.trainsize)),
@@ -45,14 +69,21 @@ class COVIDDataset(data.Dataset):
         self.gt_transform = transforms.Compose([
             transforms.Resize((self.trainsize, self.trainsize)),
             transforms.ToTensor()])
+        self.sized_transforms = {self.trainsize: (self.img_transform, self.gt_transform)}
 
+        self.image_paths = list(self.images)
         for idx in range(len(self.images)):
-            self.images[idx] = self.rgb_loader(self.images[idx])
-            self.gts[idx] = self.binary_loader(self.gts[idx])
+            if self.cached[idx]:
+                self.gts[idx] = Image.fromarray(self.cache.get('GT', self.images[idx]))
+                self.images[idx] = Image.fromarray(self.cache.get('Imgs', self.images[idx]))
+            else:
+                self.images[idx] = self.rgb_loader(self.images[idx])
+                self.gts[idx] = self.binary_loader(self.gts[idx])
 
     def __getitem__(self, index):
-        image = self.images[index]
-        gt = self.gts[index]
+        # ScaleBatchSampler asks for (index, size) with the training size of the multi-scale step
+        index, size = index if isinstance(index, tuple) else (index, self.trainsize)
+        image, gt = self.load_sized(index, size)
 
         # augment data
         if self.is_data_augment:
@@ -84,24 +115,37 @@ class COVIDDataset(data.Dataset):
                 image.paste(rect, (i, j))
 
         # transform image and gt
-        image = self.img_transform(image)
-        gt = self.gt_transform(gt)
+        img_transform, gt_transform = self.transforms_for(size)
+        image = img_transform(image)
+        gt = gt_transform(gt)
 
         if self.edge_flage:
             edge = self.binary_loader(self.edges[index])
-            edge = self.gt_transform(edge)
+            edge = gt_transform(edge)
             return image, gt, edge
         else:
             return image, gt
 
+    def load_sized(self, index, size):
+        # another training size is read from its cache pyramid level if build_cache.py wrote one, else resized
+        level = self.cache.level(size) if self.cached[index] and size != self.trainsize else None
+        path = self.image_paths[index]
+        if level is not None and path in level:
+            return Image.fromarray(level.get('Imgs', path)), Image.fromarray(level.get('GT', path))
+        return self.images[index], self.gts[index]
+
+    def transforms_for(self, size):
+        if size not in self.sized_transforms:
+            self.sized_transforms[size] = train_transforms(size)
+        return self.sized_transforms[size]
+
     def filter_files(self):
         assert len(self.images) == len(self.gts)
         images = []
         gts = []
+        sizes = image_sizes(self.images + self.gts)
         for img_path, gt_path in zip(self.images, self.gts):
-            img = Image.open(img_path)
-            gt = Image.open(gt_path)
-            if img.size == gt.size:
+            if sizes[img_path] == sizes[gt_path]:
                 images.append(img_path)
                 gts.append(gt_path)
         self.images = images
@@ -133,7 +177,10 @@ class COVIDDataset(data.Dataset):
 
 
 class IndicesDataset(data.Dataset):
-    def __init__(self, images, gts, edges, trainsize, is_data_augment=False, random_cutout=0, is_test=False):
+    def __init__(self, images, gts, edges, trainsize, is_data_augment=False, random_cutout=0, is_test=False,
+                 cache_path=None):
+        # images/gts decoded and resized by build_cache.py
+        self.cache = TensorCache(cache_path) if cache_path else None
         self.images = images
         self.gts = gts
         self.edges = edges
@@ -166,28 +213,32 @@ class IndicesDataset(data.Dataset):
         self.gt_transform_roc = transforms.Compose([
             transforms.Resize((self.trainsize, self.trainsize), Image.NEAREST),
             transforms.ToTensor()])
+        self.sized_transforms = {self.trainsize: (self.img_transform, self.gt_transform)}
 
     def __getitem__(self, index):
         if self.is_test:
             return self.test_get_item(index)
         else:
-            return self.train_get_item(index)
+            # ScaleBatchSampler asks for (index, size) with the training size of the multi-scale step
+            index, size = index if isinstance(index, tuple) else (index, self.trainsize)
+            return self.train_get_item(index, size)
 
     def test_get_item(self, index):
-        image = self.rgb_loader(self.images[index])
+        image = self.load_image(index)
         image = self.transform(image)  # .unsqueeze(0)
-        gt = self.binary_loader(self.gts[index])
+        gt = self.load_gt(index)
         gt_cont = self.gt_transform(gt)
-        gt_roc = self.gt_transform_roc(gt)
+        gt_roc = self.gt_transform_roc(self.load_gt(index, 'GT_nearest') if self.cached[index] else gt)
         name = self.images[index].split('/')[-1]
         if name.endswith('.jpg'):
             name = name.split('.jpg')[0] + '.png'
         # return image, gt, name, np.array(F.interpolate(image, gt.size, mode='bilinear'))
         return image, gt_cont, gt_roc, name
 
-    def train_get_item(self, index):
-        image = self.rgb_loader(self.images[index])
-        gt = self.binary_loader(self.gts[index])
+    def train_get_item(self, index, size=None):
+        size = size or self.trainsize
+        image = self.load_image(index, size)
+        gt = self.load_gt(index, size=size)
 
         # augment data
         if self.is_data_augment:
@@ -220,33 +271,62 @@ class IndicesDataset(data.Dataset):
                 image.paste(rect, (i, j))
 
         # transform image and gt
-        image = self.img_transform(image)
-        gt = self.gt_transform(gt)
+        img_transform, gt_transform = self.transforms_for(size)
+        image = img_transform(image)
+        gt = gt_transform(gt)
 
         if self.edge_flage:
             edge = self.binary_loader(self.edges[index])
-            edge = self.gt_transform(edge)
+            edge = gt_transform(edge)
             return image, gt, edge
         else:
             return image, gt
 
+    def transforms_for(self, size):
+        if size not in self.sized_transforms:
+            self.sized_transforms[size] = train_transforms(size)
+        return self.sized_transforms[size]
+
     def filter_files(self):
         assert len(self.images) == len(self.gts)
         images = []
         gts = []
+        sizes = image_sizes(list(self.images) + list(self.gts))
         for img_path, gt_path in zip(self.images, self.gts):
-            img = Image.open(img_path)
-            gt = Image.open(gt_path)
-            if img.size == gt.size:
+            if sizes[img_path] == sizes[gt_path]:
                 images.append(img_path)
                 gts.append(gt_path)
         self.images = images
         self.gts = gts
         self.size = len(self.images)
+        # samples missing from the cache or changed since build_cache.py are decoded from their files
+        self.cached = [self.cache is not None and path in self.cache for path in self.images]
 
     def __len__(self):
         return self.size
 
+    def cache_level(self, index, size):
+        # another training size is read from its cache pyramid level if build_cache.py wrote one, else resized
+        if not self.cached[index]:
+            return None
+        if size is not None and size != self.trainsize:
+            level = self.cache.level(size)
+            if level is not None and self.images[index] in level:
+                return level
+        return self.cache
+
+    def load_image(self, index, size=None):
+        cache = self.cache_level(index, size)
+        if cache is not None:
+            return Image.fromarray(cache.get('Imgs', self.images[index]))
+        return self.rgb_loader(self.images[index])
+
+    def load_gt(self, index, kind='GT', size=None):
+        cache = self.cache_level(index, size)
+        if cache is not None:
+            return Image.fromarray(cache.get(kind, self.images[index]))
+        return self.binary_loader(self.gts[index])
+
     def rgb_loader(self, path):
         with open(path, 'rb') as f:
             img = Image.open(f)
@@ -259,15 +339,22 @@ class IndicesDataset(data.Dataset):
             return img.convert('L')
 
 
-def get_loader(image_root, gt_root, edge_root, batchsize, trainsize, shuffle=True, num_workers=0, pin_memory=True,
-               is_data_augment=False, random_cutout=0):
-    dataset = COVIDDataset(image_root, gt_root, edge_root, trainsize, is_data_augment, random_cutout)
-    data_loader = data.DataLoader(dataset=dataset,
-                                  batch_size=batchsize,
-                                  shuffle=shuffle,
-                                  num_workers=num_workers,
-                                  pin_memory=pin_memory,
-                                  drop_last=False)
+def get_loader(image_root, gt_root, edge_root, batchsize, trainsize, shuffle=True, num_workers=AUTO, pin_memory=None,
+               is_data_augment=False, random_cutout=0, cache_path=None, device=None, multi_scale=None, seed=0):
+    # num_workers=-1 tunes the workers for this host, pin_memory=None pins when training on cuda
+    # multi_scale: MultiScaleScheduler with one rate per step, the batches are then loaded at the size of their step
+    # in a distributed run every rank loads its shard of the samples
+    dataset = COVIDDataset(image_root, gt_root, edge_root, trainsize, is_data_augment, random_cutout, cache_path)
+    batch_sampler = None
+    sampler = None
+    if multi_scale is not None:
+        batch_sampler = ScaleBatchSampler(len(dataset), batchsize, multi_scale, trainsize, shuffle=shuffle, seed=seed,
+                                          num_replicas=get_world_size(), rank=get_rank())
+    else:
+        sampler = distributed_sampler(dataset, shuffle=shuffle, seed=seed)
+    data_loader = make_loader(dataset, batchsize, shuffle=shuffle and sampler is None, num_workers=num_workers,
+                              device=device, pin_memory=pin_memory, drop_last=False, sampler=sampler,
+                              batch_sampler=batch_sampler)
     return data_loader
 
 
@@ -333,3 +420,71 @@ class test_dataset:
         with open(path, 'rb') as f:
             img = Image.open(f)
             return img.convert('L')
+
+
+class inference_dataset(data.Dataset):
+    """
+    Usage:
+        for images, sizes, names in get_inference_loader(image_root, gt_root, 352, batch_size=16):
+    the batched version of `test_dataset.load_data`: images resized to `testsize` and normalized, plus the original
+    (height, width) of the gt every prediction is resized back to. The sizes come from the image header index, no gt
+    is decoded.
+    """
+    def __init__(self, image_root, gt_root, testsize):
+        self.testsize = testsize
+        self.images = sorted(image_root + f for f in os.listdir(image_root) if f.endswith('.jpg') or f.endswith('.png'))
+        self.gts = sorted(gt_root + f for f in os.listdir(gt_root) if f.endswith('.jpg') or f.endswith('.png'))
+        self.transform = transforms.Compose([
+            transforms.Resize((self.testsize, self.testsize)),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406],
+                                 [0.229, 0.224, 0.225])])
+        gt_sizes = image_sizes(self.gts)
+        self.sizes = [gt_sizes[gt][::-1] for gt in self.gts]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        with open(self.images[index], 'rb') as f:
+            image = self.transform(Image.open(f).convert('RGB'))
+        name = self.images[index].split('/')[-1]
+        if name.endswith('.jpg'):
+            name = name.split('.jpg')[0] + '.png'
+        return image, torch.tensor(self.sizes[index]), name
+
+
+class SizeGroupedBatchSampler(data.Sampler):
+    """
+    batches of indices whose samples share the same original size, so a batch is resized back with one interpolate
+    """
+    def __init__(self, sizes, batch_size):
+        groups = {}
+        for index, size in enumerate(sizes):
+            groups.setdefault(tuple(size), []).append(index)
+        self.batches = [indices[start:start + batch_size] for indices in groups.values()
+                        for start in range(0, len(indices), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def get_inference_loader(image_root, gt_root, testsize, batch_size=16, num_workers=AUTO, device=None):
+    dataset = inference_dataset(image_root, gt_root, testsize)
+    return make_loader(dataset, batch_size, num_workers=num_workers, device=device, persistent_workers=False,
+                       batch_sampler=SizeGroupedBatchSampler(dataset.sizes, batch_size))
+
+
+def restore_predictions(logits, sizes):
+    """
+    logits of a size-grouped batch -> N x H x W numpy maps at the original size, sigmoid and min-max normalized per
+    sample like the single image path did
+    """
+    res = F.interpolate(logits, size=tuple(sizes[0].tolist()), mode='bilinear', align_corners=False).sigmoid()
+    res_min = res.amin(dim=(1, 2, 3), keepdim=True)
+    res_max = res.amax(dim=(1, 2, 3), keepdim=True)
+    res = (res - res_min) / (res_max - res_min + 1e-8)
+    return res[:, 0].cpu().numpy()
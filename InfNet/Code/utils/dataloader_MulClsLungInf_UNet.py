@@ -16,12 +16,16 @@ import torchvision.transforms.functional as TF
 import random
 from PIL import Image
 import cv2
-from Code.utils.onehot import onehot
+from Code.utils.onehot import quantize_label
+from Code.utils.tensor_cache import TensorCache
 
 
 class LungDataset(Dataset):
-    def __init__(self, imgs_path, pseudo_path, label_path, transform=None, is_test=False, is_data_augment=False, is_label_smooth=False, random_cutout=0):
+    def __init__(self, imgs_path, pseudo_path, label_path, transform=None, is_test=False, is_data_augment=False, is_label_smooth=False, random_cutout=0,
+                 cache_path=None):
         self.transform = transform
+        # images/labels/priors decoded and resized by build_cache.py
+        self.cache = TensorCache(cache_path) if cache_path else None
         self.imgs_path = imgs_path  # 'data/class3_images/'
         self.pseudo_path = pseudo_path
         self.label_path = label_path    # 'data/class3_label/'
@@ -39,16 +43,26 @@ class LungDataset(Dataset):
         is_process_file = 'StichNet' not in label_path and 'full_ct_processed' not in label_path
 
         for img_name in img_names:
-            imgA = cv2.resize(cv2.imread(self.imgs_path + img_name), (352, 352))
-            imgB = cv2.resize(cv2.imread(self.label_path + img_name.split('.')[0] + '.png', 0), (352, 352))
-            imgC = cv2.resize(cv2.imread(self.pseudo_path + img_name.split('.')[0] + '.png'), (352, 352))
+            # samples missing from the cache or changed since build_cache.py are decoded from their files
+            if self.cache is not None and self.imgs_path + img_name in self.cache:
+                imgA = self.cache.get('Imgs', self.imgs_path + img_name)
+                imgC = self.cache.get('Prior', self.imgs_path + img_name)
+                if is_process_file and self.cache.has_kind('Label'):
+                    # class indices quantized by build_cache.py
+                    imgB = self.cache.get('Label', self.imgs_path + img_name)
+                    is_quantized = True
+                else:
+                    imgB = self.cache.get('GT', self.imgs_path + img_name)
+                    is_quantized = False
+            else:
+                imgA = cv2.resize(cv2.imread(self.imgs_path + img_name), (352, 352))
+                imgB = cv2.resize(cv2.imread(self.label_path + img_name.split('.')[0] + '.png', 0), (352, 352))
+                imgC = cv2.resize(cv2.imread(self.pseudo_path + img_name.split('.')[0] + '.png'), (352, 352))
+                is_quantized = False
 
             # only need to process the original dataset, tr and rp already processed
-            if is_process_file:  # don't process file if StichNet Dataset
-                if 'tr' not in img_name and 'rp' not in img_name:
-                    imgB[imgB < 19] = 0
-                    imgB[(imgB <= 38) & (imgB >= 19)] = 1
-                    imgB[imgB > 38] = 2
+            if is_process_file and not is_quantized:  # don't process file if StichNet Dataset
+                imgB = quantize_label(imgB, img_name)
 
             self.imgA.append(imgA)
             self.imgB.append(imgB)
@@ -109,7 +123,8 @@ class LungDataset(Dataset):
                     pil_imgA.paste(rect, (i, j))
 
             pil_imgA = pil_imgA.resize((352, 352))
-            pil_img_label = pil_img_label.resize((352, 352))
+            # class indices, never interpolated
+            pil_img_label = pil_img_label.resize((352, 352), Image.NEAREST)
             pil_imgC = pil_imgC.resize((352, 352))
 
             # convert pil back to numpy
@@ -117,14 +132,8 @@ class LungDataset(Dataset):
             img_label = np.array(pil_img_label)
             imgC = np.array(pil_imgC)
 
-        img_label_onehot = (np.arange(self.num_class) == img_label[...,None]).astype(float)
-        img_label_onehot = img_label_onehot.transpose(2, 0, 1)  # n_class * w * H
-
-        # label smoothing
-        if self.is_label_smooth:
-            img_label_onehot[0] = img_label_onehot[0] * 0.9 # since there are so many labels on the first axis, we smooth it
-
-        onehot_label = torch.FloatTensor(img_label_onehot)
+        # uint8 class indices, the one-hot (and label smoothing) is built on the batch by `batch_onehot`
+        onehot_label = torch.from_numpy(np.ascontiguousarray(img_label, dtype=np.uint8))
         if self.transform:
             imgA = self.transform(imgA)
             imgC = self.transform(imgC)
@@ -134,9 +143,13 @@ class LungDataset(Dataset):
 
 
 class IndicesLungDataset(Dataset):
-    def __init__(self, img_names, pseudo_path, label_path, transform=None, is_test=False, is_data_augment=False, is_label_smooth=False, random_cutout=0):
+    def __init__(self, img_names, pseudo_path, label_path, transform=None, is_test=False, is_data_augment=False, is_label_smooth=False, random_cutout=0,
+                 cache_path=None):
         self.transform = transform
+        # images/labels/priors decoded and resized by build_cache.py
+        self.cache = TensorCache(cache_path) if cache_path else None
         self.img_names = img_names  # 'data/class3_images/'
+        # either a directory, or an array of files aligned with img_names (e.g. read from an All-set manifest)
         self.pseudo_path = pseudo_path
         self.label_path = label_path    # 'data/class3_label/'
         self.is_test = is_test
@@ -144,27 +157,51 @@ class IndicesLungDataset(Dataset):
         self.is_label_smooth = is_label_smooth
         self.random_cutout = random_cutout
         self.num_class = 3
+        # samples missing from the cache or changed since build_cache.py are decoded from their files
+        self.cached = [self.cache is not None and img_name in self.cache for img_name in self.img_names]
 
     def __len__(self):
         return self.img_names.shape[0]
 
+    def label_file(self, idx):
+        if isinstance(self.label_path, str):
+            return self.label_path + os.path.basename(self.img_names[idx]).split('.')[0] + '.png'
+        return self.label_path[idx]
+
+    def load_label(self, idx):
+        img_name = self.img_names[idx]
+        if self.cached[idx] and not self.is_test:
+            if self.cache.has_kind('Label'):
+                return self.cache.get('Label', img_name)
+            return quantize_label(self.cache.get('GT', img_name), img_name)
+        label = cv2.imread(self.label_file(idx), 0)
+        # the test label keeps its original size
+        if not self.is_test:
+            label = cv2.resize(label, (352, 352))
+        return quantize_label(label, img_name)
+
     def __getitem__(self, idx):
         # processing img
         img_name = self.img_names[idx]
-        # image path
-        imgA = cv2.imread(img_name)
-        imgA = cv2.resize(imgA, (352, 352))
-
         img_filename = os.path.basename(img_name).split('.')[0]
-        # processing pseudo
-        imgC = cv2.imread(self.pseudo_path + img_filename.split('.')[0] + '.png')
-        imgC = cv2.resize(imgC, (352, 352))
-
-        # processing label
-        imgB = cv2.imread(self.label_path + img_filename + '.png', 0)
-        if not self.is_test:
-            imgB = cv2.resize(imgB, (352, 352))
-        img_label = imgB
+        if isinstance(self.pseudo_path, str):
+            pseudo_name = self.pseudo_path + img_filename.split('.')[0] + '.png'
+        else:
+            pseudo_name = self.pseudo_path[idx]
+        if self.cached[idx]:
+            imgA = self.cache.get('Imgs', img_name)
+            imgC = self.cache.get('Prior', img_name)
+        else:
+            # image path
+            imgA = cv2.imread(img_name)
+            imgA = cv2.resize(imgA, (352, 352))
+
+            # processing pseudo
+            imgC = cv2.imread(pseudo_name)
+            imgC = cv2.resize(imgC, (352, 352))
+
+        # uint8 class indices, decoded in the worker like the image
+        img_label = self.load_label(idx)
         # print(np.unique(img_label))
         # make data augmentation here
         if self.is_data_augment:
@@ -208,7 +245,8 @@ class IndicesLungDataset(Dataset):
                     pil_imgA.paste(rect, (i, j))
 
             pil_imgA = pil_imgA.resize((352, 352))
-            pil_img_label = pil_img_label.resize((352, 352))
+            # class indices, never interpolated
+            pil_img_label = pil_img_label.resize((352, 352), Image.NEAREST)
             pil_imgC = pil_imgC.resize((352, 352))
 
             # convert pil back to numpy
@@ -216,20 +254,8 @@ class IndicesLungDataset(Dataset):
             img_label = np.array(pil_img_label)
             imgC = np.array(pil_imgC)
 
-        # only need to process the original dataset, tr and rp already processed
-        if 'tr' not in img_filename and 'rp' not in img_filename:
-            img_label[img_label < 19] = 0
-            img_label[(img_label <= 38) & (img_label >= 19)] = 1
-            img_label[img_label > 38] = 2
-
-        img_label_onehot = (np.arange(self.num_class) == img_label[...,None]).astype(float)
-        img_label_onehot = img_label_onehot.transpose(2, 0, 1)  # n_class * w * H
-
-        # label smoothing
-        if self.is_label_smooth:
-            img_label_onehot[0] = img_label_onehot[0] * 0.9 # since there are so many labels on the first axis, we smooth it
-
-        onehot_label = torch.FloatTensor(img_label_onehot)
+        # uint8 class indices, the one-hot (and label smoothing) is built on the batch by `batch_onehot`
+        onehot_label = torch.from_numpy(np.ascontiguousarray(img_label, dtype=np.uint8))
         if self.transform:
             imgA = self.transform(imgA)
             imgC = self.transform(imgC)
@@ -0,0 +1,119 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from Code.utils.loader_factory import available_cpus
+
+
+def init_distributed(backend='gloo'):
+    """
+    Usage:
+        torchrun --nproc_per_node 4 MyTrain_LungInf.py --distributed ...
+    join the process group torchrun describes in the environment (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). The
+    cores of the host are split between its processes. Started without torchrun it is a single process run.
+    :return: (rank, world size)
+    """
+    if 'WORLD_SIZE' not in os.environ:
+        print('--distributed without torchrun, training on one process')
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+    torch.set_num_threads(max(1, available_cpus() // local_world_size))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    # logging, metric files and checkpoints are written by rank 0 only
+    return get_rank() == 0
+
+
+def wrap_model(model):
+    """
+    DistributedDataParallel on CPU (gloo) or on the current cuda device. The Inf-Net models carry inpainting heads the
+    segmentation forward does not use, so unused parameters are allowed.
+    """
+    if not is_distributed():
+        return model
+    device_ids = None
+    if next(model.parameters()).is_cuda:
+        device_ids = [torch.cuda.current_device()]
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
+
+
+def unwrap(model):
+    # the plain module, for the state dict, type checks and rank-local evaluation
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def sync_gradients(model, sync):
+    """
+    Usage:
+        with sync_gradients(model, sync=num_passes % accum_steps == 0):
+            loss = criterion(model(images), gts)
+            loss.backward()
+    the passes accumulated before an optimizer step skip the gradient all-reduce of DistributedDataParallel, only the
+    pass of the step (`sync`) averages the summed gradients over the ranks. The forward has to be inside as well.
+    """
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def distributed_sampler(dataset, shuffle=True, seed=0):
+    """
+    :return: a DistributedSampler giving every rank its shard of `dataset`, None if not distributed
+    """
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+
+
+def all_reduce_sum(values):
+    """
+    :param values: list of numbers or 0-dim tensors of this rank
+    :return: list of floats summed over all ranks
+    """
+    if not is_distributed():
+        return [float(value) for value in values]
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def gather_lists(*lists):
+    """
+    Usage:
+        test_dice, test_loss = gather_lists(test_dice, test_loss)
+    concatenate per-batch metric lists of all ranks, in rank order
+    """
+    if not is_distributed():
+        return lists
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, lists)
+    return tuple([value for rank_lists in gathered for value in rank_lists[index]] for index in range(len(lists)))
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
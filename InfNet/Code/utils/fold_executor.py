@@ -0,0 +1,190 @@
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Code.utils.loader_factory import available_cpus
+
+
+class FoldJournal:
+    """
+    Usage:
+        journal = FoldJournal(os.path.join(opt.metric_path, opt.train_save, 'folds_journal.jsonl'),
+                              {'folds': opt.folds, 'seed': opt.seed})
+    one JSON line per completed fold with its metrics. Only the lines of the same `config` count as completed, so a
+    run with another number of folds or seed starts over.
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+
+    def completed(self):
+        """
+        :return: dict of fold index -> {metric: value} of the folds already done
+        """
+        folds = {}
+        if not os.path.isfile(self.path):
+            return folds
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut off by an interrupted run
+                    continue
+                if entry.get('config') == self.config:
+                    folds[entry['fold']] = entry['metrics']
+        return folds
+
+    def record(self, fold, metrics, seconds):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        entry = {'fold': fold, 'config': self.config, 'metrics': metrics, 'seconds': round(seconds, 1)}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+# the cores of this process when it trains a fold of a --fold_workers pool, None otherwise
+_fold_cpu_budget = None
+
+
+def fold_threads(fold_workers):
+    # the cores of the host split between the folds trained at the same time
+    return max(1, available_cpus() // fold_workers)
+
+
+def fold_cpu_budget():
+    """
+    Usage:
+        make_loader(dataset, batch_size, num_workers=opt.num_workers, max_workers=fold_cpu_budget())
+    the share of the cores of the fold trained in this process, so its loader workers do not oversubscribe the host.
+    None outside of a --fold_workers pool (no cap)
+    """
+    return _fold_cpu_budget
+
+
+def parse_metric_lines(text):
+    """
+    'mean dice: 0.71\nerror dice: 0.02\n...' -> {'mean dice': 0.71, 'error dice': 0.02, ...}, lines without a number
+    are skipped
+    """
+    metrics = {}
+    for line in text.splitlines():
+        name, _, value = line.rpartition(':')
+        try:
+            metrics[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+def to_floats(metrics):
+    # numpy scalars and 0-dim tensors to plain floats for the journal, everything else is dropped
+    floats = {}
+    for name, value in metrics.items():
+        try:
+            floats[name] = float(value)
+        except (TypeError, ValueError):
+            continue
+    return floats
+
+
+def timed_fold(run_fold, num_threads, fold_index, args):
+    # runs in the pool process
+    global _fold_cpu_budget
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+        _fold_cpu_budget = num_threads
+    start = time.time()
+    metrics = run_fold(fold_index, *args)
+    return metrics, time.time() - start
+
+
+def run_folds(run_fold, folds, journal, fold_workers=1, write_journal=True, start_method='spawn'):
+    """
+    Usage:
+        metrics = run_folds(run_fold, [(fold_index, (train_index, test_index, ...)), ...], journal, opt.fold_workers)
+    train the folds missing from the journal. With fold_workers 1 they run one after another in this process, else
+    `fold_workers` at a time in a process pool, each process on its share of the cores (torch.set_num_threads, and
+    `fold_cpu_budget` for its loader workers).
+    `run_fold(fold_index, *args)` has to be a module-level function (it is pickled) that sets up everything it uses
+    and returns {metric: value}, or None on ranks that do not evaluate.
+    A fold is journaled as soon as it is done, so an interrupted run resumes at the missing folds. A failed fold does
+    not stop the others, its error is raised once they are done.
+    :return: dict of fold index -> metrics of all folds, the journaled ones included
+    """
+    results = journal.completed()
+    pending = [(fold_index, args) for fold_index, args in folds if fold_index not in results]
+    if results:
+        print(f'folds {sorted(results)} are in {journal.path}, training folds {[fold for fold, _ in pending]}')
+
+    def finish(fold_index, metrics, seconds):
+        if metrics is None:
+            return
+        metrics = to_floats(metrics)
+        results[fold_index] = metrics
+        if write_journal:
+            journal.record(fold_index, metrics, seconds)
+
+    if fold_workers <= 1 or len(pending) <= 1:
+        for fold_index, args in pending:
+            finish(fold_index, *timed_fold(run_fold, None, fold_index, args))
+        return results
+
+    fold_workers = min(fold_workers, len(pending))
+    num_threads = fold_threads(fold_workers)
+    print(f'training {len(pending)} folds, {fold_workers} at a time with {num_threads} threads each')
+    errors = []
+    context = multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=fold_workers, mp_context=context) as executor:
+        futures = {executor.submit(timed_fold, run_fold, num_threads, fold_index, args): fold_index
+                   for fold_index, args in pending}
+        for future in as_completed(futures):
+            fold_index = futures[future]
+            try:
+                finish(fold_index, *future.result())
+            except Exception as error:
+                print(f'fold {fold_index} failed: {error!r}')
+                errors.append(error)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def merge_fold_metrics(results, output_path, fold_files=None):
+    """
+    write the mean and standard deviation over the folds of every metric, followed by the metric file of every fold
+    :param results: dict of fold index -> {metric: value}, as returned by run_folds
+    :param fold_files: dict of fold index -> path of its metric file, appended as is
+    :return: dict of metric -> (mean, std)
+    """
+    folds = sorted(results)
+    names = []
+    for fold in folds:
+        names += [name for name in results[fold] if name not in names]
+    summary = {}
+    lines = [f'folds: {", ".join(str(fold) for fold in folds)}\n']
+    for name in names:
+        values = np.array([results[fold][name] for fold in folds if name in results[fold]], dtype=np.float64)
+        summary[name] = (float(np.nanmean(values)), float(np.nanstd(values)))
+        lines.append(f'{name}: {summary[name][0]} +- {summary[name][1]} '
+                     f'[{", ".join(str(value) for value in values)}]\n')
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as f:
+        f.writelines(lines)
+        for fold in folds:
+            if fold_files and os.path.isfile(fold_files.get(fold, '')):
+                f.write(f'============== fold {fold} ==============\n')
+                with open(fold_files[fold]) as fold_file:
+                    f.write(fold_file.read())
+    print(''.join(lines))
+    return summary
@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+# the indexes live outside the datasets, so no loader or copy script ever lists them as samples
+INDEX_DIR = os.environ.get('INFNET_IMAGE_INDEX_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'infnet', 'image_index'))
+
+
+def index_path_of(directory):
+    # one index per dataset directory, named by a hash of its absolute path
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()
+    return os.path.join(INDEX_DIR, f'{key}.json')
+
+
+def read_dimensions(path):
+    # PIL only parses the header here, the pixels are never decoded
+    with Image.open(path) as img:
+        return img.size
+
+
+def load_directory_index(directory):
+    try:
+        with open(index_path_of(directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_directory_index(directory, entries):
+    index_path = index_path_of(directory)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # no writable cache directory, the index is simply rebuilt next time
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def image_sizes(paths, num_workers=16):
+    """
+    Usage:
+        sizes = image_sizes(images + gts)
+        sizes[images[0]] == sizes[gts[0]]
+    every directory has an index of filename -> [file size, mtime, width, height] in `INDEX_DIR` (default
+    `~/.cache/infnet/image_index`, or `$INFNET_IMAGE_INDEX_DIR`), never in the directory itself. Entries are
+    revalidated with `os.stat`, only new or changed files have their header read (on a thread pool), so building a
+    dataset does not open every image again.
+    :param paths: image paths, possibly from several directories
+    :param num_workers: threads reading headers
+    :return: dict of path -> (width, height)
+    """
+    by_directory = defaultdict(list)
+    for path in paths:
+        by_directory[os.path.dirname(path)].append(path)
+
+    sizes = {}
+    for directory, directory_paths in by_directory.items():
+        entries = load_directory_index(directory)
+        stale = []
+        for path in set(directory_paths):
+            stat = os.stat(path)
+            entry = entries.get(os.path.basename(path))
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                sizes[path] = (entry[2], entry[3])
+            else:
+                stale.append((path, stat))
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                dimensions = executor.map(read_dimensions, [path for path, _ in stale])
+                for (path, stat), (width, height) in zip(stale, dimensions):
+                    entries[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns, width, height]
+                    sizes[path] = (width, height)
+            save_directory_index(directory, entries)
+    return sizes
@@ -0,0 +1,201 @@
+import os
+import time
+import random
+import weakref
+import contextlib
+import numpy as np
+import torch
+from torch.utils import data
+
+
+AUTO = -1
+
+# dataset -> {(batch size, shuffle, max workers): tuned settings}, so a dataset is only tuned once. Weakly keyed: an
+# id() is reused once its dataset is collected, a new dataset must not get the settings of an old one
+_tuned_settings = weakref.WeakKeyDictionary()
+
+
+def tuned_settings(dataset):
+    # the settings of the dataset object itself: two datasets of one class (train/test folds, test/val) can differ a
+    # lot in cost
+    try:
+        return _tuned_settings.setdefault(dataset, {})
+    except TypeError:
+        # no weak reference to it (e.g. a list of samples), tuned every time
+        return {}
+
+
+@contextlib.contextmanager
+def preserved_rng():
+    # the tuning iterates real batches (shuffling, augmentations), the training must not see its random draws
+    python_state, numpy_state = random.getstate(), np.random.get_state()
+    with torch.random.fork_rng(devices=[]):
+        yield
+    random.setstate(python_state)
+    np.random.set_state(numpy_state)
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def worker_candidates(max_workers=None):
+    # 0, 1, 2, 4, ... up to the cores of the host, or fewer
+    max_workers = min(max_workers, available_cpus()) if max_workers else available_cpus()
+    candidates = [0]
+    num_workers = 1
+    while num_workers < max_workers:
+        candidates.append(num_workers)
+        num_workers *= 2
+    candidates.append(max_workers)
+    return candidates
+
+
+def use_pin_memory(device=None):
+    return torch.cuda.is_available() and (device is None or str(device).startswith('cuda'))
+
+
+def loader_kwargs(num_workers, prefetch_factor=2, persistent_workers=True, pin_memory=False):
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+        kwargs['persistent_workers'] = persistent_workers
+    return kwargs
+
+
+def batch_length(batch):
+    # number of samples in a collated batch: length of its first tensor
+    if isinstance(batch, torch.Tensor):
+        return len(batch)
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+    for item in batch:
+        length = batch_length(item)
+        if length:
+            return length
+    return 0
+
+
+def measure_throughput(dataset, batch_size, num_batches=20, warmup_batches=2, shuffle=False, collate_fn=None,
+                       drop_last=False, **kwargs):
+    """
+    samples/s of iterating a DataLoader, the worker start-up and the first `warmup_batches` are not timed
+    """
+    if hasattr(dataset, '__len__'):
+        # small datasets: time what is left after the warm-up
+        num_batches = max(1, min(num_batches, len(dataset) // batch_size - warmup_batches))
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn,
+                             drop_last=drop_last, **kwargs)
+    iterator = iter(loader)
+    try:
+        for _ in range(warmup_batches):
+            next(iterator)
+        samples = 0
+        start = time.perf_counter()
+        for _, batch in zip(range(num_batches), iterator):
+            samples += batch_length(batch)
+        elapsed = time.perf_counter() - start
+    except StopIteration:
+        return 0.
+    finally:
+        # shuts the workers down
+        del iterator
+    return samples / elapsed if elapsed > 0 else 0.
+
+
+def tune_loader(dataset, batch_size, shuffle=False, collate_fn=None, drop_last=False, device=None, max_workers=None,
+                num_batches=20, verbose=True):
+    """
+    Usage:
+        settings = tune_loader(train_dataset, batch_size=16, shuffle=True)
+    measure samples/s for 0, 1, 2, 4, ... workers and stop once another doubling gains less than 5%. For the best
+    worker count the prefetch factor 2 and 4 are compared as well.
+    :return: dict with num_workers and prefetch_factor
+    """
+    settings = tuned_settings(dataset)
+    key = batch_size, shuffle, max_workers
+    if key in settings:
+        return settings[key]
+
+    with preserved_rng():
+        best = search_settings(dataset, batch_size, shuffle, collate_fn, drop_last, device, max_workers, num_batches,
+                               verbose)
+    settings[key] = best
+    return best
+
+
+def search_settings(dataset, batch_size, shuffle, collate_fn, drop_last, device, max_workers, num_batches, verbose):
+    name = type(dataset).__name__
+    pin_memory = use_pin_memory(device)
+    best = {'num_workers': 0, 'prefetch_factor': 2}
+    best_throughput = 0.
+    for num_workers in worker_candidates(max_workers):
+        throughput = measure_throughput(dataset, batch_size, num_batches, shuffle=shuffle, collate_fn=collate_fn,
+                                        drop_last=drop_last, **loader_kwargs(num_workers, pin_memory=pin_memory))
+        if verbose:
+            print(f'loader tuning {name}: {num_workers} workers -> {throughput:.1f} samples/s')
+        if throughput <= best_throughput * 1.05:
+            break
+        best, best_throughput = {'num_workers': num_workers, 'prefetch_factor': 2}, throughput
+
+    if best['num_workers'] > 0:
+        throughput = measure_throughput(dataset, batch_size, num_batches, shuffle=shuffle, collate_fn=collate_fn,
+                                        drop_last=drop_last,
+                                        **loader_kwargs(best['num_workers'], prefetch_factor=4, pin_memory=pin_memory))
+        if verbose:
+            print(f'loader tuning {name}: {best["num_workers"]} workers, prefetch 4 -> {throughput:.1f} samples/s')
+        if throughput > best_throughput * 1.05:
+            best['prefetch_factor'] = 4
+
+    if verbose:
+        print(f'loader tuning {name}: using {best}')
+    return best
+
+
+def make_loader(dataset, batch_size, shuffle=False, num_workers=AUTO, device=None, drop_last=False, collate_fn=None,
+                sampler=None, prefetch_factor=2, persistent_workers=True, pin_memory=None, batch_sampler=None,
+                max_workers=None):
+    """
+    Usage:
+        train_loader = make_loader(train_dataset, opt.batchsize, shuffle=True, num_workers=opt.num_workers,
+                                   device=opt.device)
+    DataLoader with the worker settings picked for this host: num_workers=-1 tunes num_workers and prefetch_factor
+    with `tune_loader`, workers are kept alive between epochs and memory is pinned when training on cuda.
+    `max_workers` caps the workers, tuned or not (e.g. the shards of a stream, or the CPU share of a process).
+    """
+    if pin_memory is None:
+        pin_memory = use_pin_memory(device)
+    if num_workers == AUTO:
+        settings = tune_loader(dataset, batch_size, shuffle=shuffle, collate_fn=collate_fn, drop_last=drop_last,
+                               device=device, max_workers=max_workers)
+        num_workers, prefetch_factor = settings['num_workers'], settings['prefetch_factor']
+    elif max_workers is not None:
+        num_workers = min(num_workers, max_workers)
+    kwargs = loader_kwargs(num_workers, prefetch_factor, persistent_workers, pin_memory)
+    if batch_sampler is not None:
+        # the batches are fixed by the sampler, batch_size is only used for tuning
+        return data.DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **kwargs)
+    return data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler, collate_fn=collate_fn,
+                           drop_last=drop_last, **kwargs)
+
+
+def loader_benchmark(datasets, batch_size, shuffle=False, collate_fn=None, device=None, max_workers=None,
+                     num_batches=20):
+    """
+    Usage:
+        loader_benchmark({'train': train_dataset, 'test': test_dataset}, opt.batchsize, shuffle=True)
+    the loader-only mode of the entry points (--loader_benchmark): samples/s of every dataset for every worker count,
+    nothing is trained
+    """
+    pin_memory = use_pin_memory(device)
+    for name, dataset in datasets.items():
+        print(f'{name}: {len(dataset)} samples, batch size {batch_size}')
+        for num_workers in worker_candidates(max_workers):
+            for prefetch_factor in ((2, 4) if num_workers > 0 else (2,)):
+                throughput = measure_throughput(dataset, batch_size, num_batches, shuffle=shuffle,
+                                                collate_fn=collate_fn,
+                                                **loader_kwargs(num_workers, prefetch_factor, pin_memory=pin_memory))
+                print(f'  workers {num_workers:3d}  prefetch {prefetch_factor}  {throughput:10.1f} samples/s')
@@ -0,0 +1,69 @@
+import os
+import csv
+
+
+MANIFEST_NAME = 'manifest.csv'
+
+
+def write_manifest(manifest_path, rows, fieldnames):
+    """
+    Usage:
+        a manifest is a csv table mapping the logical name of a sample to the files it is made of, so a dataset
+        view can be built without copying files around
+    :param manifest_path:
+    :param rows: list of dicts with the keys in `fieldnames`, file paths are stored relative to the manifest
+    :param fieldnames: column names, the first one is the logical name
+    :return:
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def manifest_columns(manifest_path, columns):
+    """
+    Usage:
+        images, gts = manifest_columns(manifest_path, ['Imgs', 'GT'])
+    :param manifest_path:
+    :param columns:
+    :return: one list of file paths per column, resolved against the manifest directory and ordered by sample name
+    """
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    rows = sorted(read_manifest(manifest_path), key=lambda row: row['name'])
+    return [[os.path.normpath(os.path.join(root, row[column])) for row in rows] for column in columns]
+
+
+def find_manifest(root):
+    """
+    :return: path of the manifest in `root`, or None if `root` is a plain directory of files
+    """
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        return manifest_path
+    return None
+
+
+def list_dataset_files(root, suffixes=('.jpg', '.png')):
+    """
+    Usage:
+        list the samples of a dataset directory, or of the manifest in it (columns `name` and `path`), so loaders can
+        read a flattened view without the files being copied into `root`
+    :param root:
+    :param suffixes: only names ending with one of these are kept
+    :return: list of (name, path) sorted by name
+    """
+    manifest_path = find_manifest(root)
+    if manifest_path is not None:
+        manifest_root = os.path.dirname(os.path.abspath(manifest_path))
+        files = [(row['name'], os.path.normpath(os.path.join(manifest_root, row['path'])))
+                 for row in read_manifest(manifest_path)]
+    else:
+        files = [(f, os.path.join(root, f)) for f in os.listdir(root)]
+    return sorted((name, path) for name, path in files if name.endswith(suffixes))
@@ -0,0 +1,108 @@
+import json
+import queue
+import threading
+import torch
+
+
+class MetricsSink:
+    """
+    Usage:
+        metrics = MetricsSink(train_writer, every=20, jsonl_path=os.path.join(opt.graph_path, 'train_metrics.jsonl'))
+        metrics.add({'train/loss2': loss2, 'train/loss3': loss3}, global_current_iteration)
+        ...
+        metrics.close()
+    buffers the loss tensors of every step without `.item()`. Every `every` steps they are stacked into one tensor and
+    handed to a background thread, which copies them to the host once and writes every step to TensorBoard and/or a
+    JSONL file, so the training loop neither syncs nor does Python I/O per step.
+    :param writer: tensorboardX SummaryWriter or None
+    :param every: steps per reduction
+    :param jsonl_path: one {"step": ..., tag: value, ...} line per step, or None
+    :param on_reduce: called in the background thread with (last step, {tag: mean over the window}), e.g. to update a
+    progress bar
+    A failed write is raised by the next `add`, `flush`, `wait` or `close`.
+    """
+    def __init__(self, writer=None, every=20, jsonl_path=None, on_reduce=None):
+        self.writer = writer
+        self.every = every
+        self.jsonl_path = jsonl_path
+        self.on_reduce = on_reduce
+        self.tags = None
+        self.steps = []
+        self.values = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def add(self, scalars, step):
+        """
+        :param scalars: dict of tag -> 0-dim tensor or number, the same tags every step
+        :param step: global step of the scalars
+        """
+        self.raise_error()
+        if self.tags is None:
+            self.tags = list(scalars)
+        elif list(scalars) != self.tags:
+            # another set of tags: write out what was buffered for the previous one first
+            self.flush()
+            self.tags = list(scalars)
+        self.steps.append(step)
+        self.values.append(torch.stack([torch.as_tensor(scalars[tag]).detach().float().reshape(()) for tag in self.tags]))
+        if len(self.steps) >= self.every:
+            self.flush()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        self.raise_error()
+        if not self.steps:
+            return
+        # steps x tags, still on the device of the losses
+        values = torch.stack([value.to(self.values[0].device) for value in self.values])
+        self.queue.put((list(self.tags), self.steps, values))
+        self.steps, self.values = [], []
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            tags, steps, values = item
+            try:
+                self.write(tags, steps, values.cpu().tolist())
+            except Exception as error:
+                # the thread goes on, or the queue would never be joined
+                print(f'could not write metrics: {error!r}')
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def write(self, tags, steps, rows):
+        if self.writer is not None:
+            for step, row in zip(steps, rows):
+                for tag, value in zip(tags, row):
+                    self.writer.add_scalar(tag, value, step)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                for step, row in zip(steps, rows):
+                    f.write(json.dumps({'step': step, **dict(zip(tags, row))}) + '\n')
+        if self.on_reduce is not None:
+            means = {tag: sum(row[index] for row in rows) / len(rows) for index, tag in enumerate(tags)}
+            self.on_reduce(steps[-1], means)
+
+    def wait(self):
+        # everything added so far is written
+        self.flush()
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
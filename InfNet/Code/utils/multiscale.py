@@ -0,0 +1,105 @@
+import random
+import torch
+from torch.utils import data
+
+
+MULTISCALE_MODES = ('all', 'per_step', 'per_bucket')
+
+
+def parse_rates(size_rates):
+    # '0.75,1,1.25' -> [0.75, 1.0, 1.25]
+    return [float(rate) for rate in str(size_rates).split(',') if rate.strip()]
+
+
+def scale_size(trainsize, rate):
+    # training size of a rate, a multiple of 32 like the original recipe
+    return int(round(trainsize * rate / 32) * 32)
+
+
+class MultiScaleScheduler:
+    """
+    Usage:
+        multi_scale = MultiScaleScheduler([0.75, 1, 1.25], mode='per_step', seed=opt.seed)
+        for i, pack in enumerate(train_loader, start=1):
+            for rate in multi_scale.rates(i, epoch):
+    which scales a training step runs:
+        all: every rate for every batch, the original recipe (one forward/backward per rate and batch)
+        per_step: one rate per batch, consecutive windows of len(size_rates) batches see every rate once in a random
+            order, so with --accum_steps len(size_rates) every optimizer step still mixes all scales
+        per_bucket: one random rate for `bucket_steps` consecutive batches
+    The rates only depend on (seed, epoch, step), so the data loader can ask for the same rates ahead of the training
+    loop (ScaleBatchSampler) and resize the samples in the workers.
+    """
+    def __init__(self, size_rates=(0.75, 1, 1.25), mode='all', bucket_steps=50, seed=0):
+        assert mode in MULTISCALE_MODES, f'unknown multi-scale mode {mode}, options are {MULTISCALE_MODES}'
+        self.size_rates = list(size_rates)
+        self.mode = mode
+        self.bucket_steps = bucket_steps
+        self.seed = seed
+
+    def rates(self, step, epoch=0):
+        """
+        :param step: 1-based step of the epoch
+        :return: list of the rates to train this step on
+        """
+        if self.mode == 'all':
+            return list(self.size_rates)
+        if self.mode == 'per_step':
+            window, position = divmod(step - 1, len(self.size_rates))
+            order = list(self.size_rates)
+            random.Random(f'{self.seed}-{epoch}-{window}').shuffle(order)
+            return [order[position]]
+        bucket = (step - 1) // self.bucket_steps
+        return [random.Random(f'{self.seed}-{epoch}-{bucket}').choice(self.size_rates)]
+
+    def single_rate(self):
+        # every step runs one rate, so a batch can be loaded at its size
+        return self.mode != 'all' or len(self.size_rates) == 1
+
+
+class ScaleBatchSampler(data.Sampler):
+    """
+    batches of (index, size) for the datasets that can load a sample at another training size, the size of every batch
+    is the rate `multi_scale` picks for its step. Call `set_epoch` before every epoch like with DistributedSampler.
+    With num_replicas > 1 every rank gets its shard of the samples, and all ranks run the same size per step.
+    """
+    def __init__(self, num_samples, batch_size, multi_scale, trainsize, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0):
+        assert multi_scale.single_rate(), 'the sizes can only be picked in the loader for one rate per step'
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.multi_scale = multi_scale
+        self.trainsize = trainsize
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_samples))
+        if self.num_replicas > 1:
+            # padded like DistributedSampler, so every rank runs the same number of steps
+            indices += indices[:self.shard_size() * self.num_replicas - len(indices)]
+            indices = indices[self.rank::self.num_replicas]
+        for step in range(1, len(self) + 1):
+            batch = indices[(step - 1) * self.batch_size:step * self.batch_size]
+            size = scale_size(self.trainsize, self.multi_scale.rates(step, self.epoch)[0])
+            yield [(index, size) for index in batch]
+
+    def shard_size(self):
+        return (self.num_samples + self.num_replicas - 1) // self.num_replicas
+
+    def __len__(self):
+        if self.drop_last:
+            return self.shard_size() // self.batch_size
+        return (self.shard_size() + self.batch_size - 1) // self.batch_size
@@ -1,4 +1,10 @@
+import os
 import numpy as np
+import torch.nn.functional as F
+
+
+# gt intensities of the multi-class lung dataset: < 19 background, 19..38 ground-glass opacity, > 38 consolidation
+LABEL_BINS = (19, 39)
 
 
 def onehot(data, n):
@@ -7,3 +13,29 @@ def onehot(data, n):
     nmsk = np.arange(data.size) * n + data.ravel()
     buf.ravel()[nmsk - 1] = 1
     return buf
+
+
+def quantize_label(label, img_name=''):
+    """
+    gt intensities -> uint8 class indices. The `tr`/`rp` samples are stored as class indices already and are kept.
+    """
+    name = os.path.basename(img_name)
+    if 'tr' in name or 'rp' in name:
+        return label.astype(np.uint8)
+    return np.digitize(label, LABEL_BINS).astype(np.uint8)
+
+
+def batch_onehot(labels, num_classes=3, is_label_smooth=False):
+    """
+    Usage:
+        img_mask = batch_onehot(img_mask.to(device), 3, is_label_smooth)
+    N x H x W class indices -> N x num_classes x H x W float one-hot, on the device of the batch. With label smoothing
+    the background channel is scaled by 0.9, since there are so many background labels. A batch that already is
+    one-hot (N x C x H x W) is returned as float unchanged.
+    """
+    if labels.dim() == 4:
+        return labels.float()
+    labels = F.one_hot(labels.long(), num_classes).permute(0, 3, 1, 2).float()
+    if is_label_smooth:
+        labels[:, 0] *= 0.9
+    return labels
@@ -0,0 +1,131 @@
+import os
+import json
+import numpy as np
+
+
+STORE_SUFFIX = '.npy'
+INDEX_SUFFIX = '.json'
+
+
+def store_paths(store_path):
+    """
+    Usage:
+        `store_path` can be given with or without the `.npy` suffix, the slice index lives next to it as `.json`
+    :param store_path:
+    :return: (data path, index path)
+    """
+    if store_path.endswith(STORE_SUFFIX):
+        store_path = store_path[:-len(STORE_SUFFIX)]
+    return store_path + STORE_SUFFIX, store_path + INDEX_SUFFIX
+
+
+def window_slice(data, window=None, dtype=np.uint8):
+    """
+    Usage:
+        map a slice into the range of `dtype`. With a (low, high) `window` (e.g. HU windowing) the window is stretched
+        over the full range of `dtype`, otherwise the values are rounded and saturated like `cv2.imwrite` does.
+    :param data: 2d array of any numeric dtype
+    :param window: None or (low, high)
+    :param dtype: np.uint8 or np.uint16
+    :return:
+    """
+    max_value = np.iinfo(dtype).max
+    data = np.asarray(data, dtype=np.float32)
+    if window is not None:
+        low, high = window
+        data = (np.clip(data, low, high) - low) * (max_value / float(high - low))
+    return np.clip(np.rint(data), 0, max_value).astype(dtype)
+
+
+def hu_window(window_center, window_width):
+    return window_center - window_width / 2., window_center + window_width / 2.
+
+
+class SliceStoreWriter:
+    """
+    Usage:
+        writer = SliceStoreWriter(store_path, num_slices, slice_shape, names)
+        writer.write(index, current_slice)
+        writer.close()
+    slices are written straight into one memory-mapped array of shape (num_slices, *slice_shape), `close` flushes it
+    and writes the slice index next to it.
+    """
+    def __init__(self, store_path, num_slices, slice_shape, names, dtype=np.uint8, window=None, chunk_size=16):
+        assert len(names) == num_slices, 'one name per slice is required'
+        self.data_path, self.index_path = store_paths(store_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.data_path)), exist_ok=True)
+        self.names = list(names)
+        self.dtype = dtype
+        self.window = window
+        self.chunk_size = chunk_size
+        self.written = 0
+        self.store = np.lib.format.open_memmap(self.data_path, mode='w+', dtype=dtype,
+                                               shape=(num_slices,) + tuple(slice_shape))
+
+    def write(self, index, current_slice):
+        self.store[index] = window_slice(current_slice, self.window, self.dtype)
+        self.written += 1
+        if self.written % self.chunk_size == 0:
+            self.store.flush()
+
+    def close(self):
+        num_slices = self.store.shape[0]
+        assert self.written == num_slices, f'expected {num_slices} slices, got {self.written}'
+        self.store.flush()
+        slice_index = {'names': self.names,
+                       'shape': list(self.store.shape),
+                       'dtype': np.dtype(self.dtype).name,
+                       'window': list(self.window) if self.window is not None else None}
+        del self.store
+        with open(self.index_path, 'w') as f:
+            json.dump(slice_index, f)
+        return self.data_path
+
+
+def write_slice_store(store_path, slices, num_slices, slice_shape, names, dtype=np.uint8, window=None,
+                      chunk_size=16):
+    """
+    Usage:
+        stream `slices` into one memory-mapped slice store. Only `chunk_size` slices are kept in memory before they
+        are flushed to disk.
+    :param store_path: output path (without or with the `.npy` suffix)
+    :param slices: iterable of 2d (or HxWxC) arrays, already in the order of `names`
+    :param num_slices:
+    :param slice_shape:
+    :param names: logical name of each slice, e.g. `tr_0`
+    :param dtype:
+    :param window: None or (low, high), see `window_slice`
+    :param chunk_size:
+    :return: data path of the written store
+    """
+    writer = SliceStoreWriter(store_path, num_slices, slice_shape, names, dtype, window, chunk_size)
+    for index, current_slice in enumerate(slices):
+        writer.write(index, current_slice)
+    return writer.close()
+
+
+class SliceStore:
+    """
+    Read-only view of a store written by `write_slice_store`. Slices are memory-mapped, so opening a store
+    is cheap and only the requested slices are paged in.
+    """
+    def __init__(self, store_path):
+        self.data_path, self.index_path = store_paths(store_path)
+        with open(self.index_path) as f:
+            slice_index = json.load(f)
+        self.names = slice_index['names']
+        self.window = slice_index['window']
+        self.name_to_index = {name: index for index, name in enumerate(self.names)}
+        self.data = np.load(self.data_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __contains__(self, name):
+        return name in self.name_to_index
+
+    def get(self, name):
+        return self.data[self.name_to_index[name]]
@@ -0,0 +1,168 @@
+import os
+import cv2
+import json
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+from Code.utils.slice_store import SliceStore, SliceStoreWriter, store_paths
+from Code.utils.onehot import quantize_label
+
+
+# how every kind is decoded and resized, this matches what the datasets do per sample:
+# - lung: PIL loaders + `transforms.Resize` of `COVIDDataset`/`IndicesDataset` (bilinear, nearest for the roc gt)
+# - multi: `cv2.imread` + `cv2.resize` of `LungDataset`/`IndicesLungDataset`, Label holds the gt already quantized
+#   to uint8 class indices
+LUNG_KINDS = {'Imgs': ('pil', 'RGB', Image.BILINEAR),
+              'GT': ('pil', 'L', Image.BILINEAR),
+              'GT_nearest': ('pil', 'L', Image.NEAREST)}
+MULTI_KINDS = {'Imgs': ('cv2', cv2.IMREAD_COLOR, cv2.INTER_LINEAR),
+               'Prior': ('cv2', cv2.IMREAD_COLOR, cv2.INTER_LINEAR),
+               'GT': ('cv2', cv2.IMREAD_GRAYSCALE, cv2.INTER_LINEAR),
+               'Label': ('cv2_label', cv2.IMREAD_GRAYSCALE, cv2.INTER_LINEAR)}
+
+
+SOURCES_NAME = 'sources.json'
+
+
+def cache_key(path):
+    # samples are looked up by the path of their image
+    return os.path.normpath(os.path.abspath(path))
+
+
+def source_stat(path):
+    # [file size, mtime] a cached sample was decoded from, None if the file is gone
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def pyramid_path(cache_path, size):
+    # the extra training sizes of a cache (build_cache.py --pyramid_sizes) live next to its stores
+    return os.path.join(cache_path, f'pyramid-{size}')
+
+
+def decode_resize(path, kind_spec, size):
+    backend, mode, interpolation = kind_spec
+    if backend == 'pil':
+        with open(path, 'rb') as f:
+            img = Image.open(f).convert(mode)
+        return np.asarray(img.resize((size, size), interpolation))
+    img = cv2.resize(cv2.imread(path, mode), (size, size), interpolation=interpolation)
+    if backend == 'cv2_label':
+        return quantize_label(img, path)
+    return img
+
+
+def _decode_job(job):
+    return decode_resize(*job)
+
+
+def build_cache(cache_path, files, kinds, size=352, num_workers=None, chunk_size=64):
+    """
+    Usage:
+        build_cache('./Dataset/Cache/LungInfection-Train', {'Imgs': images, 'GT': gts, 'GT_nearest': gts}, LUNG_KINDS)
+    decode and resize every file once on a process pool, and write one memory-mapped uint8 store per kind to
+    `cache_path/{kind}.npy` (+ `.json` index). Every store lists the samples in the same order and names them by
+    `cache_key` of their image. The size and mtime of every source file are kept in `cache_path/sources.json`, so
+    samples whose files changed after the cache was built are not read from it.
+    :param cache_path:
+    :param files: dict of kind -> list of paths, all aligned with files['Imgs']
+    :param kinds: LUNG_KINDS or MULTI_KINDS
+    :param size: output height and width
+    :param num_workers: default all cores
+    :param chunk_size: files decoded per task
+    :return:
+    """
+    names = [cache_key(path) for path in files['Imgs']]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for kind, paths in files.items():
+            assert len(paths) == len(names), f'{kind}: expected {len(names)} files, got {len(paths)}'
+            jobs = [(path, kinds[kind], size) for path in paths]
+            writer = None
+            for index, current_slice in enumerate(executor.map(_decode_job, jobs, chunksize=chunk_size)):
+                if writer is None:
+                    writer = SliceStoreWriter(os.path.join(cache_path, kind), len(names), current_slice.shape, names,
+                                              chunk_size=chunk_size)
+                writer.write(index, current_slice)
+            if writer is not None:
+                writer.close()
+            print(f'cached {len(paths)} {kind} at {size}x{size}')
+
+    sources = {name: [] for name in names}
+    missing = set()
+    for paths in files.values():
+        for name, path in zip(names, paths):
+            source = cache_key(path)
+            stat = source_stat(path)
+            if stat is None:
+                # gone since it was decoded, the sample is left out of sources.json and never read from the cache
+                print(f'{path} disappeared while building the cache, {name} is not cached')
+                missing.add(name)
+            elif source not in (entry[0] for entry in sources[name]):
+                sources[name].append([source] + stat)
+    for name in missing:
+        del sources[name]
+    with open(os.path.join(cache_path, SOURCES_NAME), 'w') as f:
+        json.dump(sources, f)
+
+
+class TensorCache:
+    """
+    Read side of `build_cache`, the stores are memory-mapped so every worker only pages in the samples it reads.
+    A sample is only `in` the cache if none of its source files changed since it was built, the datasets decode the
+    other samples from their files.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.stores = {}
+        self.levels = {}
+        self.sources = None
+        self.fresh = {}
+
+    def store(self, kind):
+        if kind not in self.stores:
+            self.stores[kind] = SliceStore(os.path.join(self.cache_path, kind))
+        return self.stores[kind]
+
+    def has_kind(self, kind):
+        # caches built before a kind was added do not have its store
+        return kind in self.stores or os.path.exists(store_paths(os.path.join(self.cache_path, kind))[0])
+
+    def level(self, size):
+        """
+        :return: the TensorCache of the pyramid level `size`, None if it was not built
+        """
+        if size not in self.levels:
+            level = TensorCache(pyramid_path(self.cache_path, size))
+            self.levels[size] = level if level.has_kind('Imgs') else None
+        return self.levels[size]
+
+    def load_sources(self):
+        if self.sources is None:
+            try:
+                with open(os.path.join(self.cache_path, SOURCES_NAME)) as f:
+                    self.sources = json.load(f)
+            except (OSError, ValueError):
+                # built before the sources were recorded, nothing can be validated
+                print(f'{self.cache_path}: no {SOURCES_NAME}, rebuild the cache with build_cache.py to use it')
+                self.sources = {}
+        return self.sources
+
+    def __contains__(self, path):
+        key = cache_key(path)
+        if key not in self.fresh:
+            entries = self.load_sources().get(key)
+            self.fresh[key] = (entries is not None and key in self.store('Imgs')
+                               and all(source_stat(source) == [size, mtime] for source, size, mtime in entries))
+        return self.fresh[key]
+
+    def get(self, kind, path):
+        # a writable copy, the augmentations work in place
+        return np.array(self.store(kind).get(cache_key(path)))
+
+    def __getstate__(self):
+        # DataLoader workers re-open the memory maps instead of pickling them, the validated samples are kept
+        return {'cache_path': self.cache_path, 'stores': {}, 'levels': {}, 'sources': None, 'fresh': dict(self.fresh)}
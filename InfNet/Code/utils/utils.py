@@ -1,5 +1,6 @@
 import torch
-import numpy as np
+import torch.nn.functional as F
+from collections import deque
 # `pip install thop`
 from thop import profile
 from thop import clever_format
@@ -24,6 +25,22 @@ def adjust_lr(optimizer, init_lr, epoch, decay_rate=0.1, decay_epoch=30):
         param_group['lr'] *= decay
 
 
+def mask_to_edge(gts, kernel_size=3, threshold=0.5):
+    """
+    Usage:
+        derive the edge supervision from a (N, 1, H, W) gt batch on its device instead of reading an `Edge/` folder.
+        The edge is the inner morphological gradient of the binarized mask (mask - erosion), a boundary of about
+        kernel_size // 2 pixels like the Canny edges of `binary2edge`
+    :param gts: gt batch in [0, 1], may be bilinearly rescaled
+    :param kernel_size: odd size of the square structuring element
+    :param threshold: gts above it are foreground
+    :return: float edge batch of the same shape, 0 or 1
+    """
+    masks = (gts > threshold).to(gts.dtype)
+    erosion = -F.max_pool2d(-masks, kernel_size, stride=1, padding=kernel_size // 2)
+    return masks - erosion
+
+
 def timer(start, end):
     hours, rem = divmod(end-start, 3600)
     minutes, seconds = divmod(rem, 60)
@@ -42,7 +59,8 @@ class AvgMeter(object):
         self.avg = 0
         self.sum = 0
         self.count = 0
-        self.losses = []
+        # only the last `num` losses are shown, keep no more than those
+        self.losses = deque(maxlen=self.num)
 
     def update(self, val, n=1):
         self.val = val
@@ -52,7 +70,7 @@ class AvgMeter(object):
         self.losses.append(val)
 
     def show(self):
-        return torch.mean(torch.stack(self.losses[np.maximum(len(self.losses)-self.num, 0):]))
+        return torch.mean(torch.stack(list(self.losses)))
 
 
 def CalParams(model, input_tensor):
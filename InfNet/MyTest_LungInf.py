@@ -9,7 +9,6 @@ First Version: Created on 2020-05-13 (@author: Ge-Peng Ji)
 
 import torch
 import torch.nn.functional as F
-import numpy as np
 import os
 import argparse
 import imageio
@@ -19,7 +18,7 @@ import sys
 sys.path.append('..')
 
 from InfNet.Code.model_lung_infection.InfNet_ResNet import Inf_Net as Network
-from InfNet.Code.utils.dataloader_LungInf import test_dataset
+from InfNet.Code.utils.dataloader_LungInf import get_inference_loader, restore_predictions
 
 
 def joint_loss(pred, mask):
@@ -40,6 +39,8 @@ def inference():
     parser.add_argument('--data_path', type=str, default='./Dataset/TestingSet/LungInfection-Test/',
                         help='Path to test data')
     parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch_size', type=int, default=16, help='slices per forward pass')
+    parser.add_argument('--num_workers', type=int, default=-1, help='-1 picks the fastest for this host')
     parser.add_argument('--pth_path', type=str, default='./Snapshots/save_weights/self-inf-net_improved/Inf-Net-36.pth',
                         help='Path to weights fileif `semi-sup`, edit it to `Semi-Inf-Net/Semi-Inf-Net-100.pth`')
     parser.add_argument('--save_path', type=str, default='./Results/Lung infection segmentation/self-inf-net_improved/',
@@ -63,21 +64,17 @@ def inference():
 
     image_root = '{}/Imgs/'.format(opt.data_path)
     gt_root = '{}/GT/'.format(opt.data_path)
-    test_loader = test_dataset(image_root, gt_root, opt.testsize)
+    test_loader = get_inference_loader(image_root, gt_root, opt.testsize, opt.batch_size, opt.num_workers, opt.device)
     os.makedirs(opt.save_path, exist_ok=True)
 
-    for i in range(test_loader.size):
-        image, gt, name = test_loader.load_data()
-        gt = np.asarray(gt, np.float32)
-        gt /= (gt.max() + 1e-8)
-        image = image.to(opt.device)
-
-        lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(image)
-        res = lateral_map_2
-        res = F.upsample(res, size=gt.shape, mode='bilinear', align_corners=False)
-        res = res.sigmoid().data.cpu().numpy().squeeze()
-        res = (res - res.min()) / (res.max() - res.min() + 1e-8)
-        imageio.imwrite(opt.save_path + name, res)
+    with torch.no_grad():
+        for images, sizes, names in test_loader:
+            images = images.to(opt.device)
+
+            lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
+            # resized back to the size of the gt, one interpolate per batch since batches share their size
+            for res, name in zip(restore_predictions(lateral_map_2, sizes), names):
+                imageio.imwrite(opt.save_path + name, res)
 
     print('Test Done!')
 
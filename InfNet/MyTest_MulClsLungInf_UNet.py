@@ -10,8 +10,9 @@ First Version: Created on 2020-05-13 (@author: Ge-Peng Ji)
 import os
 import numpy as np
 from Code.utils.dataloader_MulClsLungInf_UNet import LungDataset
+from Code.utils.loader_factory import make_loader, loader_benchmark, AUTO
+from Code.utils.onehot import batch_onehot
 from torchvision import transforms
-from torch.utils.data import DataLoader
 import sys
 sys.path.append('..')
 from fcn8 import create_fcn, FCN8s
@@ -22,7 +23,8 @@ import shutil
 import argparse
 
 
-def inference(num_classes, input_channels, snapshot_dir, save_path, test_path, pseudo_path, model_name):
+def inference(num_classes, input_channels, snapshot_dir, save_path, test_path, pseudo_path, model_name,
+              num_workers=AUTO, is_loader_benchmark=False):
     test_dataset = LungDataset(
         imgs_path=os.path.join(test_path, 'Imgs/'),
         pseudo_path=pseudo_path,  # NOTES: generated from Semi-Inf-Net
@@ -32,9 +34,12 @@ def inference(num_classes, input_channels, snapshot_dir, save_path, test_path, p
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
         is_test=True
     )
-    test_dataloader = DataLoader(test_dataset, batch_size=1, shuffle=False, num_workers=0)
-
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if is_loader_benchmark:
+        loader_benchmark({'test': test_dataset}, 1, device=device)
+        return
+    test_dataloader = make_loader(test_dataset, 1, shuffle=False, num_workers=num_workers, device=device,
+                                  persistent_workers=False)
 
     model_dict = {'baseline': Inf_Net_UNet, 'improved': Inf_Net_UNet_Improved, 'FCN': create_fcn}
     lung_model = model_dict[model_name](input_channels, num_classes).to(device)
@@ -46,7 +51,7 @@ def inference(num_classes, input_channels, snapshot_dir, save_path, test_path, p
     for index, (img, pseudo, img_mask, name) in enumerate(test_dataloader):
         img = img.to(device)
         pseudo = pseudo.to(device)
-        img_mask = img_mask.to(device)
+        img_mask = batch_onehot(img_mask.to(device), num_classes)
 
         inputs = torch.cat((img, pseudo), dim=1)
         if type(lung_model) == FCN8s:
@@ -79,6 +84,8 @@ if __name__ == "__main__":
     parser.add_argument('--save_path', type=str, default='./Results/Multi-class lung infection segmentation/self-multi-inf-net_new/')
     parser.add_argument('--input_channels', type=int, default=6)
     parser.add_argument('--model_name', type=str, default='improved')  # can be baseline or improved
+    parser.add_argument('--num_workers', type=int, default=-1, help='-1 picks the fastest for this host')
+    parser.add_argument('--loader_benchmark', action='store_true', help='only measure the data loader and exit')
     arg = parser.parse_args()
 
     inference(num_classes=3,
@@ -87,5 +94,7 @@ if __name__ == "__main__":
               save_path=arg.save_path,
               pseudo_path=arg.pseudo_path,
               test_path=arg.test_path,
-              model_name=arg.model_name
+              model_name=arg.model_name,
+              num_workers=arg.num_workers,
+              is_loader_benchmark=arg.loader_benchmark
               )
@@ -11,7 +11,6 @@ import torch
 import math
 import time
 import random
-from torch.utils.data.dataloader import DataLoader
 from torch.autograd import Variable
 import torch.utils.data
 import os
@@ -19,7 +18,17 @@ import numpy as np
 import argparse
 from datetime import datetime
 from Code.utils.dataloader_LungInf import get_loader, COVIDDataset, IndicesDataset
-from Code.utils.utils import clip_gradient, adjust_lr, AvgMeter, timer
+from Code.utils.loader_factory import make_loader, loader_benchmark
+from Code.utils.manifest import find_manifest, manifest_columns
+from Code.utils.batch_augment import BatchAugmenter
+from Code.utils.amp import autocast, fp32_island, dice_parity
+from Code.utils.multiscale import MultiScaleScheduler, ScaleBatchSampler, MULTISCALE_MODES, parse_rates, scale_size
+from Code.utils.metrics_logger import MetricsSink
+from Code.utils.distributed import init_distributed, wrap_model, unwrap, distributed_sampler, all_reduce_sum, \
+    is_main_process, barrier, cleanup, get_rank, get_world_size, is_distributed, sync_gradients
+from Code.utils.fold_executor import FoldJournal, run_folds, merge_fold_metrics, parse_metric_lines, fold_cpu_budget
+from Code.utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from Code.utils.utils import clip_gradient, adjust_lr, AvgMeter, timer, mask_to_edge
 import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 from sklearn.metrics import roc_curve, auc
@@ -41,8 +50,15 @@ from metric import dice_similarity_coefficient, jaccard_similarity_coefficient,
 global_current_iteration = 0
 best_loss = 1e9
 focal_loss_criterion = FocalLoss(logits=True)
+batch_augmenter = None
+multi_scale = MultiScaleScheduler()
+train_writer, test_writer, train_metrics = None, None, None
+checkpoints = None
+# batches of the current epoch trained so far, saved by a mid-epoch checkpoint
+epoch_batches = 0
 
 
+@fp32_island
 def joint_loss(pred, mask, opt):
     weit = 1 + 5*torch.abs(F.avg_pool2d(mask, kernel_size=31, stride=1, padding=15) - mask)
 
@@ -59,71 +75,103 @@ def joint_loss(pred, mask, opt):
     return (wbce + wiou).mean()
 
 
-def train(train_loader, test_loader, model, optimizer, epoch, train_save, device, opt):
+def train(train_loader, test_loader, model, optimizer, epoch, train_save, device, opt, skip_batches=0):
     global global_current_iteration
     global best_loss
+    global epoch_batches
     global focal_loss_criterion
 
-    if opt.lookahead:
-        optimizer = Lookahead(optimizer, k=5, alpha=0.5)
     optimizer.zero_grad()
     focal_loss_criterion = focal_loss_criterion.to(device)
 
     model.train()
     # ---- multi-scale training ----
-    size_rates = [0.75, 1, 1.25]    # replace your desired scale, try larger scale for better accuracy in small object
+    # --size_rates/--multiscale: every rate per batch (all), or one rate per batch/bucket of batches
+    for sampler in (train_loader.sampler, train_loader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            # --distributed shards and --scale_in_loader sizes are drawn per epoch
+            sampler.set_epoch(epoch)
+    num_passes = 0
     loss_record1, loss_record2, loss_record3, loss_record4, loss_record5 = AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter(), AvgMeter()
     for i, pack in enumerate(train_loader, start=1):
+        if i <= skip_batches:
+            # resumed from a mid-epoch checkpoint, these batches are trained already
+            continue
+        epoch_batches = i
         global_current_iteration += 1
-        for rate in size_rates:
-            optimizer.zero_grad()
+        if batch_augmenter is not None:
+            # --batch_augment: the whole batch is augmented at once on the device
+            pack = batch_augmenter(*[tensor.to(device) for tensor in pack])
+        rates = multi_scale.rates(i, epoch)
+        for rate in rates:
             # ---- data prepare ----
-            images, gts, edges = pack
+            if len(pack) == 3:
+                images, gts, edges = pack
+                edges = Variable(edges).to(device)
+            else:
+                images, gts = pack
+                edges = None
             images = Variable(images).to(device)
             gts = Variable(gts).to(device)
-            edges = Variable(edges).to(device)
             # ---- rescaling the inputs (img/gt/edge) ----
-            trainsize = int(round(opt.trainsize*rate/32)*32)
-            if rate != 1:
+            trainsize = scale_size(opt.trainsize, rate)
+            if images.shape[-1] != trainsize:
                 images = F.upsample(images, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
                 gts = F.upsample(gts, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
-                edges = F.upsample(edges, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
-
-            # ---- forward ----
-            lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
-            # ---- loss function ----
-            loss5 = joint_loss(lateral_map_5, gts, opt)
-            loss4 = joint_loss(lateral_map_4, gts, opt)
-            loss3 = joint_loss(lateral_map_3, gts, opt)
-            loss2 = joint_loss(lateral_map_2, gts, opt)
-            loss1 = BCE(lateral_edge, edges)
-            loss = loss1 + loss2 + loss3 + loss4 + loss5
-
-            train_writer.add_scalar('train/edge_loss', loss1.item(), global_current_iteration)
-            train_writer.add_scalar('train/loss2', loss2.item(), global_current_iteration)
-            train_writer.add_scalar('train/loss3', loss3.item(), global_current_iteration)
-            train_writer.add_scalar('train/loss4', loss4.item(), global_current_iteration)
-            train_writer.add_scalar('train/loss5', loss5.item(), global_current_iteration)
-            scalar_total_loss = loss2.item() + loss3.item() + loss4.item() + loss5.item()
-            train_writer.add_scalar('train/total_loss', scalar_total_loss, global_current_iteration)
-
-            # ---- backward ----
-            loss.backward()
-            clip_gradient(optimizer, opt.clip)
-            optimizer.step()
+                if edges is not None:
+                    edges = F.upsample(edges, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
+            if edges is None:
+                # --derive_edges: edges come from the (rescaled) gt batch
+                edges = mask_to_edge(gts)
+
+            # gradients of --accum_steps passes are summed into one optimizer step, --distributed ranks only
+            # all-reduce them in the pass of the step (or the last pass of the epoch)
+            num_passes += 1
+            is_step = num_passes % opt.accum_steps == 0
+            with sync_gradients(model, is_step or (i == len(train_loader) and rate == rates[-1])):
+                with autocast(opt.bf16, device):
+                    # ---- forward ----
+                    lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
+                    # ---- loss function (fp32 islands) ----
+                    loss5 = joint_loss(lateral_map_5, gts, opt)
+                    loss4 = joint_loss(lateral_map_4, gts, opt)
+                    loss3 = joint_loss(lateral_map_3, gts, opt)
+                    loss2 = joint_loss(lateral_map_2, gts, opt)
+                    loss1 = BCE(lateral_edge, edges)
+                    loss = loss1 + loss2 + loss3 + loss4 + loss5
+
+                # buffered and written by a background thread, no sync per step
+                train_metrics.add({'train/edge_loss': loss1, 'train/loss2': loss2, 'train/loss3': loss3,
+                                   'train/loss4': loss4, 'train/loss5': loss5,
+                                   'train/total_loss': loss2 + loss3 + loss4 + loss5}, global_current_iteration)
+
+                # ---- backward ----
+                (loss / opt.accum_steps).backward()
+            if is_step:
+                clip_gradient(optimizer, opt.clip)
+                optimizer.step()
+                optimizer.zero_grad()
             # ---- recording loss ----
-            if rate == 1:
+            if rate == 1 or len(rates) == 1:
                 loss_record1.update(loss1.data, opt.batchsize)
                 loss_record2.update(loss2.data, opt.batchsize)
                 loss_record3.update(loss3.data, opt.batchsize)
                 loss_record4.update(loss4.data, opt.batchsize)
                 loss_record5.update(loss5.data, opt.batchsize)
         # ---- train logging ----
-        if i % 20 == 0 or i == total_step:
+        if (i % 20 == 0 or i == total_step) and is_main_process():
             print('{} Epoch [{:03d}/{:03d}], Step [{:04d}/{:04d}], [lateral-edge: {:.4f}, '
                   'lateral-2: {:.4f}, lateral-3: {:0.4f}, lateral-4: {:0.4f}, lateral-5: {:0.4f}]'.
                   format(datetime.now(), epoch, opt.epoch, i, total_step, loss_record1.show(),
                          loss_record2.show(), loss_record3.show(), loss_record4.show(), loss_record5.show()))
+        if checkpoints is not None and checkpoints.preempted and num_passes % opt.accum_steps == 0:
+            # SIGTERM: stop after the optimizer step, the caller saves the first `epoch_batches` batches as trained
+            return None
+    if num_passes % opt.accum_steps != 0:
+        # the last passes of the epoch
+        clip_gradient(optimizer, opt.clip)
+        optimizer.step()
+        optimizer.zero_grad()
     # check testing error
     total_test_step = 0
     total_loss_5 = 0
@@ -136,13 +184,15 @@ def train(train_loader, test_loader, model, optimizer, epoch, train_save, device
     total_dice_3 = 0
     total_dice_2 = 0
     model.eval()
+    # with --distributed every rank validates its shard on the plain module, the sums are reduced below
+    net = unwrap(model)
     for pack in test_loader:
         total_test_step += 1
         image, gt, _, name = pack
         image = Variable(image).to(device)
         gt = Variable(gt).to(device)
         # ---- forward ----
-        lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(image)
+        lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = net(image)
         # ---- loss function ----
         loss5 = joint_loss(lateral_map_5, gt, opt)
         loss4 = joint_loss(lateral_map_4, gt, opt)
@@ -158,26 +208,34 @@ def train(train_loader, test_loader, model, optimizer, epoch, train_save, device
         total_dice_3 += dice_similarity_coefficient(lateral_map_3.sigmoid(), gt, 0.5)
         total_dice_2 += dice_similarity_coefficient(lateral_map_2.sigmoid(), gt, 0.5)
 
+    total_test_step, total_loss_2, total_loss_3, total_loss_4, total_loss_5, \
+        total_dice_2, total_dice_3, total_dice_4, total_dice_5 = all_reduce_sum(
+            [total_test_step, total_loss_2, total_loss_3, total_loss_4, total_loss_5,
+             total_dice_2, total_dice_3, total_dice_4, total_dice_5])
+
     total_average_loss = (total_loss_2 + total_loss_3 + total_loss_4 + total_loss_5) / total_test_step / 4
-    test_writer.add_scalar('test/loss2', total_loss_2/total_test_step, global_current_iteration)
-    test_writer.add_scalar('test/loss3', total_loss_3/total_test_step, global_current_iteration)
-    test_writer.add_scalar('test/loss4', total_loss_4/total_test_step, global_current_iteration)
-    test_writer.add_scalar('test/loss5', total_loss_5/total_test_step, global_current_iteration)
-    test_writer.add_scalar('test/total_loss', total_average_loss, global_current_iteration)
-    test_writer.add_scalar('test/dice', (total_dice_2 + total_dice_3 + total_dice_4 + total_dice_5) / total_test_step / 4, global_current_iteration)
+    if is_main_process():
+        test_writer.add_scalar('test/loss2', total_loss_2/total_test_step, global_current_iteration)
+        test_writer.add_scalar('test/loss3', total_loss_3/total_test_step, global_current_iteration)
+        test_writer.add_scalar('test/loss4', total_loss_4/total_test_step, global_current_iteration)
+        test_writer.add_scalar('test/loss5', total_loss_5/total_test_step, global_current_iteration)
+        test_writer.add_scalar('test/total_loss', total_average_loss, global_current_iteration)
+        test_writer.add_scalar('test/dice', (total_dice_2 + total_dice_3 + total_dice_4 + total_dice_5) / total_test_step / 4, global_current_iteration)
     model.train()
 
     if total_average_loss < best_loss:
         best_loss = total_average_loss
         # ---- save model_lung_infection ----
-        save_path = './Snapshots/save_weights/{}/'.format(train_save)
-        os.makedirs(save_path, exist_ok=True)
-        torch.save(model.state_dict(), save_path + 'Inf-Net-%d.pth' % (epoch + 1))
-        print('[Saving Snapshot:]', save_path + 'Inf-Net-%d.pth' % (epoch + 1))
+        if is_main_process():
+            save_path = './Snapshots/save_weights/{}/'.format(train_save)
+            os.makedirs(save_path, exist_ok=True)
+            # written in the background
+            checkpoints.save_file(unwrap(model).state_dict(), save_path + 'Inf-Net-%d.pth' % (epoch + 1))
+            print('[Saving Snapshot:]', save_path + 'Inf-Net-%d.pth' % (epoch + 1))
     return total_average_loss
 
 
-def eval(test_loader, model, device, load_net_path, threshold, opt):
+def eval(test_loader, model, device, load_net_path, threshold, opt, title=None):
     total_test_step = 0
     total_loss_5 = []
     total_loss_4 = []
@@ -293,10 +351,8 @@ def eval(test_loader, model, device, load_net_path, threshold, opt):
     plt.ylim([0.0, 1.05])
     plt.xlabel('False Positive Rate')
     plt.ylabel('True Positive Rate')
-    if load_net_path is not None:
-        title = load_net_path.split(os.sep)[-2]
-    else:
-        title = opt.train_save
+    if title is None:
+        title = load_net_path.split(os.sep)[-2] if load_net_path is not None else opt.train_save
     plt.title(f'{title}')
     plt.legend(loc="lower right")
     plt.show()
@@ -344,9 +400,8 @@ def eval(test_loader, model, device, load_net_path, threshold, opt):
     error_auc = np.std(accumulated_auc) / np.sqrt(accumulated_auc.size) * 1.96
 
     with open('single_metric.txt', 'a') as f:
-        f.write(title + '\n')
-        for loss in accumulated_dice:
-            f.write(str(loss) + '\n')
+        # one write, folds evaluated at the same time do not interleave their lines
+        f.write(title + '\n' + ''.join(str(loss) + '\n' for loss in accumulated_dice))
 
     metric_string = ""
     metric_string  += f'mean absolute loss: {mean_loss}\n'
@@ -375,63 +430,255 @@ def cross_validation(train_save, opt):
     gt_root = '{}/GT/'.format(opt.all_path)
     edge_root = '{}/Edge/'.format(opt.all_path)
 
-    images = np.array(sorted([image_root + f for f in os.listdir(image_root) if f.endswith('.jpg') or f.endswith('.png')]))
-    gts = np.array(sorted([gt_root + f for f in os.listdir(gt_root) if f.endswith('.png')]))
-    edges = np.array(sorted([edge_root + f for f in os.listdir(edge_root) if f.endswith('.png')]))
+    edges = None
+    manifest_path = find_manifest(opt.all_path)
+    if manifest_path is not None and not os.path.isdir(image_root):
+        # the All-set was built with `combine_dataset.py --mode manifest`
+        images, gts = [np.array(column) for column in manifest_columns(manifest_path, ['Imgs', 'GT'])]
+        if not opt.derive_edges:
+            edges = np.array(manifest_columns(manifest_path, ['Edge'])[0])
+    else:
+        images = np.array(sorted([image_root + f for f in os.listdir(image_root) if f.endswith('.jpg') or f.endswith('.png')]))
+        gts = np.array(sorted([gt_root + f for f in os.listdir(gt_root) if f.endswith('.png')]))
+        if not opt.derive_edges:
+            edges = np.array(sorted([edge_root + f for f in os.listdir(edge_root) if f.endswith('.png')]))
 
     k_folds = KFold(opt.folds)
+    folds = [(fold_index, (train_index, test_index, images, gts, edges, train_save, opt))
+             for fold_index, (train_index, test_index) in enumerate(k_folds.split(images))]
+
+    # --fold_workers: folds in a process pool, completed folds are journaled so an interrupted run resumes
+    metric_dir = os.path.join(opt.metric_path, opt.train_save)
+    journal = FoldJournal(os.path.join(metric_dir, 'folds_journal.jsonl'), {'folds': opt.folds, 'seed': opt.seed})
+    if opt.restart_folds and is_main_process():
+        journal.reset()
+    barrier()
+    results = run_folds(run_fold, folds, journal, opt.fold_workers, write_journal=is_main_process())
+    if is_main_process():
+        merge_fold_metrics(results, os.path.join(metric_dir, 'metrics_folds.txt'),
+                           {fold_index: os.path.join(metric_dir, f'metrics_{fold_index}.txt') for fold_index in results})
+
+
+def run_fold(fold_index, train_index, test_index, images, gts, edges, train_save, opt):
+    """
+    train and evaluate one fold of the cross validation, in this process or in a --fold_workers process
+    :return: the metrics of the fold, None on the ranks > 0 of a --distributed run
+    """
+    global global_current_iteration, best_loss, total_step
+    setup_training(opt)
+    global_current_iteration = 0
+    best_loss = 1e9
+    # every fold has its graphs and snapshots, folds trained at the same time would mix them up
+    open_logs(opt, os.path.join(opt.graph_path, f'fold_{fold_index}'))
+    fold_save = os.path.join(train_save, f'fold_{fold_index}')
+    metric_filename = os.path.join(opt.metric_path, opt.train_save, f"metrics_{fold_index}.txt")
+    if is_main_process() and os.path.isfile(metric_filename):
+        # the metrics of an earlier run of this fold
+        os.remove(metric_filename)
+
+    sample_augment, sample_cutout = dataset_augmentation(opt)
     VALIDATION_EARLY_STOPPING = 6
-    for fold_index, (train_index, test_index) in enumerate(k_folds.split(images)):
-        best_loss = 99999
-        current_validation_early_count = 0
-        random.seed(opt.seed)
-        np.random.seed(opt.seed)
-        torch.manual_seed(opt.seed)
-        torch.cuda.manual_seed(opt.seed)
-        torch.random.manual_seed(opt.seed)
-        model, optimizer = create_model(opt)
-
-        train_dataset = IndicesDataset(images[train_index], gts[train_index], edges[train_index], opt.trainsize, opt.is_data_augment, opt.random_cutout)
-        test_dataset = IndicesDataset(images[test_index], gts[test_index], None, opt.trainsize, opt.is_data_augment, opt.random_cutout, is_test=True)
-        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                   batch_size=opt.batchsize,
-                                                   shuffle=True,
-                                                   num_workers=opt.num_workers,
-                                                   pin_memory=True,
-                                                   drop_last=False)
-        test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                                   batch_size=opt.batchsize,
-                                                   shuffle=True,
-                                                   num_workers=opt.num_workers,
-                                                   pin_memory=True,
-                                                   drop_last=False)
-
-        for epoch in range(1, opt.epoch):
-            adjust_lr(optimizer, opt.lr, epoch, opt.decay_rate, opt.decay_epoch)
-            average_test_loss = train(train_loader, test_loader, model, optimizer, epoch, train_save, opt.device, opt)
-            if average_test_loss < best_loss:
-                best_loss = average_test_loss
-                current_validation_early_count = 0
-            else:
-                current_validation_early_count += 1
-            if current_validation_early_count >= VALIDATION_EARLY_STOPPING:
-                break
-        metric_string = eval(test_loader, model, opt.device, None, opt.eval_threshold, opt)
+    best_fold_loss = 99999
+    current_validation_early_count = 0
+    random.seed(opt.seed)
+    np.random.seed(opt.seed)
+    torch.manual_seed(opt.seed)
+    torch.cuda.manual_seed(opt.seed)
+    torch.random.manual_seed(opt.seed)
+    model, optimizer = create_model(opt)
+    model = wrap_model(model)
+
+    train_edges = None if edges is None else edges[train_index]
+    train_dataset = IndicesDataset(images[train_index], gts[train_index], train_edges, opt.trainsize, sample_augment, sample_cutout,
+                                   cache_path=opt.cache_path)
+    test_dataset = IndicesDataset(images[test_index], gts[test_index], None, opt.trainsize, opt.is_data_augment, opt.random_cutout, is_test=True,
+                                  cache_path=opt.cache_path)
+    train_sampler = distributed_sampler(train_dataset, shuffle=True, seed=opt.seed)
+    # --fold_workers: the loader workers of a fold stay within its share of the cores
+    max_workers = fold_cpu_budget()
+    train_loader = make_loader(train_dataset, opt.batchsize, shuffle=train_sampler is None,
+                               num_workers=opt.num_workers, device=opt.device, sampler=train_sampler,
+                               batch_sampler=scale_batch_sampler(len(train_dataset), opt), max_workers=max_workers)
+    test_loader = make_loader(test_dataset, opt.batchsize, shuffle=True, num_workers=opt.num_workers,
+                              device=opt.device, max_workers=max_workers)
+    # --distributed: the validation during training is sharded, the fold metrics are computed by rank 0
+    val_sampler = distributed_sampler(test_dataset, shuffle=False)
+    val_loader = test_loader if val_sampler is None else make_loader(
+        test_dataset, opt.batchsize, num_workers=opt.num_workers, device=opt.device, sampler=val_sampler,
+        max_workers=max_workers)
+    total_step = len(train_loader)
+
+    open_checkpoints(opt, fold_save)
+    first_epoch, skip_batches = 1, 0
+    state = resume_training(opt, model, optimizer)
+    if state is not None:
+        first_epoch, skip_batches = state['epoch'], state.get('batch_index', 0)
+        best_fold_loss, current_validation_early_count = state['best_fold_loss'], state['early_count']
+    for epoch in range(first_epoch, opt.epoch):
+        if current_validation_early_count >= VALIDATION_EARLY_STOPPING:
+            break
+        adjust_lr(optimizer, opt.lr, epoch, opt.decay_rate, opt.decay_epoch)
+        epoch_rng = start_epoch_rng(state, skip_batches)
+        average_test_loss = train(train_loader, val_loader, model, optimizer, epoch, fold_save, opt.device, opt,
+                                  skip_batches=skip_batches)
+        checkpoints.exit_if_preempted(lambda: training_state(model, optimizer, epoch, global_current_iteration, best_loss,
+                                                             best_fold_loss=best_fold_loss,
+                                                             early_count=current_validation_early_count,
+                                                             batch_index=epoch_batches, epoch_rng=epoch_rng), epoch)
+        skip_batches = 0
+        if average_test_loss < best_fold_loss:
+            best_fold_loss = average_test_loss
+            current_validation_early_count = 0
+        else:
+            current_validation_early_count += 1
+        if is_main_process():
+            checkpoints.save(training_state(model, optimizer, epoch + 1, global_current_iteration, best_loss,
+                                            best_fold_loss=best_fold_loss,
+                                            early_count=current_validation_early_count), epoch + 1)
+    checkpoints.close()
+    close_logs()
+
+    metrics = None
+    if is_main_process():
+        # the roc curve and dice scores of every fold are saved under its own title
+        metric_string = eval(test_loader, unwrap(model), opt.device, None, opt.eval_threshold, opt,
+                             title=f'{opt.train_save}_fold_{fold_index}')
 
         # write the metrics
         os.makedirs(os.path.join(opt.metric_path, opt.train_save), exist_ok=True)
-        filename = os.path.join(opt.metric_path, opt.train_save, f"metrics_{fold_index}.txt")
-        with open(f'{filename}', 'a') as f:
+        with open(metric_filename, 'a') as f:
             f.write(metric_string)
+        metrics = parse_metric_lines(metric_string)
+    barrier()
+    return metrics
+
+
+def dataset_augmentation(opt):
+    # with --batch_augment the datasets return plain samples, `batch_augmenter` augments the batches instead
+    if opt.batch_augment:
+        return False, 0
+    return opt.is_data_augment, opt.random_cutout
+
+
+def scale_batch_sampler(num_samples, opt):
+    # --scale_in_loader: the workers load every batch at the size of its multi-scale step
+    if not opt.scale_in_loader:
+        return None
+    return ScaleBatchSampler(num_samples, opt.batchsize, multi_scale, opt.trainsize, shuffle=True, seed=opt.seed,
+                             num_replicas=get_world_size(), rank=get_rank())
 
 
 def create_model(opt):
     model = Inf_Net(channel=opt.net_channel, n_class=opt.n_classes).to(opt.device)
     params = model.parameters()
     optimizer = torch.optim.Adam(params, opt.lr)
+    if opt.lookahead:
+        # created once, so its slow weights carry over the epochs and are part of the checkpoints
+        optimizer = Lookahead(optimizer, k=5, alpha=0.5)
     return model, optimizer
 
 
+def load_backbone(backbone):
+    if backbone == 'Res2Net50':
+        print('Backbone loading: Res2Net50')
+        from Code.model_lung_infection.InfNet_Res2Net import Inf_Net
+    elif backbone == 'ResNet50':
+        print('Backbone loading: ResNet50')
+        from Code.model_lung_infection.InfNet_ResNet import Inf_Net
+    elif backbone == 'VGGNet16':
+        print('Backbone loading: VGGNet16')
+        from Code.model_lung_infection.InfNet_VGGNet import Inf_Net
+    else:
+        raise ValueError('Invalid backbone parameters: {}'.format(backbone))
+    return Inf_Net
+
+
+def setup_training(opt):
+    # the module-level state train() and create_model() use, set up again in every --fold_workers process
+    global Inf_Net, BCE, batch_augmenter, multi_scale
+    Inf_Net = load_backbone(opt.backbone)
+    BCE = fp32_island(torch.nn.BCEWithLogitsLoss())
+    batch_augmenter = None
+    if opt.batch_augment and opt.is_data_augment:
+        # every --distributed rank draws its own augmentations
+        batch_augmenter = BatchAugmenter(cutout=opt.random_cutout, seed=opt.seed + get_rank())
+    multi_scale = MultiScaleScheduler(parse_rates(opt.size_rates), opt.multiscale, opt.scale_bucket, opt.seed)
+
+
+def open_logs(opt, graph_path):
+    # only rank 0 of a --distributed run writes the graphs
+    global train_writer, test_writer, train_metrics
+    train_writer, test_writer = None, None
+    if is_main_process():
+        train_writer = SummaryWriter(logdir=os.path.join(graph_path, 'training'))
+        test_writer = SummaryWriter(logdir=os.path.join(graph_path, 'testing'))
+    train_metrics = MetricsSink(train_writer, every=opt.log_every,
+                                jsonl_path=os.path.join(graph_path, 'train_metrics.jsonl')
+                                if opt.log_jsonl and is_main_process() else None)
+
+
+def close_logs():
+    train_metrics.close()
+    for writer in (train_writer, test_writer):
+        if writer is not None:
+            writer.close()
+
+
+def open_checkpoints(opt, train_save):
+    # full training states of every epoch in Snapshots/save_weights/{train_save}/checkpoints, written in the background
+    global checkpoints
+    checkpoints = CheckpointManager(os.path.join('./Snapshots/save_weights', train_save, 'checkpoints'),
+                                    keep_last=opt.keep_checkpoints,
+                                    # the ranks of a --distributed run would stop at different steps
+                                    handle_sigterm=not is_distributed())
+
+
+def training_state(model, optimizer, epoch, iteration, loss, **extra):
+    """
+    what --resume needs to train on from `epoch`, a mid-epoch state also holds the `batch_index` of the batches trained
+    and the `epoch_rng` the epoch started with
+    :param iteration: global step of the writers
+    :param loss: best validation loss so far
+    """
+    return dict(extra, **{
+        'epoch': epoch,
+        'global_iteration': iteration,
+        'best_loss': loss,
+        'model': unwrap(model).state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'batch_augmenter': batch_augmenter.generator.get_state() if batch_augmenter is not None else None,
+        'rng': rng_state(),
+    })
+
+
+def resume_training(opt, model, optimizer):
+    """
+    --resume: load a state of `training_state` into the model, optimizer and the module-level state
+    :return: the state, None if there is nothing to resume from
+    """
+    global global_current_iteration, best_loss
+    if not opt.resume or (opt.resume == 'latest' and checkpoints.latest() is None):
+        return None
+    state = checkpoints.load(opt.resume)
+    unwrap(model).load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    global_current_iteration, best_loss = state['global_iteration'], state['best_loss']
+    if batch_augmenter is not None and state['batch_augmenter'] is not None:
+        batch_augmenter.generator.set_state(state['batch_augmenter'])
+    set_rng_state(state['rng'])
+    return state
+
+
+def start_epoch_rng(state, skip_batches):
+    """
+    :return: the random state the epoch starts with, that of the interrupted epoch when resuming a mid-epoch state so
+    the loader goes over the batches in the same order
+    """
+    if skip_batches:
+        set_rng_state(state['epoch_rng'])
+    return rng_state()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     # hyper-parameters
@@ -455,8 +702,11 @@ if __name__ == '__main__':
                         help='whether calculate FLOPs/Params (Thop)')
     parser.add_argument('--gpu_device', type=int, default=0,
                         help='choose which GPU device you want to use')
-    parser.add_argument('--num_workers', type=int, default=0,
-                        help='number of workers in dataloader. In windows, set num_workers=0')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='number of workers in dataloader, -1 measures and picks the fastest for this host. '
+                             'In windows, set num_workers=0')
+    parser.add_argument('--loader_benchmark', action='store_true',
+                        help='only measure the samples/s of the data loaders for every worker count and exit')
     parser.add_argument('--device', type=str, default='cpu')
     # model_lung_infection parameters
     parser.add_argument('--net_channel', type=int, default=32,
@@ -476,6 +726,12 @@ if __name__ == '__main__':
                         help='If you use custom save path, please edit `--is_semi=True` and `--is_pseudo=True`')
     parser.add_argument('--is_data_augment', type=bool, default=False)
     parser.add_argument('--random_cutout', type=float, default=0)
+    parser.add_argument('--derive_edges', action='store_true',
+                        help='derive the edge supervision from the gt batch instead of reading the Edge folder')
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='apply --is_data_augment/--random_cutout to whole batches on the device instead of per sample')
+    parser.add_argument('--cache_path', type=str, default=None,
+                        help='read the training images/gts from a cache built by build_cache.py (train_path, or all_path with --folds)')
 
     # testing dataset
     parser.add_argument('--test_path', type=str, default="./Dataset/TestingSet/LungInfection-Test/")
@@ -491,29 +747,60 @@ if __name__ == '__main__':
     # new techniques
     parser.add_argument('--focal_loss', action='store_true')
     parser.add_argument('--lookahead', action='store_true')
+    parser.add_argument('--size_rates', type=str, default='0.75,1,1.25',
+                        help='scales of the multi-scale training, try larger scale for better accuracy in small object')
+    parser.add_argument('--multiscale', type=str, default='all', choices=MULTISCALE_MODES,
+                        help='all: every scale for every batch (3x compute), per_step: one scale per batch, '
+                             'per_bucket: one scale per --scale_bucket batches')
+    parser.add_argument('--scale_bucket', type=int, default=50, help='batches per scale with --multiscale per_bucket')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='forward/backward passes per optimizer step, e.g. 3 with per_step keeps every step '
+                             'on all scales')
+    parser.add_argument('--scale_in_loader', action='store_true',
+                        help='load the batches at the size of their scale (from the --cache_path pyramid of '
+                             'build_cache.py --pyramid_sizes if built) instead of upsampling them, needs per_step or '
+                             'per_bucket')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='full checkpoint to go on from, "latest" picks the newest of the run (of every fold '
+                             'with --folds, which takes no path)')
+    parser.add_argument('--keep_checkpoints', type=int, default=3,
+                        help='full checkpoints kept in Snapshots/save_weights/{train_save}/checkpoints')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data-parallel training over the processes started by torchrun (gloo), --batchsize is '
+                             'per process')
+    parser.add_argument('--fold_workers', type=int, default=1,
+                        help='folds of --folds trained at the same time in a process pool, the cores are split '
+                             'between them')
+    parser.add_argument('--restart_folds', action='store_true',
+                        help='train every fold again instead of resuming at the folds missing from the journal')
+    parser.add_argument('--bf16', action='store_true',
+                        help='train with bfloat16 autocast (CPU AVX-512/AMX nodes), the losses stay float32')
+    parser.add_argument('--bf16_parity', action='store_true',
+                        help='only compare the validation Dice of --load_net_path in float32 and bfloat16 and exit')
 
     # save log tensorboard
     parser.add_argument('--graph_path', type=str, default="./graph_log")
+    parser.add_argument('--log_every', type=int, default=20, help='steps of training losses written at once')
+    parser.add_argument('--log_jsonl', action='store_true',
+                        help='also write the training losses to graph_path/train_metrics.jsonl')
     parser.add_argument('--is_eval', type=bool, default=False)
     parser.add_argument('--metric_path', type=str, default='./metrics_log')
     parser.add_argument('--eval_threshold', type=float, help='Use for threshold the sigmoid to get 1 or 0')
 
     opt = parser.parse_args()
+    if opt.folds and opt.resume not in (None, 'latest'):
+        # a checkpoint holds a single fold
+        parser.error('--resume of --folds resumes every fold from its own checkpoints, only "latest" is allowed')
+    if opt.distributed:
+        init_distributed()
+        if opt.fold_workers > 1 and is_distributed():
+            parser.error('--fold_workers runs the folds one per process, it cannot be combined with --distributed')
 
     # ---- build models ----
     # torch.cuda.set_device(opt.gpu_device)
 
-    if opt.backbone == 'Res2Net50':
-        print('Backbone loading: Res2Net50')
-        from Code.model_lung_infection.InfNet_Res2Net import Inf_Net
-    elif opt.backbone == 'ResNet50':
-        print('Backbone loading: ResNet50')
-        from Code.model_lung_infection.InfNet_ResNet import Inf_Net
-    elif opt.backbone == 'VGGNet16':
-        print('Backbone loading: VGGNet16')
-        from Code.model_lung_infection.InfNet_VGGNet import Inf_Net
-    else:
-        raise ValueError('Invalid backbone parameters: {}'.format(opt.backbone))
+    # ---- load training sub-modules ----
+    setup_training(opt)
 
     random.seed(opt.seed)
     np.random.seed(opt.seed)
@@ -553,29 +840,42 @@ if __name__ == '__main__':
         x = torch.randn(1, 3, opt.trainsize, opt.trainsize).to(opt.device)
         CalParams(model, x)
 
-    # ---- load training sub-modules ----
-    BCE = torch.nn.BCEWithLogitsLoss()
-
-    train_writer = SummaryWriter(logdir=os.path.join(opt.graph_path, 'training'))
-    test_writer = SummaryWriter(logdir=os.path.join(opt.graph_path, 'testing'))
-
     image_root = '{}/Imgs/'.format(opt.train_path)
     gt_root = '{}/GT/'.format(opt.train_path)
-    edge_root = '{}/Edge/'.format(opt.train_path)
-
-    train_loader = get_loader(image_root, gt_root, edge_root,
-                              batchsize=opt.batchsize, trainsize=opt.trainsize, num_workers=opt.num_workers,
-                              is_data_augment=opt.is_data_augment, random_cutout=opt.random_cutout)
+    edge_root = '' if opt.derive_edges else '{}/Edge/'.format(opt.train_path)
 
+    sample_augment, sample_cutout = dataset_augmentation(opt)
     test_image_root = '{}/Imgs/'.format(opt.test_path)
     test_gt_root = '{}/GT/'.format(opt.test_path)
     test_data = test_dataset(test_image_root, test_gt_root, opt.testsize)
-    test_loader = DataLoader(test_data, batch_size=opt.batchsize, num_workers=opt.num_workers)
 
     val_image_root = '{}/Imgs/'.format(opt.val_path)
     val_gt_root = '{}/GT/'.format(opt.val_path)
     val_data = test_dataset(val_image_root, val_gt_root, opt.valsize)
-    val_loader = DataLoader(val_data, batch_size=opt.batchsize, num_workers=opt.num_workers)
+
+    if opt.loader_benchmark:
+        # loader-only mode: samples/s for every worker count, nothing is trained
+        train_data = COVIDDataset(image_root, gt_root, edge_root, opt.trainsize, sample_augment, sample_cutout,
+                                  opt.cache_path)
+        loader_benchmark({'train': train_data, 'test': test_data, 'val': val_data}, opt.batchsize, shuffle=True,
+                         device=opt.device)
+        sys.exit()
+
+    if opt.bf16_parity:
+        model.eval()
+        dice_parity(lambda pack: (model(pack[0].to(opt.device))[3].sigmoid(), pack[1].to(opt.device)),
+                    make_loader(val_data, opt.batchsize, num_workers=opt.num_workers, device=opt.device), opt.device,
+                    threshold=opt.eval_threshold or 0.5)
+        sys.exit()
+
+    train_loader = get_loader(image_root, gt_root, edge_root,
+                              batchsize=opt.batchsize, trainsize=opt.trainsize, num_workers=opt.num_workers,
+                              is_data_augment=sample_augment, random_cutout=sample_cutout,
+                              cache_path=opt.cache_path, device=opt.device,
+                              multi_scale=multi_scale if opt.scale_in_loader else None, seed=opt.seed)
+    test_loader = make_loader(test_data, opt.batchsize, num_workers=opt.num_workers, device=opt.device)
+    val_loader = make_loader(val_data, opt.batchsize, num_workers=opt.num_workers, device=opt.device,
+                             sampler=distributed_sampler(val_data, shuffle=False))
 
     total_step = len(train_loader)
 
@@ -599,13 +899,31 @@ if __name__ == '__main__':
     else:
 
         if opt.folds == 0:
-            for epoch in range(1, opt.epoch):
+            model = wrap_model(model)
+            open_logs(opt, opt.graph_path)
+            open_checkpoints(opt, train_save)
+            first_epoch, skip_batches = 1, 0
+            state = resume_training(opt, model, optimizer)
+            if state is not None:
+                first_epoch, skip_batches = state['epoch'], state.get('batch_index', 0)
+            for epoch in range(first_epoch, opt.epoch):
                 start = time.time()
                 adjust_lr(optimizer, opt.lr, epoch, opt.decay_rate, opt.decay_epoch)
-                train(train_loader, val_loader, model, optimizer, epoch, train_save, opt.device, opt)
+                epoch_rng = start_epoch_rng(state, skip_batches)
+                train(train_loader, val_loader, model, optimizer, epoch, train_save, opt.device, opt,
+                      skip_batches=skip_batches)
+                checkpoints.exit_if_preempted(
+                    lambda: training_state(model, optimizer, epoch, global_current_iteration, best_loss,
+                                           batch_index=epoch_batches, epoch_rng=epoch_rng), epoch)
+                skip_batches = 0
+                if is_main_process():
+                    checkpoints.save(training_state(model, optimizer, epoch + 1, global_current_iteration, best_loss),
+                                     epoch + 1)
                 end = time.time()
                 timer(start, end)
+            checkpoints.close()
+            close_logs()
         else:
             del train_loader, val_loader
             cross_validation(train_save, opt)
-
+    cleanup()
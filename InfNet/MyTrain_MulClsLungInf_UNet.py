@@ -24,9 +24,18 @@ import sys
 sys.path.append('..')
 
 from Code.utils.dataloader_MulClsLungInf_UNet import LungDataset, IndicesLungDataset
+from Code.utils.manifest import find_manifest, manifest_columns
+from Code.utils.batch_augment import BatchAugmenter
+from Code.utils.onehot import batch_onehot
+from Code.utils.amp import autocast, fp32_island
+from Code.utils.metrics_logger import MetricsSink
+from Code.utils.distributed import init_distributed, wrap_model, unwrap, distributed_sampler, gather_lists, \
+    is_main_process, barrier, cleanup, is_distributed, get_rank
+from Code.utils.fold_executor import FoldJournal, run_folds, merge_fold_metrics, fold_cpu_budget
+from Code.utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from Code.utils.loader_factory import make_loader, loader_benchmark, AUTO
 from torchvision import transforms
 # from LungData import test_dataloader, train_dataloader  # pls change batch_size
-from torch.utils.data import DataLoader
 from Code.model_lung_infection.InfNet_UNet import *
 from fcn8 import create_fcn, FCN8s
 from Code.utils.utils import timer
@@ -55,13 +64,27 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
     VALIDATION_EARLY_STOPPING = 6
     current_validation_early_count = 0
 
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0, drop_last=True)
+    # --batch_augment: the datasets return plain samples and whole batches are augmented on the device
+    batch_augmenter = None
+    if arg.batch_augment and is_data_augment:
+        # every --distributed rank draws its own augmentations
+        batch_augmenter = BatchAugmenter(cutout=random_cutout, cutout_prob=0.5, seed=arg.seed + get_rank())
+
+    # --distributed: every rank trains and validates on its shard
+    train_sampler = distributed_sampler(train_dataset, shuffle=False, seed=arg.seed)
+    # --fold_workers: the loader workers of a fold stay within its share of the cores
+    train_dataloader = make_loader(train_dataset, batch_size, shuffle=False, num_workers=arg.num_workers, device=device,
+                                   sampler=train_sampler, max_workers=fold_cpu_budget())
+    test_dataloader = make_loader(test_dataset, batch_size, shuffle=False, num_workers=arg.num_workers, device=device,
+                                  drop_last=True, sampler=distributed_sampler(test_dataset, shuffle=False),
+                                  max_workers=fold_cpu_budget())
 
     if arg.focal_loss:
         criterion = FocalLoss().to(device)  # nn.BCELoss().to(device)
     else:
         criterion = nn.BCELoss().to(device)
+    # the loss is computed in float32 also under --bf16
+    criterion = fp32_island(criterion)
     optimizer = optim.SGD(lung_model.parameters(), lr=lr, momentum=0.7)
 
     if arg.lookahead:
@@ -73,10 +96,15 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
         net_state_dict = torch.load(load_net_path, map_location=torch.device(device))
         net_state_dict = {k: v for k, v in net_state_dict.items() if k in lung_model.state_dict()}
         lung_model.load_state_dict(net_state_dict)
+    lung_model = wrap_model(lung_model)
 
-    # summary writers
-    train_writer = SummaryWriter(os.path.join(graph_path, 'training'))
-    test_writer = SummaryWriter(os.path.join(graph_path, 'testing'))
+    # summary writers, only rank 0 of a --distributed run writes
+    train_writer, test_writer = None, None
+    if is_main_process():
+        train_writer = SummaryWriter(os.path.join(graph_path, 'training'))
+        test_writer = SummaryWriter(os.path.join(graph_path, 'testing'))
+    # per step training loss, written by a background thread every `log_every` steps
+    train_metrics = MetricsSink(train_writer, every=arg.log_every)
 
     print("#" * 20, "\nStart Training (Inf-Net)\nThis code is written for 'Inf-Net: Automatic COVID-19 Lung "
                     "Infection Segmentation from CT Scans', 2020, arXiv.\n"
@@ -85,41 +113,94 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
                     "via E-mail (gepengai.ji@163.com)\n----\n", "#" * 20)
 
     global_iteration = 0
-    for epo in range(epo_num):
 
+    # full training state of every epoch, written in the background; the ranks of a --distributed run would stop at
+    # different steps on SIGTERM, so only single process runs handle it
+    checkpoints = CheckpointManager(os.path.join('./Snapshots/save_weights', save_path, 'checkpoints'),
+                                    keep_last=arg.keep_checkpoints, handle_sigterm=not is_distributed())
+
+    def training_state(epoch, iteration, **mid_epoch):
+        # what --resume needs to train on from `epoch`, the Lookahead slow weights are part of the optimizer state; a
+        # mid-epoch state also holds the `batch_index` of the batches trained and the `epoch_rng` the epoch started with
+        return dict(mid_epoch, **{
+            'epoch': epoch,
+            'global_iteration': iteration,
+            'best': [best_loss, best_dice, best_jaccard, best_sensitivity, best_precision],
+            'early_count': current_validation_early_count,
+            'model': unwrap(lung_model).state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'batch_augmenter': batch_augmenter.generator.get_state() if batch_augmenter is not None else None,
+            'rng': rng_state(),
+        })
+
+    first_epoch, skip_batches = 0, 0
+    if arg.resume and (arg.resume != 'latest' or checkpoints.latest() is not None):
+        state = checkpoints.load(arg.resume)
+        unwrap(lung_model).load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        best_loss, best_dice, best_jaccard, best_sensitivity, best_precision = state['best']
+        current_validation_early_count = state['early_count']
+        global_iteration = state['global_iteration']
+        if batch_augmenter is not None and state['batch_augmenter'] is not None:
+            batch_augmenter.generator.set_state(state['batch_augmenter'])
+        set_rng_state(state['rng'])
+        first_epoch, skip_batches = state['epoch'], state.get('batch_index', 0)
+        if current_validation_early_count >= VALIDATION_EARLY_STOPPING:
+            # the checkpointed run had stopped early
+            first_epoch = epo_num
+
+    for epo in range(first_epoch, epo_num):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epo)
+
+        if skip_batches:
+            # a mid-epoch checkpoint: the loader goes over the batches in the order of the interrupted epoch
+            set_rng_state(state['epoch_rng'])
+        epoch_rng = rng_state()
+        epoch_batches = skip_batches
         train_loss = 0
         lung_model.train()
 
-        total_train_loss = []
         for index, (img, pseudo, img_mask, _) in enumerate(train_dataloader):
+            if index < skip_batches:
+                # resumed from a mid-epoch checkpoint, these batches are trained already
+                continue
+            epoch_batches = index + 1
             global_iteration += 1
 
             img = img.to(device)
             pseudo = pseudo.to(device)
-            img_mask = img_mask.to(device)
+            img_mask = batch_onehot(img_mask.to(device), num_classes, is_label_smooth)
+            if batch_augmenter is not None:
+                img, pseudo, img_mask = batch_augmenter(img, pseudo, img_mask, modes=('bilinear', 'bilinear', 'nearest'))
 
             optimizer.zero_grad()
 
             inputs =  torch.cat((img, pseudo), dim =1)
-            if type(lung_model) == FCN8s:
+            if type(unwrap(lung_model)) == FCN8s:
                 inputs = img
 
-            output = lung_model(inputs)  # change 2nd img to pseudo for original
+            with autocast(arg.bf16, device):
+                output = lung_model(inputs)  # change 2nd img to pseudo for original
 
-            output = torch.sigmoid(output)  # output.shape is torch.Size([4, 2, 160, 160])
-            loss = criterion(output, img_mask)
+                output = torch.sigmoid(output.float())  # output.shape is torch.Size([4, 2, 160, 160])
+                loss = criterion(output, img_mask)
 
             loss.backward()
-            iter_loss = loss.item()
-
-            train_loss += iter_loss
-            total_train_loss.append(train_loss)
+            train_loss += loss.detach()
+            train_metrics.add({'train/loss': loss}, global_iteration)
 
             optimizer.step()
 
-            if np.mod(index, 20) == 0:
+            if np.mod(index, 20) == 0 and is_main_process():
                 print('Epoch: {}/{}, Step: {}/{}, Train loss is {}'.format(epo, epo_num, index, len(train_dataloader),
-                                                                           iter_loss))
+                                                                           loss.item()))
+            if checkpoints.preempted:
+                # SIGTERM: checkpointed below, --resume skips the first `epoch_batches` batches of the epoch
+                break
+        checkpoints.exit_if_preempted(
+            lambda: training_state(epo, global_iteration, batch_index=epoch_batches, epoch_rng=epoch_rng), epo)
+        skip_batches = 0
 
         # old saving method
         # os.makedirs('./checkpoints//UNet_Multi-Class-Semi', exist_ok=True)
@@ -154,12 +235,13 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
         for index, (img, pseudo, img_mask, name) in enumerate(test_dataloader):
             img = img.to(device)
             pseudo = pseudo.to(device)
-            img_mask = img_mask.to(device)
+            img_mask = batch_onehot(img_mask.to(device), num_classes)
 
             inputs = torch.cat((img, pseudo), dim=1)
-            if type(lung_model) == FCN8s:
+            if type(unwrap(lung_model)) == FCN8s:
                 inputs = img
-            output = lung_model(inputs)  # change 2nd img to pseudo for original
+            # the plain module: ranks validate their shard independently
+            output = unwrap(lung_model)(inputs)  # change 2nd img to pseudo for original
 
             output = torch.sigmoid(output)  # output.shape is torch.Size([4, 2, 160, 160])
             b, _, w, h = output.size()
@@ -223,6 +305,14 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
             if not math.isnan(precision):
                 cons_test_precision.append(precision)
 
+        # the batches of all ranks, so every rank takes the same early stopping decision
+        total_test_loss, background_test_dice, background_test_jaccard, background_test_sensitivity, \
+            background_test_precision, gg_test_dice, gg_test_jaccard, gg_test_sensitivity, gg_test_precision, \
+            cons_test_dice, cons_test_jaccard, cons_test_sensitivity, cons_test_precision = gather_lists(
+                total_test_loss, background_test_dice, background_test_jaccard, background_test_sensitivity,
+                background_test_precision, gg_test_dice, gg_test_jaccard, gg_test_sensitivity, gg_test_precision,
+                cons_test_dice, cons_test_jaccard, cons_test_sensitivity, cons_test_precision)
+
         average_test_loss = sum(total_test_loss) / len(total_test_loss)
         average_test_dice = (sum(background_test_dice) + sum(gg_test_dice) + sum(cons_test_dice)) / \
                             (len(background_test_dice) + len(gg_test_dice) + len(cons_test_dice))
@@ -234,12 +324,13 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
             cons_test_sensitivity))
         average_test_precision = (sum(background_test_precision) + sum(gg_test_precision) + sum(cons_test_precision)) / \
                                  (len(background_test_precision) + len(gg_test_precision) + len(cons_test_precision))
-        test_writer.add_scalar('test/loss', average_test_loss, epo)
-        test_writer.add_scalar('test/dice', average_test_dice, epo)
-        test_writer.add_scalar('test/jaccard', average_test_jaccard, epo)
-        test_writer.add_scalar('test/sensitivity', average_test_sensitivity, epo)
-        test_writer.add_scalar('test/precision', average_test_precision, epo)
-        print(f'test loss is {average_test_loss}')
+        if is_main_process():
+            test_writer.add_scalar('test/loss', average_test_loss, epo)
+            test_writer.add_scalar('test/dice', average_test_dice, epo)
+            test_writer.add_scalar('test/jaccard', average_test_jaccard, epo)
+            test_writer.add_scalar('test/sensitivity', average_test_sensitivity, epo)
+            test_writer.add_scalar('test/precision', average_test_precision, epo)
+            print(f'test loss is {average_test_loss}')
 
         if average_test_loss < best_loss:
             best_loss = average_test_loss
@@ -247,18 +338,23 @@ def train(lung_model, train_dataset, test_dataset, epo_num, num_classes, input_c
             best_jaccard = average_test_jaccard
             best_sensitivity = average_test_sensitivity
             best_precision = average_test_precision
-            torch.save(lung_model.state_dict(),
-                       './Snapshots/save_weights/{}/unet_model_{}.pkl'.format(save_path, epo + 1))
-            print('Saving checkpoints: unet_model_{}.pkl'.format(epo + 1))
+            if is_main_process():
+                checkpoints.save_file(unwrap(lung_model).state_dict(),
+                                      './Snapshots/save_weights/{}/unet_model_{}.pkl'.format(save_path, epo + 1))
+                print('Saving checkpoints: unet_model_{}.pkl'.format(epo + 1))
             current_validation_early_count = 0
         else:
             current_validation_early_count += 1
+        if is_main_process():
+            checkpoints.save(training_state(epo + 1, global_iteration), epo + 1)
 
         if current_validation_early_count >= VALIDATION_EARLY_STOPPING:
             break
 
         del img
         del img_mask
+    checkpoints.close()
+    train_metrics.close()
     return best_loss, best_dice, best_jaccard, best_sensitivity, best_precision
 
 
@@ -287,7 +383,7 @@ def calculate_metrics(test_dataloader, num_classes, load_net_path, lung_model, d
     for index, (img, pseudo, img_mask, name) in enumerate(test_dataloader):
         img = img.to(device)
         pseudo = pseudo.to(device)
-        img_mask = img_mask.to(device)
+        img_mask = batch_onehot(img_mask.to(device), num_classes)
 
         inputs = torch.cat((img, pseudo), dim=1)
         if type(lung_model) == FCN8s:
@@ -566,8 +662,9 @@ def calculate_metrics(test_dataloader, num_classes, load_net_path, lung_model, d
 # if load_net_path_2 is provided, then the wilcox test will be calculated to compare between load_net_path and
 # load_net_path_2 to determine if they are statistically significant
 def eval(test_dataset, device, pseudo_test_path, lung_model, batch_size, input_channels, num_classes, gg_threshold, cons_threshold, load_net_path,
-         load_net_path_2, model_name, model_name_2):
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+         load_net_path_2, model_name, model_name_2, num_workers=AUTO):
+    test_dataloader = make_loader(test_dataset, batch_size, shuffle=False, num_workers=num_workers, device=device,
+                                  max_workers=fold_cpu_budget())
 
     if lung_model is None:
         lung_model = model_dict[model_name](input_channels, num_classes).to(device)  # input_channels=3， n_class=3
@@ -649,72 +746,115 @@ def eval(test_dataset, device, pseudo_test_path, lung_model, batch_size, input_c
 
 def cross_validation(arg):
     imgs_path = os.path.join(arg.all_path, 'Imgs') + "/"
-    img_names = [imgs_path + f for f in os.listdir(imgs_path)]
     # NOTES: prior is borrowed from the object-level label of train split
     pseudo_path = os.path.join(arg.all_path, 'Prior') + "/"
     label_path = os.path.join(arg.all_path, 'GT') + "/"
-
-    img_names = np.array(img_names)
+    manifest_path = find_manifest(arg.all_path)
+    if manifest_path is not None and not os.path.isdir(imgs_path):
+        # the All-set was built with `combine_dataset.py --mode manifest`, index the files per sample
+        img_names, pseudo_names, label_names = [np.array(column) for column in
+                                                manifest_columns(manifest_path, ['Imgs', 'Prior', 'GT'])]
+    else:
+        img_names = np.array([imgs_path + f for f in os.listdir(imgs_path)])
+        pseudo_names, label_names = None, None
 
     k_folds = KFold(arg.folds)
-    for fold_index, (train_index, test_index) in enumerate(k_folds.split(img_names)):
-        np.random.seed(arg.seed)
-        random.seed(arg.seed)
-        torch.manual_seed(arg.seed)
-        torch.cuda.manual_seed(arg.seed)
-        torch.random.manual_seed(arg.seed)
-
-        train_img_names = img_names[train_index]
-        test_img_names = img_names[test_index]
-
-        training_dataset = IndicesLungDataset(
-            img_names=train_img_names,
-            pseudo_path=pseudo_path,
-            label_path=label_path,
-            transform=transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
-            is_data_augment=arg.is_data_augment, is_label_smooth=arg.is_label_smooth, random_cutout=arg.random_cutout
-        )
-        testing_dataset = IndicesLungDataset(
-            img_names=test_img_names,
-            pseudo_path=pseudo_path,
-            label_path=label_path,
-            transform=transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
-            is_test=False)
-
-        lung_model = model_dict[arg.model_name](arg.input_channels, arg.num_classes)  # input_channels=3， n_class=3
-        # lung_model.load_state_dict(torch.load('./Snapshots/save_weights/multi_baseline/unet_model_200.pkl', map_location=torch.device(device)))
-        print(lung_model)
-        lung_model = lung_model.to(arg.device)
-
-        train(lung_model, training_dataset, testing_dataset, epo_num=arg.epoch,
-              num_classes=3,
-              input_channels=6,
-              batch_size=arg.batchsize,
-              lr=1e-2,
-              is_data_augment=arg.is_data_augment,
-              is_label_smooth=arg.is_label_smooth,
-              random_cutout=arg.random_cutout,
-              graph_path=arg.graph_path,
-              save_path=arg.save_path,
-              device=arg.device,
-              load_net_path=arg.load_net_path,
-              model_name=arg.model_name,
-              arg=arg)
-
+    folds = [(fold_index, (train_index, test_index, img_names, pseudo_names, label_names, pseudo_path, label_path, arg))
+             for fold_index, (train_index, test_index) in enumerate(k_folds.split(img_names))]
+
+    # --fold_workers: folds in a process pool, completed folds are journaled so an interrupted run resumes
+    metric_dir = os.path.join(arg.metric_path, arg.save_path)
+    journal = FoldJournal(os.path.join(metric_dir, 'folds_journal.jsonl'), {'folds': arg.folds, 'seed': arg.seed})
+    if arg.restart_folds and is_main_process():
+        journal.reset()
+    barrier()
+    results = run_folds(run_fold, folds, journal, arg.fold_workers, write_journal=is_main_process())
+    if is_main_process():
+        merge_fold_metrics(results, os.path.join(metric_dir, 'metrics_folds.txt'),
+                           {fold_index: os.path.join(metric_dir, f'metrics_{fold_index}.txt') for fold_index in results})
+
+
+def run_fold(fold_index, train_index, test_index, img_names, pseudo_names, label_names, pseudo_path, label_path, arg):
+    """
+    train and evaluate one fold of the cross validation, in this process or in a --fold_workers process
+    :return: the metrics of the fold, None on the ranks > 0 of a --distributed run
+    """
+    np.random.seed(arg.seed)
+    random.seed(arg.seed)
+    torch.manual_seed(arg.seed)
+    torch.cuda.manual_seed(arg.seed)
+    torch.random.manual_seed(arg.seed)
+
+    train_img_names = img_names[train_index]
+    test_img_names = img_names[test_index]
+    if pseudo_names is not None:
+        train_pseudo_path, test_pseudo_path = pseudo_names[train_index], pseudo_names[test_index]
+        train_label_path, test_label_path = label_names[train_index], label_names[test_index]
+    else:
+        train_pseudo_path, test_pseudo_path = pseudo_path, pseudo_path
+        train_label_path, test_label_path = label_path, label_path
+
+    training_dataset = IndicesLungDataset(
+        img_names=train_img_names,
+        pseudo_path=train_pseudo_path,
+        label_path=train_label_path,
+        transform=transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
+        is_data_augment=arg.is_data_augment and not arg.batch_augment, is_label_smooth=arg.is_label_smooth,
+        random_cutout=0 if arg.batch_augment else arg.random_cutout, cache_path=arg.cache_path
+    )
+    testing_dataset = IndicesLungDataset(
+        img_names=test_img_names,
+        pseudo_path=test_pseudo_path,
+        label_path=test_label_path,
+        transform=transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
+        is_test=False, cache_path=arg.cache_path)
+
+    lung_model = model_dict[arg.model_name](arg.input_channels, arg.num_classes)  # input_channels=3， n_class=3
+    # lung_model.load_state_dict(torch.load('./Snapshots/save_weights/multi_baseline/unet_model_200.pkl', map_location=torch.device(device)))
+    print(lung_model)
+    lung_model = lung_model.to(arg.device)
+
+    # every fold has its graphs and snapshots, folds trained at the same time would mix them up
+    fold_save_path = os.path.join(arg.save_path, f'fold_{fold_index}')
+    metric_filename = os.path.join(arg.metric_path, arg.save_path, f"metrics_{fold_index}.txt")
+    if is_main_process() and os.path.isfile(metric_filename):
+        # the metrics of an earlier run of this fold
+        os.remove(metric_filename)
+    os.makedirs(f'./Snapshots/save_weights/{fold_save_path}/', exist_ok=True)
+    train(lung_model, training_dataset, testing_dataset, epo_num=arg.epoch,
+          num_classes=3,
+          input_channels=6,
+          batch_size=arg.batchsize,
+          lr=1e-2,
+          is_data_augment=arg.is_data_augment,
+          is_label_smooth=arg.is_label_smooth,
+          random_cutout=arg.random_cutout,
+          graph_path=os.path.join(arg.graph_path, f'fold_{fold_index}'),
+          save_path=fold_save_path,
+          device=arg.device,
+          load_net_path=arg.load_net_path,
+          model_name=arg.model_name,
+          arg=arg)
+
+    metrics = None
+    if is_main_process():
+        # the fold metrics are computed once, on the full test fold
         all_metrics_information, _ = eval(testing_dataset, arg.device, None, lung_model=lung_model, batch_size=1, input_channels=6, num_classes=3,
              gg_threshold=arg.gg_threshold, cons_threshold=arg.cons_threshold,
              load_net_path=arg.load_net_path,
-             model_name=arg.model_name, load_net_path_2=None, model_name_2=None)
+             model_name=arg.model_name, load_net_path_2=None, model_name_2=None, num_workers=arg.num_workers)
 
         # write the metrics
         os.makedirs(os.path.join(arg.metric_path, arg.save_path), exist_ok=True)
-        filename = os.path.join(arg.metric_path, arg.save_path, f"metrics_{fold_index}.txt")
-        with open(f'{filename}', 'a') as f:
+        with open(metric_filename, 'a') as f:
             f.write(all_metrics_information['metrics_string'])
+        metrics = {name: value for name, value in all_metrics_information.items() if name != 'metrics_string'}
+    barrier()
+    return metrics
 
 
 if __name__ == "__main__":
@@ -746,11 +886,44 @@ if __name__ == "__main__":
     parser.add_argument('--pseudo_test_path', default='./Results/Lung infection segmentation/baseline-inf-net/', type=str)
     parser.add_argument('--val_path', default='./Dataset/ValSet/MultiClassInfection-Val/', type=str)
     parser.add_argument('--all_path', default='./Dataset/AllSet/MultiClassInfection-All/', type=str)
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='apply --is_data_augment/--random_cutout to whole batches on the device instead of per sample')
+    parser.add_argument('--cache_path', default=None, type=str,
+                        help='read the training samples from a cache built by `build_cache.py --task multi` '
+                             '(train_path, or all_path with --folds)')
+
+    parser.add_argument('--num_workers', default=-1, type=int,
+                        help='number of workers in the data loaders, -1 measures and picks the fastest for this host')
+    parser.add_argument('--loader_benchmark', action='store_true',
+                        help='only measure the samples/s of the data loaders for every worker count and exit')
 
     parser.add_argument('--focal_loss', action='store_true')
     parser.add_argument('--lookahead', action='store_true')
+    parser.add_argument('--log_every', type=int, default=20, help='steps of training losses written at once')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='full checkpoint to go on from, "latest" picks the newest of the run (of every fold '
+                             'with --folds, which takes no path)')
+    parser.add_argument('--keep_checkpoints', type=int, default=3,
+                        help='full checkpoints kept in Snapshots/save_weights/{save_path}/checkpoints')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data-parallel training over the processes started by torchrun (gloo), --batchsize is '
+                             'per process')
+    parser.add_argument('--fold_workers', type=int, default=1,
+                        help='folds of --folds trained at the same time in a process pool, the cores are split '
+                             'between them')
+    parser.add_argument('--restart_folds', action='store_true',
+                        help='train every fold again instead of resuming at the folds missing from the journal')
+    parser.add_argument('--bf16', action='store_true',
+                        help='train with bfloat16 autocast (CPU AVX-512/AMX nodes), the loss stays float32')
 
     arg = parser.parse_args()
+    if arg.folds and arg.resume not in (None, 'latest'):
+        # a checkpoint holds a single fold
+        parser.error('--resume of --folds resumes every fold from its own checkpoints, only "latest" is allowed')
+    if arg.distributed:
+        init_distributed()
+        if arg.fold_workers > 1 and is_distributed():
+            parser.error('--fold_workers runs the folds one per process, it cannot be combined with --distributed')
 
     if arg.is_eval:
         # evaluation
@@ -769,10 +942,13 @@ if __name__ == "__main__":
                 transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
             is_test=False
         )
+        if arg.loader_benchmark:
+            loader_benchmark({'test': test_dataset}, 1, device=arg.device)
+            sys.exit()
         eval(test_dataset, arg.device, None, lung_model=None, batch_size=1, input_channels=arg.input_channels, num_classes=3,
              gg_threshold=arg.gg_threshold, cons_threshold=arg.cons_threshold,
              load_net_path=arg.load_net_path, load_net_path_2=arg.load_net_path_2,
-             model_name=arg.model_name, model_name_2=arg.model_name_2)
+             model_name=arg.model_name, model_name_2=arg.model_name_2, num_workers=arg.num_workers)
         end = time.time()
         timer(start, end)
     else:
@@ -804,8 +980,8 @@ if __name__ == "__main__":
                 transform=transforms.Compose([
                     transforms.ToTensor(),
                     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
-                is_data_augment=arg.is_data_augment, is_label_smooth=arg.is_label_smooth,
-                random_cutout=arg.random_cutout)
+                is_data_augment=arg.is_data_augment and not arg.batch_augment, is_label_smooth=arg.is_label_smooth,
+                random_cutout=0 if arg.batch_augment else arg.random_cutout, cache_path=arg.cache_path)
 
             img_val_path = os.path.join(arg.val_path, 'Imgs') + '/'
             pseudo_val_path = os.path.join(arg.val_path, 'Prior') + '/'
@@ -820,6 +996,10 @@ if __name__ == "__main__":
                     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
                 is_test=False
             )
+            if arg.loader_benchmark:
+                # loader-only mode: samples/s for every worker count, nothing is trained
+                loader_benchmark({'train': train_dataset, 'val': test_dataset}, arg.batchsize, device=arg.device)
+                sys.exit()
 
             # load model
             lung_model = model_dict[arg.model_name](arg.input_channels, arg.num_classes)  # input_channels=3， n_class=3
@@ -846,3 +1026,4 @@ if __name__ == "__main__":
                 arg=arg)
             end = time.time()
             timer(start, end)
+    cleanup()
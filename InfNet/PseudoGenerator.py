@@ -11,8 +11,6 @@ First Version: Created on 2020-05-13 (@author: Ge-Peng Ji)
 import os
 import argparse
 from datetime import datetime
-import cv2
-import numpy as np
 import random
 import shutil
 from scipy import misc
@@ -24,9 +22,8 @@ import torch.nn.functional as F
 # ---- custom lib ----
 # NOTES: Here we nly provide Res2Net, you can also replace it with other backbones
 from Code.model_lung_infection.InfNet_ResNet import Inf_Net as Network
-from Code.utils.dataloader_LungInf import get_loader, test_dataset
-from Code.utils.utils import clip_gradient, adjust_lr, AvgMeter
-from Code.utils.format_conversion import binary2edge
+from Code.utils.dataloader_LungInf import get_loader, get_inference_loader, restore_predictions
+from Code.utils.utils import clip_gradient, adjust_lr, AvgMeter, mask_to_edge
 
 
 def joint_loss(pred, mask):
@@ -50,16 +47,16 @@ def trainer(train_loader, model, optimizer, epoch, opt, total_step):
         for rate in size_rates:
             optimizer.zero_grad()
             # ---- data prepare ----
-            images, gts, edges = pack
+            images, gts = pack
             images = Variable(images).cuda()
             gts = Variable(gts).cuda()
-            edges = Variable(edges).cuda()
             # ---- rescale ----
             trainsize = int(round(opt.trainsize*rate/32)*32)
             if rate != 1:
                 images = F.upsample(images, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
                 gts = F.upsample(gts, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
-                edges = F.upsample(edges, size=(trainsize, trainsize), mode='bilinear', align_corners=True)
+            # edges are derived from the (rescaled) pseudo-label batch instead of an Edge folder
+            edges = mask_to_edge(gts)
 
             # ---- forward ----
             lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
@@ -108,6 +105,7 @@ def train_module(_train_path, _train_save, _resume_snapshot):
     parser.add_argument('--train_path', type=str, default=_train_path)
     parser.add_argument('--train_save', type=str, default=_train_save)
     parser.add_argument('--resume_snapshot', type=str, default=_resume_snapshot)
+    parser.add_argument('--num_workers', type=int, default=-1, help='-1 picks the fastest for this host')
     opt = parser.parse_args()
 
     # ---- build models ----
@@ -124,9 +122,8 @@ def train_module(_train_path, _train_save, _resume_snapshot):
 
     image_root = '{}/Imgs/'.format(opt.train_path)
     gt_root = '{}/GT/'.format(opt.train_path)
-    edge_root = '{}/Edge/'.format(opt.train_path)
-
-    train_loader = get_loader(image_root, gt_root, edge_root, batchsize=opt.batchsize, trainsize=opt.trainsize)
+    train_loader = get_loader(image_root, gt_root, '', batchsize=opt.batchsize, trainsize=opt.trainsize,
+                              num_workers=opt.num_workers, device='cuda')
     total_step = len(train_loader)
 
     print("#"*20, "Start Training", "#"*20)
@@ -137,7 +134,7 @@ def train_module(_train_path, _train_save, _resume_snapshot):
                 epoch=epoch, opt=opt, total_step=total_step)
 
 
-def inference_module(_data_path, _save_path, _pth_path):
+def inference_module(_data_path, _save_path, _pth_path, batch_size=16):
     model = Network(channel=32, n_class=1)
 
     net_state_dict = torch.load(_pth_path)
@@ -150,21 +147,17 @@ def inference_module(_data_path, _save_path, _pth_path):
     # FIXME
     image_root = '{}/'.format(_data_path)
     # gt_root = '{}/mask/'.format(data_path)
-    test_loader = test_dataset(image_root, image_root, 352)
+    test_loader = get_inference_loader(image_root, image_root, 352, batch_size, device='cuda')
 
-    for i in range(test_loader.size):
-        image, gt, name = test_loader.load_data()
-        gt = np.asarray(gt, np.float32)
-        gt /= (gt.max() + 1e-8)
-        image = image.cuda()
+    with torch.no_grad():
+        for images, sizes, names in test_loader:
+            images = images.cuda()
 
-        lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(image)
+            lateral_map_5, lateral_map_4, lateral_map_3, lateral_map_2, lateral_edge = model(images)
 
-        res = lateral_map_2  # final segmentation
-        res = F.upsample(res, size=gt.shape, mode='bilinear', align_corners=False)
-        res = res.sigmoid().data.cpu().numpy().squeeze()
-        res = (res - res.min()) / (res.max() - res.min() + 1e-8)
-        imageio.imwrite(_save_path + '/' + name, res)
+            # final segmentation, resized back to the size of the slices
+            for res, name in zip(restore_predictions(lateral_map_2, sizes), names):
+                imageio.imwrite(_save_path + '/' + name, res)
 
 
 def movefiles(_src_dir, _dst_dir):
@@ -178,13 +171,11 @@ if __name__ == '__main__':
     slices = './Dataset/TrainingSet/LungInfection-Train/Pseudo-label/DataPrepare'
     slices_dir = slices + '/Imgs_splits'
     slices_pred_seg_dir = slices + '/pred_seg_split'
-    slices_pred_edge_dir = slices + '/pred_edge_split'
 
     # NOTES: Hybrid-label = Doctor-label + Pseudo-label
     semi = './Dataset/TrainingSet/LungInfection-Train/Pseudo-label/DataPrepare/Hybrid-label'
     semi_img = semi + '/Imgs'
     semi_mask = semi + '/GT'
-    semi_edge = semi + '/Edge'
 
     try:
         if (not os.path.exists(semi_img)) or (len(os.listdir(semi_img)) != 50):
@@ -192,8 +183,6 @@ if __name__ == '__main__':
                             semi_img)
             shutil.copytree('Dataset/TrainingSet/LungInfection-Train/Doctor-label/GT',
                             semi_mask)
-            shutil.copytree('Dataset/TrainingSet/LungInfection-Train/Doctor-label/Edge',
-                            semi_edge)
             print('Copy done')
         else:
             print('Check done')
@@ -221,15 +210,9 @@ if __name__ == '__main__':
 
         inference_module(_data_path=test_aux_dir, _save_path=test_aux_save_dir, _pth_path=snapshot_dir)
 
-        os.makedirs(os.path.join(slices_pred_edge_dir, split_name), exist_ok=True)
-        for pred_name in os.listdir(test_aux_save_dir):
-            edge_tmp = binary2edge(os.path.join(test_aux_save_dir, pred_name))
-            cv2.imwrite(os.path.join(slices_pred_edge_dir, split_name, pred_name), edge_tmp)
-
         # ---- move generation ----
         movefiles(test_aux_dir, semi_img)
         movefiles(test_aux_save_dir, semi_mask)
-        movefiles(os.path.join(slices_pred_edge_dir, split_name), semi_edge)
 
         # ---- training ----
         train_module(_train_path=semi,
@@ -239,5 +222,4 @@ if __name__ == '__main__':
     # move img/pseudo-label into `./Dataset/TrainingSet/LungInfection-Train/Pseudo-label`
     shutil.copytree(semi_img, './Dataset/TrainingSet/LungInfection-Train/Pseudo-label/Imgs')
     shutil.copytree(semi_mask, './Dataset/TrainingSet/LungInfection-Train/Pseudo-label/GT')
-    shutil.copytree(semi_edge, 'Dataset/TrainingSet/LungInfection-Train/Pseudo-label/Edge')
     print('Pseudo Label Generated!')
\ No newline at end of file
@@ -0,0 +1,68 @@
+import os
+import argparse
+
+from Code.utils.manifest import find_manifest, manifest_columns
+from Code.utils.image_index import image_sizes
+from Code.utils.tensor_cache import build_cache, pyramid_path, LUNG_KINDS, MULTI_KINDS
+
+
+def index_stems(directory):
+    return {item.rsplit('.', 1)[0]: os.path.join(directory, item) for item in os.listdir(directory)}
+
+
+def find_samples(data_path, kinds):
+    """
+    Usage:
+        pair every image of `data_path/Imgs` with the files of the same name in the other folders (`GT`, `Prior`),
+        or read the pairs from the manifest of an All-set built with `combine_dataset.py --mode manifest`
+    :return: dict of folder -> list of aligned paths
+    """
+    folders = ['Imgs'] + [kind for kind in kinds if kind in ('GT', 'Prior')]
+    manifest_path = find_manifest(data_path)
+    if manifest_path is not None and not os.path.isdir(os.path.join(data_path, 'Imgs')):
+        return dict(zip(folders, manifest_columns(manifest_path, folders)))
+
+    indexes = {folder: index_stems(os.path.join(data_path, folder)) for folder in folders}
+    stems = sorted(stem for stem, path in indexes['Imgs'].items() if path.endswith(('.jpg', '.png'))
+                   and all(stem in indexes[folder] for folder in folders[1:]))
+    return {folder: [indexes[folder][stem] for stem in stems] for folder in folders}
+
+
+def filter_sizes(files):
+    """
+    Usage:
+        drop the samples whose image and gt sizes differ, the same check as `COVIDDataset.filter_files`, so the cache
+        never holds a pair the datasets would skip
+    :return: files without the mismatched samples
+    """
+    sizes = image_sizes(files['Imgs'] + files['GT'])
+    keep = [index for index, (image, gt) in enumerate(zip(files['Imgs'], files['GT'])) if sizes[image] == sizes[gt]]
+    if len(keep) != len(files['Imgs']):
+        print(f'skipped {len(files["Imgs"]) - len(keep)} samples whose image and gt sizes differ')
+    return {folder: [paths[index] for index in keep] for folder, paths in files.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, default='lung', help='lung (Inf-Net) or multi (multi-class UNet)')
+    parser.add_argument('--data_path', type=str, required=True, help='folder with Imgs/GT(/Prior) or a manifest')
+    parser.add_argument('--cache_path', type=str, required=True)
+    parser.add_argument('--size', type=int, default=352)
+    parser.add_argument('--pyramid_sizes', type=str, default='',
+                        help='extra sizes of the training images/gts, e.g. 256,448 for the 0.75/1.25 rates of the '
+                             'multi-scale training (MyTrain_LungInf.py --scale_in_loader)')
+    parser.add_argument('--num_workers', type=int, default=None, help='number of processes, default all cores')
+    args = parser.parse_args()
+
+    kinds = LUNG_KINDS if args.task == 'lung' else MULTI_KINDS
+    files = find_samples(args.data_path, kinds)
+    if args.task == 'lung':
+        files = filter_sizes(files)
+        files['GT_nearest'] = files['GT']
+    else:
+        files['Label'] = files['GT']
+    build_cache(args.cache_path, files, kinds, args.size, args.num_workers)
+    for size in [int(size) for size in args.pyramid_sizes.split(',') if size.strip()]:
+        # the pyramid levels only hold what the training samples are read from
+        build_cache(pyramid_path(args.cache_path, size), {'Imgs': files['Imgs'], 'GT': files['GT']}, kinds, size,
+                    args.num_workers)
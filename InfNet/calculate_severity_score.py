@@ -5,7 +5,6 @@ import numpy as np
 from PIL import Image
 import torch
 import argparse
-from shutil import copyfile
 import torchvision.transforms as transforms
 import torch.nn.functional as F
 import imageio
@@ -15,6 +14,7 @@ from sklearn.metrics import f1_score, precision_score, recall_score
 
 from InfNet.Code.model_lung_infection.InfNet_ResNet import Inf_Net
 from InfNet.Code.model_lung_infection.InfNet_UNet import Inf_Net_UNet
+from InfNet.Code.utils.manifest import write_manifest, list_dataset_files, MANIFEST_NAME
 
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 
@@ -23,6 +23,12 @@ severe_to_score = {'Regular': 0, 'Control': 0, 'Mild': 0, 'Severe': 1, 'Critical
 
 
 def create_imgs_ictcf(ictcf_input_dir, input_dir, ictcf_output_dir):
+    """
+    Usage:
+        map every parenchyma `Patient_X_N` to its ICTCF slice `Patient_X/N.jpg`. Instead of copying the slices, the
+        mapping is written to `ictcf_output_dir/manifest.csv`, which `calculate_severity` reads as its input_dir
+    """
+    rows = []
     parenchymas = os.listdir(input_dir)
     for parenchyma in parenchymas:
         if 'Patient' not in parenchyma:
@@ -39,7 +45,8 @@ def create_imgs_ictcf(ictcf_input_dir, input_dir, ictcf_output_dir):
 
         patient_dir = os.path.join(ictcf_input_dir, patient_name)
         patient_img = os.path.join(patient_dir, f'{patient_img_index}.jpg')
-        copyfile(patient_img, os.path.join(ictcf_output_dir, f'{patient_filename}.jpg'))
+        rows.append({'name': f'{patient_filename}.jpg', 'path': os.path.relpath(patient_img, ictcf_output_dir)})
+    write_manifest(os.path.join(ictcf_output_dir, MANIFEST_NAME), rows, ['name', 'path'])
 
 
 def calculate_severity(input_dir, parenchyma_input_dir, save_segment_path, save_binary_segment_path, severity_dict, model,
@@ -52,7 +59,8 @@ def calculate_severity(input_dir, parenchyma_input_dir, save_segment_path, save_
     predictions = []
     ground_truths = []
 
-    input_images = sorted(os.listdir(input_dir))
+    # input_dir is a directory of slices or holds a manifest.csv of them (see create_imgs_ictcf)
+    input_images = list_dataset_files(input_dir, suffixes=('',))
     parenchyma_images = sorted(os.listdir(parenchyma_input_dir))
 
     transform = transforms.Compose([
@@ -66,7 +74,7 @@ def calculate_severity(input_dir, parenchyma_input_dir, save_segment_path, save_
         transforms.Normalize([0.485, 0.456, 0.406],
                              [0.229, 0.224, 0.225])])
 
-    for index, input_image in enumerate(input_images):
+    for index, (input_image, input_image_filename) in enumerate(input_images):
         if 'Patient' not in input_image:
             continue
 
@@ -77,7 +85,6 @@ def calculate_severity(input_dir, parenchyma_input_dir, save_segment_path, save_
         # if ground_truth_score is None:
         #     continue
         #
-        input_image_filename = os.path.join(input_dir, input_image)
         img = Image.open(input_image_filename)
         img = img.convert('RGB')
         image = transform(img).unsqueeze(0).to(device)
@@ -1,84 +1,95 @@
 import os
+import argparse
 from natsort import natsorted
 from shutil import copyfile
-lunginfection = ['Edge', 'GT', 'Imgs']
+
+from Code.utils.manifest import write_manifest, MANIFEST_NAME
+
+lunginfection = ['GT', 'Imgs', 'Edge']
 multiinfection = ['GT', 'Imgs', 'Prior']
+# types that are combined only when every set has them, e.g. no Edge folders when training with --derive_edges
+optional_types = ['Edge']
+image_suffixes = ('.jpg', '.png')
 sets = ['TrainingSet', 'TestingSet', 'ValSet']
 set_name = ['Train', 'Test', 'Val']
 
-# LungInfection
-# make dir first
-for current_type in lunginfection:
-    new_dir = f'Dataset/AllSet/LungInfection-All/{current_type}'
-    os.makedirs(new_dir, exist_ok=True)
-# start copying files
-current_index = 0
-current_type = lunginfection[0]
-new_dir = f'Dataset/AllSet/LungInfection-All/{current_type}'
-for set_index in range(len(sets)):
-    current_dir = f'Dataset/{sets[set_index]}/LungInfection-{set_name[set_index]}'
-    training_data_dir = os.path.join(current_dir, current_type)
-    all_items = natsorted(os.listdir(training_data_dir))
-
-    for item in all_items:
-        current_index += 1
-        item_name, item_format = item.split('.')
-        new_name = f'{str(current_index)}.{item_format}'
-
-        # make sure the other files exist before copying (same filename)
-        other_files_exist = True
-        for other_type in lunginfection[1:]:
-            testing_data_dir = os.path.join(current_dir, other_type)
-            other_item_format = os.listdir(testing_data_dir)[0].split('.')[1]
-            if not os.path.exists(os.path.join(testing_data_dir, f'{item_name}.{other_item_format}')):
-                other_files_exist = False
-                continue
-        if not other_files_exist:
-            continue
-
-        copyfile(os.path.join(training_data_dir, item), os.path.join(new_dir, new_name))
-        for other_type in lunginfection[1:]:
-            testing_data_dir = os.path.join(current_dir, other_type)
-            other_item_format = os.listdir(testing_data_dir)[0].split('.')[1]
-            other_dir = f'Dataset/AllSet/LungInfection-All/{other_type}'
-            copyfile(os.path.join(testing_data_dir, f'{item_name}.{other_item_format}'),
-                     os.path.join(other_dir, f'{str(current_index)}.{other_item_format}'))
-
-# MultiClassInfection
-# make dir first
-for current_type in multiinfection:
-    new_dir = f'Dataset/AllSet/MultiClassInfection-All/{current_type}'
-    os.makedirs(new_dir, exist_ok=True)
-# start copying files
-current_index = 0
-current_type = multiinfection[0]
-new_dir = f'Dataset/AllSet/MultiClassInfection-All/{current_type}'
-for set_index in range(len(sets)):
-    current_dir = f'Dataset/{sets[set_index]}/MultiClassInfection-{set_name[set_index]}'
-
-    training_data_dir = os.path.join(current_dir, current_type)
-    all_items = natsorted(os.listdir(training_data_dir))
-    for item in all_items:
-        current_index += 1
-        item_name, item_format = item.split('.')
-        new_name = f'{str(current_index)}.{item_format}'
-
-        # make sure the other files exist before copying (same filename)
-        other_files_exist = True
-        for other_type in multiinfection[1:]:
-            testing_data_dir = os.path.join(current_dir, other_type)
-            other_item_format = os.listdir(testing_data_dir)[0].split('.')[1]
-            other_dir = f'Dataset/AllSet/MultiClassInfection-All/{other_type}'
-            if not os.path.exists(os.path.join(testing_data_dir, f'{item_name}.{other_item_format}')):
-                other_files_exist = False
+
+def index_directory(directory):
+    """
+    Usage:
+        list a directory once and index its image files by name without the extension, other files (manifests,
+        indexes, ...) are ignored
+    :return: dict of item name -> filename
+    """
+    return {item.rsplit('.', 1)[0]: item for item in os.listdir(directory) if item.lower().endswith(image_suffixes)}
+
+
+def link_or_copy(src, dst, mode):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # e.g. the All-set is on another filesystem, fall back to copying
+            pass
+    copyfile(src, dst)
+
+
+def combine(task, types, mode):
+    """
+    Usage:
+        gather the Training/Testing/Val sets of `task` into `Dataset/AllSet/{task}-All`, renaming every sample to a
+        running index. Samples that do not have a file for every type are skipped.
+    :param task: LungInfection or MultiClassInfection
+    :param types: sub directories, the first one decides which samples exist. The `optional_types` among them are
+        dropped unless every set has them
+    :param mode: hardlink, copy or manifest (only write `{task}-All/manifest.csv` pointing at the original files)
+    :return:
+    """
+    set_dirs = [f'Dataset/{sets[set_index]}/{task}-{set_name[set_index]}' for set_index in range(len(sets))]
+    types = [current_type for current_type in types if current_type not in optional_types
+             or all(os.path.isdir(os.path.join(current_dir, current_type)) for current_dir in set_dirs)]
+
+    all_dir = f'Dataset/AllSet/{task}-All'
+    if mode != 'manifest':
+        for current_type in types:
+            os.makedirs(os.path.join(all_dir, current_type), exist_ok=True)
+
+    rows = []
+    current_index = 0
+    for current_dir in set_dirs:
+        indexes = {current_type: index_directory(os.path.join(current_dir, current_type)) for current_type in types}
+
+        for item_name in natsorted(indexes[types[0]]):
+            current_index += 1
+            # make sure the other files exist (same filename)
+            if any(item_name not in indexes[other_type] for other_type in types[1:]):
                 continue
-        if not other_files_exist:
-            continue
-
-        copyfile(os.path.join(training_data_dir, item), os.path.join(new_dir, new_name))
-        for other_type in multiinfection[1:]:
-            testing_data_dir = os.path.join(current_dir, other_type)
-            other_item_format = os.listdir(testing_data_dir)[0].split('.')[1]
-            other_dir = f'Dataset/AllSet/MultiClassInfection-All/{other_type}'
-            copyfile(os.path.join(testing_data_dir, f'{item_name}.{other_item_format}'),
-                     os.path.join(other_dir, f'{str(current_index)}.{other_item_format}'))
+
+            row = {'name': str(current_index)}
+            for current_type in types:
+                item = indexes[current_type][item_name]
+                src = os.path.join(current_dir, current_type, item)
+                if mode == 'manifest':
+                    row[current_type] = os.path.relpath(src, all_dir)
+                else:
+                    item_format = item.rsplit('.', 1)[1]
+                    new_name = f'{current_index}.{item_format}'
+                    link_or_copy(src, os.path.join(all_dir, current_type, new_name), mode)
+                    row[current_type] = os.path.join(current_type, new_name)
+            rows.append(row)
+
+    write_manifest(os.path.join(all_dir, MANIFEST_NAME), rows, ['name'] + types)
+    print(f'{task}: {len(rows)} samples ({mode})')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--mode', type=str, default='hardlink',
+                            help='hardlink (default), copy, or manifest to only write a manifest.csv per All-set')
+    args = arg_parser.parse_args()
+
+    combine('LungInfection', lunginfection, args.mode)
+    combine('MultiClassInfection', multiinfection, args.mode)
@@ -11,6 +11,7 @@ class Lookahead(Optimizer):
         self.k = k
         self.alpha = alpha
         self.param_groups = self.optimizer.param_groups
+        self.defaults = self.optimizer.defaults
         self.state = defaultdict(dict)
         self.fast_state = self.optimizer.state
         for group in self.param_groups:
@@ -40,11 +41,20 @@ class Lookahead(Optimizer):
                 group["counter"] = 0
         return loss
 
+    def params(self):
+        return list(chain.from_iterable(group["params"] for group in self.param_groups))
+
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
     def state_dict(self):
         fast_state_dict = self.optimizer.state_dict()
+        # slow weights keyed by the index of their parameter like the fast state, ids do not survive a restart
+        param_index = {id(param): index for index, param in enumerate(self.params())}
         slow_state = {
-            (id(k) if isinstance(k, torch.Tensor) else k): v
+            param_index[id(k)]: v
             for k, v in self.state.items()
+            if id(k) in param_index
         }
         fast_state = fast_state_dict["state"]
         param_groups = fast_state_dict["param_groups"]
@@ -55,17 +65,22 @@ class Lookahead(Optimizer):
         }
 
     def load_state_dict(self, state_dict):
-        slow_state_dict = {
-            "state": state_dict["slow_state"],
-            "param_groups": state_dict["param_groups"],
-        }
         fast_state_dict = {
             "state": state_dict["fast_state"],
             "param_groups": state_dict["param_groups"],
         }
-        super(Lookahead, self).load_state_dict(slow_state_dict)
         self.optimizer.load_state_dict(fast_state_dict)
+        # the inner optimizer replaced its param groups (with the saved counters)
+        self.param_groups = self.optimizer.param_groups
         self.fast_state = self.optimizer.state
+        params = self.params()
+        self.state = defaultdict(dict)
+        for index, param_state in state_dict["slow_state"].items():
+            param = params[int(index)]
+            self.state[param] = {
+                key: value.to(param.device, param.dtype) if torch.is_tensor(value) else value
+                for key, value in param_state.items()
+            }
 
     def add_param_group(self, param_group):
         param_group["counter"] = 0
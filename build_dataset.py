@@ -0,0 +1,137 @@
+import os
+import glob
+import cv2
+import numpy as np
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from natsort import natsorted
+
+from nii_to_jpg import iter_nii_slices, nii_shape, binarize
+from InfNet.Code.utils.slice_store import window_slice, SliceStoreWriter
+
+
+LUNG_INFECTION_TRAIN = 'TrainingSet/LungInfection-Train'
+MULTI_CLASS_INFECTION_TRAIN = 'TrainingSet/MultiClassInfection-Train'
+
+
+def mask_variants(mask):
+    """
+    Usage:
+        derive every mask variant from one decoded mask slice
+    :param mask: multi-class mask slice
+    :return: dict of variant name -> uint8 slice
+    """
+    mask = window_slice(mask)
+    return {'multi_class': mask,
+            'binary': binarize(mask),
+            'binary_255': np.where(mask > 0, 255, 0).astype(np.uint8)}
+
+
+def volume_outputs(dataset_root, binary_255_folder=None):
+    """
+    Usage:
+        which folders every variant of an image/mask volume is written to, this is the layout nii_jpg.sh used to build
+    :param dataset_root:
+    :param binary_255_folder: optional folder for the 0/255 masks (what convert_to_binary.py used to produce)
+    :return:
+    """
+    image_outputs = {'image': [os.path.join(dataset_root, LUNG_INFECTION_TRAIN, 'Imgs'),
+                               os.path.join(dataset_root, MULTI_CLASS_INFECTION_TRAIN, 'Imgs')]}
+    mask_outputs = {'binary': [os.path.join(dataset_root, LUNG_INFECTION_TRAIN, 'GT'),
+                               os.path.join(dataset_root, MULTI_CLASS_INFECTION_TRAIN, 'Prior')],
+                    'multi_class': [os.path.join(dataset_root, MULTI_CLASS_INFECTION_TRAIN, 'GT')]}
+    if binary_255_folder:
+        mask_outputs['binary_255'] = [binary_255_folder]
+    return image_outputs, mask_outputs
+
+
+def find_volumes(dataset_root):
+    """
+    :return: list of (kind, nii file, filename prefix)
+    """
+    volumes = [('image', os.path.join(dataset_root, 'tr_im.nii'), 'tr'),
+               ('mask', os.path.join(dataset_root, 'tr_mask.nii'), 'tr')]
+    for kind, folder in [('image', 'rp_im'), ('mask', 'rp_msk')]:
+        for nii_file in natsorted(glob.glob(os.path.join(dataset_root, folder, '*.nii'))):
+            volume_name = os.path.basename(nii_file).split('.')[0]
+            volumes.append((kind, nii_file, f'rp_{volume_name}'))
+    return [volume for volume in volumes if os.path.isfile(volume[1])]
+
+
+def write_volume_files(kind, nii_file, prefix, outputs, chunk_size=16):
+    """
+    Usage:
+        decode the volume once, encode every variant of a slice once and write the encoded bytes to every folder
+        that needs it
+    """
+    for folders in outputs.values():
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+
+    save_type = 'jpg' if kind == 'image' else 'png'
+    num_slices = 0
+    for i, current_img in iter_nii_slices(nii_file, chunk_size):
+        variants = {'image': window_slice(current_img)} if kind == 'image' else mask_variants(current_img)
+        for variant, folders in outputs.items():
+            encoded = cv2.imencode(f'.{save_type}', variants[variant])[1].tobytes()
+            for folder in folders:
+                with open(os.path.join(folder, f'{prefix}_{i}.{save_type}'), 'wb') as f:
+                    f.write(encoded)
+        num_slices += 1
+    return num_slices
+
+
+def write_volume_stores(kind, nii_file, prefix, outputs, chunk_size=16):
+    """
+    Usage:
+        same as `write_volume_files` but every variant becomes one memory-mapped slice store per folder
+    """
+    shape = nii_shape(nii_file)
+    num_slices = shape[2]
+    names = [f'{prefix}_{i}' for i in range(num_slices)]
+    writers = {variant: [SliceStoreWriter(os.path.join(folder, prefix), num_slices, shape[:2], names,
+                                          chunk_size=chunk_size) for folder in folders]
+               for variant, folders in outputs.items()}
+
+    for i, current_img in iter_nii_slices(nii_file, chunk_size):
+        variants = {'image': window_slice(current_img)} if kind == 'image' else mask_variants(current_img)
+        for variant, variant_writers in writers.items():
+            for writer in variant_writers:
+                writer.write(i, variants[variant])
+
+    for variant_writers in writers.values():
+        for writer in variant_writers:
+            writer.close()
+    return num_slices
+
+
+def build_volume(kind, nii_file, prefix, outputs, save_type, chunk_size):
+    if save_type == 'store':
+        return write_volume_stores(kind, nii_file, prefix, outputs, chunk_size)
+    return write_volume_files(kind, nii_file, prefix, outputs, chunk_size)
+
+
+def build_dataset(dataset_root, num_workers=None, save_type='files', binary_255_folder=None, chunk_size=16):
+    image_outputs, mask_outputs = volume_outputs(dataset_root, binary_255_folder)
+    volumes = find_volumes(dataset_root)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for kind, nii_file, prefix in volumes:
+            outputs = image_outputs if kind == 'image' else mask_outputs
+            futures[executor.submit(build_volume, kind, nii_file, prefix, outputs, save_type, chunk_size)] = nii_file
+        for future in as_completed(futures):
+            print(f'processed {futures[future]} ({future.result()} slices)')
+
+
+if __name__ == '__main__':
+    arg_parse = ArgumentParser()
+    arg_parse.add_argument('--dataset_root', type=str, default='InfNet/Dataset')
+    arg_parse.add_argument('--num_workers', type=int, default=None, help='number of processes, default all cores')
+    arg_parse.add_argument('--save_type', type=str, default='files', help='files (jpg/png slices) or store')
+    arg_parse.add_argument('--binary_255_folder', type=str, default=None,
+                           help='also write 0/255 binary masks to this folder')
+    arg_parse.add_argument('--chunk_size', type=int, default=16, help='number of slices decoded at a time')
+    args = arg_parse.parse_args()
+
+    build_dataset(args.dataset_root, args.num_workers, args.save_type, args.binary_255_folder, args.chunk_size)
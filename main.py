@@ -1,12 +1,14 @@
 ## import libraries
 import numpy as np
 import torch
+import sys
 from torch.autograd import Variable
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import torch.optim as optim
 import torch.nn.functional as F
-from utils.dataloaders import context_inpainting_dataloader, segmentation_data_loader
+from InfNet.Code.utils.loader_factory import make_loader, loader_benchmark
+from utils.dataloaders import context_inpainting_dataloader, InpaintingMaskCollate, segmentation_data_loader
 from models import resnet18_encoderdecoder, resnet18_encoderdecoder_wbottleneck
 from models import resnet18_coach_vae
 
@@ -24,6 +26,8 @@ np.random.seed(7)
 
 
 device = 'cpu'
+num_workers = -1                ### data loader workers, -1 measures and picks the fastest for this host
+loader_benchmark_only = False   ### only measure the samples/s of the data loaders and exit
 
 dataset_root = '/Users/darylfung/programming/Self-supervision-for-segmenting-overhead-imagery/datasets/'
 model_root = '/Users/darylfung/programming/Self-supervision-for-segmenting-overhead-imagery/model/'
@@ -112,17 +116,27 @@ erase_shape = [16, 16]         ### size of each block used to erase image
 erase_count = 16               ### number of blocks to erase from image
 rec_weight = 0.99            ### loss = rec_weight*loss_rec+ (1-rec_weight)*loss_con
 
-train_loader = torch.utils.data.DataLoader(
+train_loader = make_loader(
     context_inpainting_dataloader(img_root = train_img_root, image_list = train_image_list_path+self_supervised_split+'.txt', suffix=dataset,
                                   mirror = True, resize=True, resize_shape=[256, 256], rotate = True,
-                                  erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=128, shuffle = True)
+                                  erase_shape = erase_shape, erase_count = erase_count, batch_mask = True),
+    batch_size=128, shuffle = True,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=0 if loader_benchmark_only else num_workers, device=device)
 
-val_loader = torch.utils.data.DataLoader(
+val_loader = make_loader(
     context_inpainting_dataloader(img_root = val_img_root, image_list = val_image_list, suffix=dataset,
                                   mirror = False, resize=False, resize_shape=[256, 256], rotate = False,
-                                  crop = True, erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=32, shuffle = False)
+                                  crop = True, erase_shape = erase_shape, erase_count = erase_count, batch_mask = True),
+    batch_size=32, shuffle = False,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=0 if loader_benchmark_only else num_workers, device=device)
+
+if loader_benchmark_only:
+    # loader-only mode: samples/s of the self-supervised datasets for every worker count, nothing is trained
+    loader_benchmark({'train': train_loader.dataset, 'val': val_loader.dataset}, 128, shuffle=True,
+                     collate_fn=train_loader.collate_fn, device=device)
+    sys.exit()
 
 
 def torch_to_np(input_, mask, target, output=None):
@@ -375,7 +389,7 @@ del(net)
 
 from loss import soft_iou
 from metric import fast_hist, performMetrics
-from utils.dataloaders import segmentation_data_loader
+from utils.dataloaders import sharded_segmentation_data_loader
 
 train_seg_loss = []
 val_seg_loss = []
@@ -384,21 +398,33 @@ val_seg_iou = []
 ITER_SIZE = 2    ### accumulate gradients over ITER_SIZE iterations
 best_iou = 0.
 
-train_seg_loader = torch.utils.data.DataLoader(
-    segmentation_data_loader(img_root = train_img_root, gt_root = train_gt_root, image_list = train_image_list_path+supervised_split+'.txt',
-                             suffix=dataset, out=out, crop = True, crop_shape = [256, 256], mirror = True),
-                                           batch_size=32, num_workers=8, shuffle = True)
+train_shard_root = None    ### directory written by utils/shards.py for the supervised split, streamed instead of single files
+
+if train_shard_root is None:
+    train_seg_loader = make_loader(
+        segmentation_data_loader(img_root = train_img_root, gt_root = train_gt_root, image_list = train_image_list_path+supervised_split+'.txt',
+                                 suffix=dataset, out=out, crop = True, crop_shape = [256, 256], mirror = True),
+                                               batch_size=32, num_workers=num_workers, device=device, shuffle = True)
+else:
+    train_shards = sharded_segmentation_data_loader(shard_root = train_shard_root, shuffle_buffer = 1000,
+                                         suffix=dataset, out=out, crop = True, crop_shape = [256, 256], mirror = True)
+    ### a worker without a shard would sit idle, and the workers are started again every epoch to see set_epoch
+    train_seg_loader = make_loader(train_shards, batch_size=32, num_workers=num_workers, device=device,
+                                   max_workers=len(train_shards.shard_paths), persistent_workers=False)
 
-val_seg_loader = torch.utils.data.DataLoader(
+val_seg_loader = make_loader(
     segmentation_data_loader(img_root = val_img_root, gt_root = val_gt_root, image_list = val_image_list,
                              suffix=dataset, out=out, crop = False, mirror=False),
-                                           batch_size=8, num_workers=8, shuffle = False)
+                                           batch_size=8, num_workers=num_workers, device=device, shuffle = False)
 
 
 def train_segmentation(epoch, net_segmentation, seg_optimizer):
     global train_seg_iou
     progbar = tqdm(total=len(train_seg_loader), desc='Train')
     net_segmentation.train()
+    if hasattr(train_seg_loader.dataset, 'set_epoch'):
+        ### the shard stream reshuffles its shards and samples every epoch
+        train_seg_loader.dataset.set_epoch(epoch)
 
     train_seg_loss.append(0)
     seg_optimizer.zero_grad()
@@ -511,10 +537,10 @@ c_map = np.asarray([[128, 128, 128], [128, 128, 0], [0, 64, 0], [0, 128, 0], [12
 
 
 def visualize_segmentation(net_segmentation):
-    val_seg_loader = torch.utils.data.DataLoader(
+    val_seg_loader = make_loader(
         segmentation_data_loader(img_root=val_img_root, gt_root=val_gt_root, image_list=val_image_list,
                                  suffix=dataset, out=out, crop=False, mirror=False),
-        batch_size=1, num_workers=8, shuffle=False)
+        batch_size=1, num_workers=num_workers, device=device, shuffle=False, persistent_workers=False)
     fig, axs = plt.subplots(nrows=4, ncols=3, figsize=(9, 9))
     for batch_idx, (inputs_, targets) in enumerate(val_seg_loader):
         inputs_, targets = Variable(inputs_.to(device)), Variable(targets.to(device))
@@ -541,10 +567,10 @@ def visualize_segmentation(net_segmentation):
 def evaluate_segmentation(net_segmentation):
     net_segmentation.eval()
     hist = np.zeros((nClasses, nClasses))
-    val_seg_loader = torch.utils.data.DataLoader(
+    val_seg_loader = make_loader(
         segmentation_data_loader(img_root=val_img_root, gt_root=val_gt_root, image_list=val_image_list,
                                  suffix=dataset, out=out, crop=False, mirror=False),
-        batch_size=1, num_workers=8, shuffle=False)
+        batch_size=1, num_workers=num_workers, device=device, shuffle=False, persistent_workers=False)
 
     progbar = tqdm(total=len(val_seg_loader), desc='Eval')
 
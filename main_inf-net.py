@@ -2,6 +2,7 @@
 import numpy as np
 import random
 import torch
+import sys
 from torch.autograd import Variable
 import matplotlib.pyplot as plt
 from tqdm import tqdm
@@ -10,7 +11,11 @@ import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 from argparse import ArgumentParser
 
-from utils.dataloaders import context_inpainting_dataloader, segmentation_data_loader
+from InfNet.Code.utils.loader_factory import make_loader, loader_benchmark
+from InfNet.Code.utils.amp import autocast, fp32_island
+from InfNet.Code.utils.metrics_logger import MetricsSink
+from InfNet.Code.utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from utils.dataloaders import context_inpainting_dataloader, InpaintingMaskCollate, segmentation_data_loader
 from models import resnet18_encoderdecoder, resnet18_encoderdecoder_wbottleneck
 from models import resnet18_coach_vae
 
@@ -33,6 +38,17 @@ arg_parse.add_argument('--load_net_path', type=str)
 arg_parse.add_argument('--load_coach_path', type=str)
 arg_parse.add_argument('--seed', default=7, type=int)
 arg_parse.add_argument('--batchsize', default=128, type=int)
+arg_parse.add_argument('--num_workers', default=-1, type=int,
+                       help='data loader workers, -1 measures and picks the fastest for this host')
+arg_parse.add_argument('--loader_benchmark', action='store_true',
+                       help='only measure the samples/s of the data loaders for every worker count and exit')
+arg_parse.add_argument('--log_every', default=20, type=int,
+                       help='batches between the loss updates of the progress bar, the losses are not synced per batch')
+arg_parse.add_argument('--resume', default=None, type=str,
+                       help='full checkpoint to go on from, "latest" picks the newest in save_path/checkpoints')
+arg_parse.add_argument('--keep_checkpoints', default=3, type=int, help='full checkpoints kept in save_path/checkpoints')
+arg_parse.add_argument('--bf16', action='store_true',
+                       help='bfloat16 autocast for the forward passes (CPU AVX-512/AMX nodes), the losses stay float32')
 
 args = arg_parse.parse_args()
 
@@ -43,6 +59,7 @@ test_writer = SummaryWriter(os.path.join(graph_path, 'testing'))
 
 
 device = args.device
+num_workers = 0 if args.loader_benchmark else args.num_workers
 # set seeds
 torch.cuda.manual_seed(args.seed)
 torch.manual_seed(args.seed)
@@ -53,6 +70,8 @@ is_visualize = False
 dataset_root = './datasets/'
 
 os.makedirs(save_model_location, exist_ok=True)
+# full training states of every epoch, written in the background and on SIGTERM
+checkpoints = CheckpointManager(os.path.join(save_model_location, 'checkpoints'), keep_last=args.keep_checkpoints)
 
 dataset = 'medseg'                                    #options are: spacenet, potsdam, deepglobe_roads, deepglobe_lands
 architecture = 'resnet18_autoencoder_no_bottleneck'    #options are: resnet18_autoencoder, resnet18_encoderdecoder_wbottleneck
@@ -143,17 +162,34 @@ erase_shape = [16, 16]         ### size of each block used to erase image
 erase_count = 16               ### number of blocks to erase from image
 rec_weight = 0.99            ### loss = rec_weight*loss_rec+ (1-rec_weight)*loss_con
 
-train_loader = torch.utils.data.DataLoader(
+train_loader = make_loader(
     context_inpainting_dataloader(img_root = train_img_root, image_list = '', suffix=dataset,
                                   mirror = True, resize=True, crop=True, resize_shape=[352, 352], rotate = True,
-                                  erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=args.batchsize, shuffle = True)
+                                  erase_shape = erase_shape, erase_count = erase_count, batch_mask = True),
+    batch_size=args.batchsize, shuffle = True,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=num_workers, device=device)
 
-val_loader = torch.utils.data.DataLoader(
+val_loader = make_loader(
     context_inpainting_dataloader(img_root = val_img_root, image_list = '', suffix=dataset,
                                   mirror = False, resize=False, resize_shape=[352, 352], rotate = False,
-                                  crop = True, erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=32, shuffle = False)
+                                  crop = True, erase_shape = erase_shape, erase_count = erase_count, batch_mask = True),
+    batch_size=32, shuffle = False,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=num_workers, device=device)
+
+if args.loader_benchmark:
+    # loader-only mode: samples/s of the self-supervised datasets for every worker count, nothing is trained
+    loader_benchmark({'train': train_loader.dataset, 'val': val_loader.dataset}, args.batchsize, shuffle=True,
+                     collate_fn=train_loader.collate_fn, device=device)
+    sys.exit()
+
+
+@fp32_island
+def thresholded_mse(output, target):
+    # squared error clipped at 2, always in float32
+    mse_loss = (output - target) ** 2
+    return -1 * F.threshold(-1 * mse_loss, -2, -2)
 
 
 def torch_to_np(input_, mask, target, output=None):
@@ -250,102 +286,132 @@ best_loss = 1e5
 train_loss = []
 val_loss = []
 coach_loss = []
+# batches of the current epoch trained so far, saved by a mid-epoch checkpoint
+epoch_batches = 0
 
 
-def train_context_inpainting(epoch, net, net_optimizer, coach=None, use_coach_masks=False):
-    progbar = tqdm(total=len(train_loader), desc='Train')
+def train_context_inpainting(epoch, net, net_optimizer, coach=None, use_coach_masks=False, skip_batches=0):
+    global epoch_batches
+    progbar = tqdm(total=len(train_loader), initial=skip_batches, desc='Train')
     net.train()
-    graph_train_loss = []
+    # the mean loss of the last batches is shown by the thread of the sink
+    metrics = MetricsSink(every=args.log_every,
+                          on_reduce=lambda step, means: progbar.set_description('Train (loss=%.4f)' % means['loss']))
 
     if coach is not None:
         coach.eval()
 
-    train_loss.append(0)
+    if skip_batches:
+        # resumed from a mid-epoch checkpoint, the loss of its batches is summed up already
+        train_loss[-1] = train_loss[-1].to(device)
+    else:
+        train_loss.append(0)
     for batch_idx, (inputs_, masks, targets) in enumerate(train_loader):
+        if batch_idx < skip_batches:
+            continue
+        epoch_batches = batch_idx + 1
         net_optimizer.zero_grad()
         inputs_, masks, targets = Variable(inputs_.to(device)), Variable(masks.to(device).float()), Variable(targets.to(device))
 
-        if coach is not None:
-            masks, _, _ = coach.forward(inputs_, alpha=100, use_coach=use_coach_masks)
-
-        outputs_1 = net.forward_inpainting(inputs_ * masks)
-        loss_rec = None
-        loss_con = None
-        for output_1 in outputs_1:
-            mse_loss = (output_1 - targets) ** 2
-            mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
-            # calculate reconstruction loss
-            if loss_rec is None:
-                loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
-            else:
-                loss_rec += torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
-
-            # calculate con loss
+        with autocast(args.bf16, device):
             if coach is not None:
-                loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
-            else:
-                outputs_2 = net.forward_inpainting(inputs_ * (1 - masks))
-                for output_2 in outputs_2:
-                    mse_loss = (output_2 - targets) ** 2
-                    mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
-                    if loss_con is None:
-                        loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
-                    else:
-                        loss_con += torch.sum(mse_loss * masks) / torch.sum(masks)
-
-        total_loss = rec_weight * loss_rec + (1 - rec_weight) * loss_con
+                masks, _, _ = coach.forward(inputs_, alpha=100, use_coach=use_coach_masks)
+
+            outputs_1 = net.forward_inpainting(inputs_ * masks)
+            loss_rec = None
+            loss_con = None
+            for output_1 in outputs_1:
+                mse_loss = thresholded_mse(output_1, targets)
+                # calculate reconstruction loss
+                if loss_rec is None:
+                    loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
+                else:
+                    loss_rec += torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
+
+                # calculate con loss
+                if coach is not None:
+                    loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
+                else:
+                    outputs_2 = net.forward_inpainting(inputs_ * (1 - masks))
+                    for output_2 in outputs_2:
+                        mse_loss = thresholded_mse(output_2, targets)
+                        if loss_con is None:
+                            loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
+                        else:
+                            loss_con += torch.sum(mse_loss * masks) / torch.sum(masks)
+
+            total_loss = rec_weight * loss_rec + (1 - rec_weight) * loss_con
         total_loss.backward()
 
         net_optimizer.step()
 
         train_loss[-1] += total_loss.data
-        graph_train_loss.append(total_loss.item())
-        progbar.set_description('Train (loss=%.4f)' % (train_loss[-1] / (batch_idx + 1)))
+        metrics.add({'loss': total_loss}, batch_idx)
         progbar.update(1)
+        if checkpoints.preempted:
+            # SIGTERM: the caller checkpoints the first `epoch_batches` batches as trained and exits
+            break
+    metrics.close()
+    if checkpoints.preempted:
+        return None
     train_loss[-1] = train_loss[-1] / len(train_loader)
-    average_graph_train_loss = sum(graph_train_loss) / len(graph_train_loss)
-    return average_graph_train_loss
+    return train_loss[-1].item()
 
 
-def train_coach(epoch, net, coach, coach_optimizer):
-    progbar = tqdm(total=len(train_loader), desc='Coach')
+def train_coach(epoch, net, coach, coach_optimizer, skip_batches=0):
+    global epoch_batches
+    progbar = tqdm(total=len(train_loader), initial=skip_batches, desc='Coach')
     coach.train()
     net.eval()
-    coach_loss.append(0)
+    if skip_batches:
+        coach_loss[-1] = coach_loss[-1].to(device)
+    else:
+        coach_loss.append(0)
+    metrics = MetricsSink(every=args.log_every,
+                          on_reduce=lambda step, means: progbar.set_description('Coach (loss=%.4f)' % means['loss']))
     for batch_idx, (inputs_, masks, targets) in enumerate(train_loader):
+        if batch_idx < skip_batches:
+            continue
+        epoch_batches = batch_idx + 1
         coach_optimizer.zero_grad()
         inputs_, targets = Variable(inputs_.to(device)), Variable(targets.to(device))
 
-        masks, mu, logvar = coach.forward(inputs_, alpha=1)
+        with autocast(args.bf16, device):
+            masks, mu, logvar = coach.forward(inputs_, alpha=1)
 
-        loss_rec = None
-        outputs_1 = net.forward_inpainting(inputs_ * masks)
-        for output_1 in outputs_1:
-            mse_loss = (output_1 - targets) ** 2
-            mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
-            # calculate reconstruction loss
-            if loss_rec is None:
-                loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
-            else:
-                loss_rec += torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
+            loss_rec = None
+            outputs_1 = net.forward_inpainting(inputs_ * masks)
+            for output_1 in outputs_1:
+                mse_loss = thresholded_mse(output_1, targets)
+                # calculate reconstruction loss
+                if loss_rec is None:
+                    loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
+                else:
+                    loss_rec += torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
 
-        mu = mu.mean(dim=2).mean(dim=2)
-        logvar = logvar.mean(dim=2).mean(dim=2)
+            mu = mu.float().mean(dim=2).mean(dim=2)
+            logvar = logvar.float().mean(dim=2).mean(dim=2)
 
-        KLD = 0
-        try:
-            KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
-        except:
             KLD = 0
+            try:
+                KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+            except:
+                KLD = 0
 
-        total_loss = 1 - loss_rec + 1e-6 * KLD
+            total_loss = 1 - loss_rec + 1e-6 * KLD
 
         total_loss.backward()
         coach_optimizer.step()
 
         coach_loss[-1] += total_loss.data
-        progbar.set_description('Coach (loss=%.4f)' % (coach_loss[-1] / (batch_idx + 1)))
+        metrics.add({'loss': total_loss}, batch_idx)
         progbar.update(1)
+        if checkpoints.preempted:
+            # SIGTERM: the caller checkpoints the first `epoch_batches` batches as trained and exits
+            break
+    metrics.close()
+    if checkpoints.preempted:
+        return None
     coach_loss[-1] = coach_loss[-1] / len(train_loader)
 
 
@@ -369,8 +435,7 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
         loss_con = None
         outputs_1 = net.forward_inpainting(inputs_ * masks)
         for output_1 in outputs_1:
-            mse_loss = (output_1 - targets) ** 2
-            mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+            mse_loss = thresholded_mse(output_1, targets)
             # calculate reconstruction loss
             if loss_rec is None:
                 loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
@@ -383,8 +448,7 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
             else:
                 outputs_2 = net.forward_inpainting(inputs_ * (1 - masks))
                 for output_2 in outputs_2:
-                    mse_loss = (output_2 - targets) ** 2
-                    mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+                    mse_loss = thresholded_mse(output_2, targets)
                     if loss_con is None:
                         loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
                     else:
@@ -402,12 +466,54 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
         best_loss = val_loss[-1]
         print('Saving..')
         # state = {'context_inpainting_net': net.state_dict(), 'coach': coach.state_dict()}
-        torch.save(net.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.net.best.ckpt.t7'))
-        torch.save(coach.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.coach.best.ckpt.t7'))
+        checkpoints.save_file(net.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.net.best.ckpt.t7'))
+        checkpoints.save_file(coach.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.coach.best.ckpt.t7'))
     average_graph_test_loss = sum(graph_test_loss) / len(graph_test_loss)
     return average_graph_test_loss
 
 
+def schedule_step(iter_, phase, epoch):
+    # position in the coach/inpainting schedule, numbers the checkpoints
+    return 2 * sum(epochs[:iter_]) + (epochs[iter_] if phase == 'inpainting' else 0) + epoch
+
+
+def training_state(iter_, phase, epoch, batch_index=None, epoch_rng=None):
+    """
+    everything the schedule needs to go on at `epoch` of `phase` ('coach' or 'inpainting') of coach iteration `iter_`.
+    A mid-epoch state also holds the `batch_index` of the batches trained, whose loss is summed up in the last entry
+    of the losses, and the `epoch_rng` the epoch started with; the writer step of the epoch is counted again on resume.
+    """
+    mid_epoch = batch_index is not None
+    state = {
+        'iter': iter_,
+        'phase': phase,
+        'epoch': epoch,
+        'global_iteration': global_iteration - (1 if mid_epoch and phase == 'inpainting' else 0),
+        'best_loss': best_loss,
+        'net': net.state_dict(),
+        'coach': net_coach.state_dict() if net_coach is not None else None,
+        'net_optimizer': net_optimizer.state_dict() if net_optimizer is not None else None,
+        'coach_optimizer': optimizer_coach.state_dict() if optimizer_coach is not None else None,
+        'train_loss': train_loss,
+        'coach_loss': coach_loss,
+        'val_loss': val_loss,
+        'rng': rng_state(),
+    }
+    if mid_epoch:
+        state.update(batch_index=batch_index, epoch_rng=epoch_rng)
+    return state
+
+
+def start_epoch_rng():
+    """
+    :return: the random state the epoch starts with, that of the interrupted epoch when resuming a mid-epoch checkpoint
+    so the loader goes over the batches in the same order
+    """
+    if skip_batches:
+        set_rng_state(resume_epoch_rng)
+    return rng_state()
+
+
 use_coach_masks = False
 epochs = []
 lrs = []
@@ -431,22 +537,57 @@ else:
 
 progbar_1 = tqdm(total=len(epochs), desc='Iters')
 global_iteration = -1
-for iter_ in range(0, len(epochs)):
+optimizer_coach = None
+resume = None
+skip_batches, resume_epoch_rng = 0, None
+if args.resume and (args.resume != 'latest' or checkpoints.latest() is not None):
+    # --resume: go on with the coach/inpainting schedule where the checkpoint stopped, "latest" of a fresh run starts
+    # from scratch
+    resume = checkpoints.load(args.resume)
+    net.load_state_dict(resume['net'])
+    if net_coach is not None and resume['coach'] is not None:
+        net_coach.load_state_dict(resume['coach'])
+    global_iteration = resume['global_iteration']
+    train_loss, val_loss, coach_loss = resume['train_loss'], resume['val_loss'], resume['coach_loss']
+    progbar_1.update(resume['iter'])
+    set_rng_state(resume['rng'])
+    skip_batches, resume_epoch_rng = resume.get('batch_index', 0), resume.get('epoch_rng')
+for iter_ in range(0 if resume is None else resume['iter'], len(epochs)):
     best_loss = 1e5
+    first_coach_epoch, first_epoch = 0, 0
+    if resume is not None:
+        best_loss = resume['best_loss']
+        if resume['phase'] == 'coach':
+            first_coach_epoch = resume['epoch']
+        else:
+            first_coach_epoch, first_epoch = epochs[iter_], resume['epoch']
 
     if use_coach and iter_ >= 0:
         use_coach_masks = True
-        progbar_2 = tqdm(total=epochs[iter_], desc='Epochs')
+        progbar_2 = tqdm(total=epochs[iter_], initial=first_coach_epoch, desc='Epochs')
         optimizer_coach = optim.Adam(net_coach.parameters(), lr=1e-5)
-
-        for epoch in range(epochs[iter_]):
-            train_coach(epoch, net=net, coach=net_coach, coach_optimizer=optimizer_coach)
+        if resume is not None and resume['phase'] == 'coach' and resume['coach_optimizer'] is not None:
+            optimizer_coach.load_state_dict(resume['coach_optimizer'])
+
+        for epoch in range(first_coach_epoch, epochs[iter_]):
+            epoch_rng = start_epoch_rng()
+            train_coach(epoch, net=net, coach=net_coach, coach_optimizer=optimizer_coach,
+                        skip_batches=skip_batches)
+            checkpoints.exit_if_preempted(
+                lambda: training_state(iter_, 'coach', epoch, batch_index=epoch_batches, epoch_rng=epoch_rng),
+                schedule_step(iter_, 'coach', epoch))
+            skip_batches = 0
             progbar_2.update(1)
+            checkpoints.save(training_state(iter_, 'coach', epoch + 1), schedule_step(iter_, 'coach', epoch + 1))
 
     net_optimizer = optim.SGD(net.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4)
+    if resume is not None and resume['phase'] == 'inpainting' and resume['net_optimizer'] is not None:
+        # loaded before the lr steps below, which replace the optimizer at the same epochs as in the first run
+        net_optimizer.load_state_dict(resume['net_optimizer'])
+    resume = None
 
-    progbar_2 = tqdm(total=epochs[iter_], desc='Epochs')
-    for epoch in range(epochs[iter_]):
+    progbar_2 = tqdm(total=epochs[iter_], initial=first_epoch, desc='Epochs')
+    for epoch in range(first_epoch, epochs[iter_]):
         global_iteration += 1
         if epoch % 10 == 0:
             if use_coach:
@@ -454,17 +595,24 @@ for iter_ in range(0, len(epochs)):
             else:
                 visualize_self_sup(cols=4, net=net.eval(), coach=None, use_coach_masks=use_coach_masks)
 
-        if epoch == 90:
+        # the optimizer of a mid-epoch checkpoint was replaced at the start of its epoch already
+        if epoch == 90 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][3], momentum=0.9, weight_decay=5e-4)
-        if epoch == 80:
+        if epoch == 80 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][2], momentum=0.9, weight_decay=5e-4)
-        if epoch == 40:
+        if epoch == 40 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][1], momentum=0.9, weight_decay=5e-4)
-        if epoch == 0:
+        if epoch == 0 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][0], momentum=0.9, weight_decay=5e-4)
 
+        # after visualize_self_sup, which draws from the same random state
+        epoch_rng = start_epoch_rng()
         average_train_loss = train_context_inpainting(epoch, net=net, net_optimizer=net_optimizer, coach=net_coach,
-                                 use_coach_masks=use_coach_masks)
+                                 use_coach_masks=use_coach_masks, skip_batches=skip_batches)
+        checkpoints.exit_if_preempted(
+            lambda: training_state(iter_, 'inpainting', epoch, batch_index=epoch_batches, epoch_rng=epoch_rng),
+            schedule_step(iter_, 'inpainting', epoch))
+        skip_batches = 0
         average_test_loss = val_context_inpainting(iter_, epoch, net=net, coach=net_coach, use_coach_masks=use_coach_masks)
 
 
@@ -472,8 +620,10 @@ for iter_ in range(0, len(epochs)):
 
         train_writer.add_scalar('train/inpainting_loss', average_train_loss, global_iteration)
         test_writer.add_scalar('test/inpainting_loss', average_test_loss, global_iteration)
+        checkpoints.save(training_state(iter_, 'inpainting', epoch + 1), schedule_step(iter_, 'inpainting', epoch + 1))
         print("finished writing train and test graph loss")
     progbar_1.update(1)
+checkpoints.close()
 
 from utils.printing import training_curves_loss
 training_curves_loss(train_loss, val_loss)
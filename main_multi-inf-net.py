@@ -1,6 +1,7 @@
 ## import libraries
 import numpy as np
 import torch
+import sys
 import random
 from torch.autograd import Variable
 import matplotlib.pyplot as plt
@@ -8,7 +9,11 @@ from tqdm import tqdm
 import torch.optim as optim
 import torch.nn.functional as F
 from argparse import ArgumentParser
-from utils.dataloaders import context_inpainting_dataloader, multi_context_inpainting_data_loader, segmentation_data_loader
+from InfNet.Code.utils.loader_factory import make_loader, loader_benchmark
+from InfNet.Code.utils.amp import autocast, fp32_island
+from InfNet.Code.utils.metrics_logger import MetricsSink
+from InfNet.Code.utils.checkpoint import CheckpointManager, rng_state, set_rng_state
+from utils.dataloaders import context_inpainting_dataloader, InpaintingMaskCollate, multi_context_inpainting_data_loader, segmentation_data_loader
 from models import resnet18_encoderdecoder, resnet18_encoderdecoder_wbottleneck
 from models import resnet18_coach_vae
 
@@ -33,6 +38,20 @@ arg_parse.add_argument('--graph_path', default="./graph_logs", required=True, ty
 arg_parse.add_argument('--device', required=True, type=str)
 arg_parse.add_argument('--seed', default=7, type=int)
 arg_parse.add_argument('--batchsize', default=128, type=int)
+arg_parse.add_argument('--num_workers', default=-1, type=int,
+                       help='data loader workers, -1 measures and picks the fastest for this host')
+arg_parse.add_argument('--loader_benchmark', action='store_true',
+                       help='only measure the samples/s of the data loaders for every worker count and exit')
+arg_parse.add_argument('--log_every', default=20, type=int,
+                       help='batches between the loss updates of the progress bar, the losses are not synced per batch')
+arg_parse.add_argument('--resume', default=None, type=str,
+                       help='full checkpoint to go on from, "latest" picks the newest in save_path/checkpoints')
+arg_parse.add_argument('--keep_checkpoints', default=3, type=int, help='full checkpoints kept in save_path/checkpoints')
+arg_parse.add_argument('--bf16', action='store_true',
+                       help='bfloat16 autocast for the forward passes (CPU AVX-512/AMX nodes), the losses stay float32')
+arg_parse.add_argument('--train_stacked_root', default=None, type=str,
+                       help='image+prior .npy samples written by pack_image_prior.py, read instead of Imgs and Prior')
+arg_parse.add_argument('--val_stacked_root', default=None, type=str)
 args = arg_parse.parse_args()
 
 args = arg_parse.parse_args()
@@ -40,9 +59,12 @@ save_model_location = args.save_path
 graph_path = args.graph_path
 
 os.makedirs(save_model_location, exist_ok=True)
+# full training states of every epoch, written in the background and on SIGTERM
+checkpoints = CheckpointManager(os.path.join(save_model_location, 'checkpoints'), keep_last=args.keep_checkpoints)
 train_writer = SummaryWriter(os.path.join(graph_path, 'training'))
 test_writer = SummaryWriter(os.path.join(graph_path, 'testing'))
 device = args.device
+num_workers = 0 if args.loader_benchmark else args.num_workers
 
 ## fix seeds
 torch.cuda.manual_seed(args.seed)
@@ -149,17 +171,36 @@ erase_shape = [16, 16]         ### size of each block used to erase image
 erase_count = 16               ### number of blocks to erase from image
 rec_weight = 0.99            ### loss = rec_weight*loss_rec+ (1-rec_weight)*loss_con
 
-train_loader = torch.utils.data.DataLoader(
+train_loader = make_loader(
     multi_context_inpainting_data_loader(img_root = train_img_root, prior_root=train_prior_root, image_list = '', suffix=dataset,
                                   mirror = True, resize=True, crop=True, resize_shape=[352, 352], rotate = True,
-                                  erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=args.batchsize, shuffle = True)
+                                  erase_shape = erase_shape, erase_count = erase_count, batch_mask = True,
+                                  stacked_root = args.train_stacked_root),
+    batch_size=args.batchsize, shuffle = True,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=num_workers, device=device)
 
-val_loader = torch.utils.data.DataLoader(
+val_loader = make_loader(
     multi_context_inpainting_data_loader(img_root = val_img_root, prior_root=val_prior_root, image_list = '', suffix=dataset,
                                   mirror = False, resize=False, resize_shape=[352, 352], rotate = False,
-                                  crop = True, erase_shape = erase_shape, erase_count = erase_count),
-    batch_size=12, shuffle = False)
+                                  crop = True, erase_shape = erase_shape, erase_count = erase_count, batch_mask = True,
+                                  stacked_root = args.val_stacked_root),
+    batch_size=12, shuffle = False,
+    collate_fn=InpaintingMaskCollate(erase_shape, erase_count),
+    num_workers=num_workers, device=device)
+
+if args.loader_benchmark:
+    # loader-only mode: samples/s of the self-supervised datasets for every worker count, nothing is trained
+    loader_benchmark({'train': train_loader.dataset, 'val': val_loader.dataset}, args.batchsize, shuffle=True,
+                     collate_fn=train_loader.collate_fn, device=device)
+    sys.exit()
+
+
+@fp32_island
+def thresholded_mse(output, target):
+    # squared error clipped at 2, always in float32
+    mse_loss = (output - target) ** 2
+    return -1 * F.threshold(-1 * mse_loss, -2, -2)
 
 
 def torch_to_np(input_, mask, target, output=None):
@@ -240,126 +281,149 @@ best_loss = 1e5
 train_loss = []
 val_loss = []
 coach_loss = []
+# batches of the current epoch trained so far, saved by a mid-epoch checkpoint
+epoch_batches = 0
 
 
-def train_context_inpainting(epoch, net, net_optimizer, coach=None, use_coach_masks=False):
-    progbar = tqdm(total=len(train_loader), desc='Train')
+def train_context_inpainting(epoch, net, net_optimizer, coach=None, use_coach_masks=False, skip_batches=0):
+    global epoch_batches
+    progbar = tqdm(total=len(train_loader), initial=skip_batches, desc='Train')
     net.train()
 
-    graph_train_loss = []
+    # the mean loss of the last batches is shown by the thread of the sink
+    metrics = MetricsSink(every=args.log_every,
+                          on_reduce=lambda step, means: progbar.set_description('Train (loss=%.4f)' % means['loss']))
 
     if coach is not None:
         coach.eval()
 
-    train_loss.append(0)
+    if skip_batches:
+        # resumed from a mid-epoch checkpoint, the loss of its batches is summed up already
+        train_loss[-1] = train_loss[-1].to(device)
+    else:
+        train_loss.append(0)
     for batch_idx, (inputs_, masks, targets, prior) in enumerate(train_loader):
+        if batch_idx < skip_batches:
+            continue
+        epoch_batches = batch_idx + 1
         net_optimizer.zero_grad()
         inputs_, masks, targets = Variable(inputs_.to(device)), Variable(masks.to(device).float()), Variable(targets.to(device))
         prior = Variable(prior.to(device))
 
-        if coach is not None:
-            masks, _, _ = coach.forward(inputs_, alpha=100, use_coach=use_coach_masks)
+        with autocast(args.bf16, device):
+            if coach is not None:
+                masks, _, _ = coach.forward(inputs_, alpha=100, use_coach=use_coach_masks)
 
-        masked_inputs_ = inputs_ * masks
-        masked_prior = prior * masks
-        outputs = net.forward_inpainting(torch.cat((masked_inputs_, masked_prior), dim=1))
-        g_outputs, g_priors = torch.split(outputs, 3, dim=1)
+            masked_inputs_ = inputs_ * masks
+            masked_prior = prior * masks
+            outputs = net.forward_inpainting(torch.cat((masked_inputs_, masked_prior), dim=1))
+            g_outputs, g_priors = torch.split(outputs, 3, dim=1)
 
-        mse_loss = (g_outputs - targets) ** 2
-        mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+            mse_loss = thresholded_mse(g_outputs, targets)
 
-        prior_mse_loss = (g_priors - prior) ** 2
-        prior_mse_loss = -1 * F.threshold(-1 * prior_mse_loss, -2, -2)
+            prior_mse_loss = thresholded_mse(g_priors, prior)
 
-        loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
-        prior_loss_rec = torch.sum(prior_mse_loss * (1 - masks)) / torch.sum(1 - masks)
+            loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
+            prior_loss_rec = torch.sum(prior_mse_loss * (1 - masks)) / torch.sum(1 - masks)
 
-        # calculate con loss
-        if coach is not None:
-            loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
-            prior_loss_con = torch.sum(prior_mse_loss * masks) / torch.sum(masks)
+            # calculate con loss
+            if coach is not None:
+                loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
+                prior_loss_con = torch.sum(prior_mse_loss * masks) / torch.sum(masks)
 
-        else:
-            outputs = net.forward_inpainting(inputs_ * (1 - masks))
-            g_outputs, g_priors = torch.split(outputs, 3, dim=1)
+            else:
+                outputs = net.forward_inpainting(inputs_ * (1 - masks))
+                g_outputs, g_priors = torch.split(outputs, 3, dim=1)
 
-            mse_loss = (g_outputs - targets) ** 2
-            mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+                mse_loss = thresholded_mse(g_outputs, targets)
 
-            prior_mse_loss = (g_priors - prior) ** 2
-            prior_mse_loss = -1 * F.threshold(-1 * prior_mse_loss, -2, -2)
-            loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
-            prior_loss_con = torch.sum(prior_mse_loss * masks) / torch.sum(masks)
+                prior_mse_loss = thresholded_mse(g_priors, prior)
+                loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
+                prior_loss_con = torch.sum(prior_mse_loss * masks) / torch.sum(masks)
 
-        loss_rec = loss_rec + prior_loss_rec
-        loss_con = loss_con + prior_loss_con
+            loss_rec = loss_rec + prior_loss_rec
+            loss_con = loss_con + prior_loss_con
 
-        total_loss = rec_weight * loss_rec + (1 - rec_weight) * loss_con
+            total_loss = rec_weight * loss_rec + (1 - rec_weight) * loss_con
         total_loss.backward()
 
         net_optimizer.step()
 
         train_loss[-1] += total_loss.data
-        graph_train_loss.append(total_loss.item())
-        progbar.set_description('Train (loss=%.4f)' % (train_loss[-1] / (batch_idx + 1)))
+        metrics.add({'loss': total_loss}, batch_idx)
         progbar.update(1)
+        if checkpoints.preempted:
+            # SIGTERM: the caller checkpoints the first `epoch_batches` batches as trained and exits
+            break
+    metrics.close()
+    if checkpoints.preempted:
+        return None
     train_loss[-1] = train_loss[-1] / len(train_loader)
+    return train_loss[-1].item()
 
-    average_graph_train_loss = sum(graph_train_loss) / len(graph_train_loss)
-    return average_graph_train_loss
 
-
-def train_coach(epoch, net, coach, coach_optimizer):
-    progbar = tqdm(total=len(train_loader), desc='Coach')
+def train_coach(epoch, net, coach, coach_optimizer, skip_batches=0):
+    global epoch_batches
+    progbar = tqdm(total=len(train_loader), initial=skip_batches, desc='Coach')
     coach.train()
     net.eval()
-    coach_loss.append(0)
+    if skip_batches:
+        coach_loss[-1] = coach_loss[-1].to(device)
+    else:
+        coach_loss.append(0)
+    metrics = MetricsSink(every=args.log_every,
+                          on_reduce=lambda step, means: progbar.set_description('Coach (loss=%.4f)' % means['loss']))
 
-    graph_coach_loss = []
     for batch_idx, (inputs_, masks, targets, prior) in enumerate(train_loader):
+        if batch_idx < skip_batches:
+            continue
+        epoch_batches = batch_idx + 1
         coach_optimizer.zero_grad()
         inputs_, targets = Variable(inputs_.to(device)), Variable(targets.to(device))
         prior = Variable(prior.to(device))
 
-        masks, mu, logvar = coach.forward(inputs_, alpha=1)
+        with autocast(args.bf16, device):
+            masks, mu, logvar = coach.forward(inputs_, alpha=1)
 
-        masked_inputs_ = inputs_ * masks
-        masked_prior = prior * masks
-        outputs = net.forward_inpainting(torch.cat((masked_inputs_, masked_prior), dim=1)).detach()
-        g_outputs, g_priors = torch.split(outputs, 3, dim=1)
+            masked_inputs_ = inputs_ * masks
+            masked_prior = prior * masks
+            outputs = net.forward_inpainting(torch.cat((masked_inputs_, masked_prior), dim=1)).detach()
+            g_outputs, g_priors = torch.split(outputs, 3, dim=1)
 
-        mse_loss = (g_outputs - targets) ** 2
-        mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
-        loss_rec = torch.sum(mse_loss * (1 - masks)) / (3 * torch.sum(1 - masks))
+            mse_loss = thresholded_mse(g_outputs, targets)
+            loss_rec = torch.sum(mse_loss * (1 - masks)) / (3 * torch.sum(1 - masks))
 
-        prior_mse_loss = (g_priors - prior) ** 2
-        prior_mse_loss = -1 * F.threshold(-1 * prior_mse_loss, -2, -2)
-        prior_loss_rec = torch.sum(prior_mse_loss * (1 - masks)) / (3 * torch.sum(1 - masks))
+            prior_mse_loss = thresholded_mse(g_priors, prior)
+            prior_loss_rec = torch.sum(prior_mse_loss * (1 - masks)) / (3 * torch.sum(1 - masks))
 
-        total_loss_rec = loss_rec + prior_loss_rec
+            total_loss_rec = loss_rec + prior_loss_rec
 
-        mu = mu.mean(dim=2).mean(dim=2)
-        logvar = logvar.mean(dim=2).mean(dim=2)
+            mu = mu.float().mean(dim=2).mean(dim=2)
+            logvar = logvar.float().mean(dim=2).mean(dim=2)
 
-        KLD = 0
-        try:
-            KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
-        except:
             KLD = 0
+            try:
+                KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+            except:
+                KLD = 0
 
-        total_loss = 1 - total_loss_rec + 1e-6 * KLD
+            total_loss = 1 - total_loss_rec + 1e-6 * KLD
 
         total_loss.backward()
         coach_optimizer.step()
 
         coach_loss[-1] += total_loss.data
-        graph_coach_loss.append(total_loss.item())
-        progbar.set_description('Coach (loss=%.4f)' % (coach_loss[-1] / (batch_idx + 1)))
+        metrics.add({'loss': total_loss}, batch_idx)
         progbar.update(1)
+        if checkpoints.preempted:
+            # SIGTERM: the caller checkpoints the first `epoch_batches` batches as trained and exits
+            break
+    metrics.close()
+    if checkpoints.preempted:
+        return None
 
     coach_loss[-1] = coach_loss[-1] / len(train_loader)
-    average_graph_coach_loss = sum(graph_coach_loss) / len(graph_coach_loss)
-    return average_graph_coach_loss
+    return coach_loss[-1].item()
 
 
 def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False):
@@ -385,11 +449,9 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
         outputs = net.forward_inpainting(torch.cat((masked_inputs, masked_prior), dim=1))
         g_outputs, g_priors = torch.split(outputs, 3, dim=1)
 
-        mse_loss = (g_outputs - targets) ** 2
-        mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+        mse_loss = thresholded_mse(g_outputs, targets)
 
-        prior_mse_loss = (g_priors - prior) ** 2
-        prior_mse_loss = -1 * F.threshold(-1 * prior_mse_loss, -2, -2)
+        prior_mse_loss = thresholded_mse(g_priors, prior)
 
         loss_rec = torch.sum(mse_loss * (1 - masks)) / torch.sum(1 - masks)
         prior_loss_rec = torch.sum(prior_mse_loss * (1 - masks)) / torch.sum(1 - masks)
@@ -403,11 +465,9 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
             outputs = net.forward_inpainting(inputs_ * (1 - masks))
             g_outputs, g_priors = torch.split(outputs, 3, dim=1)
 
-            mse_loss = (g_outputs - targets) ** 2
-            mse_loss = -1 * F.threshold(-1 * mse_loss, -2, -2)
+            mse_loss = thresholded_mse(g_outputs, targets)
 
-            prior_mse_loss = (g_priors - prior) ** 2
-            prior_mse_loss = -1 * F.threshold(-1 * prior_mse_loss, -2, -2)
+            prior_mse_loss = thresholded_mse(g_priors, prior)
             loss_con = torch.sum(mse_loss * masks) / torch.sum(masks)
             prior_loss_con = torch.sum(prior_mse_loss * masks) / torch.sum(masks)
 
@@ -426,13 +486,54 @@ def val_context_inpainting(iter_, epoch, net, coach=None, use_coach_masks=False)
     if best_loss > val_loss[-1]:
         best_loss = val_loss[-1]
         print('Saving..')
-        torch.save(net.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.net.best.ckpt.t7'))
-        torch.save(coach.state_dict(),
-                   os.path.join(save_model_location, experiment + str(iter_) + '.coach.best.ckpt.t7'))
+        checkpoints.save_file(net.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.net.best.ckpt.t7'))
+        checkpoints.save_file(coach.state_dict(), os.path.join(save_model_location, experiment + str(iter_) + '.coach.best.ckpt.t7'))
 
     average_graph_test_loss = sum(graph_test_loss) / len(graph_test_loss)
     return average_graph_test_loss
 
+def schedule_step(iter_, phase, epoch):
+    # position in the coach/inpainting schedule, numbers the checkpoints
+    return 2 * sum(epochs[:iter_]) + (epochs[iter_] if phase == 'inpainting' else 0) + epoch
+
+
+def training_state(iter_, phase, epoch, batch_index=None, epoch_rng=None):
+    """
+    everything the schedule needs to go on at `epoch` of `phase` ('coach' or 'inpainting') of coach iteration `iter_`.
+    A mid-epoch state also holds the `batch_index` of the batches trained, whose loss is summed up in the last entry
+    of the losses, and the `epoch_rng` the epoch started with; the writer step of the epoch is counted again on resume.
+    """
+    mid_epoch = batch_index is not None
+    state = {
+        'iter': iter_,
+        'phase': phase,
+        'epoch': epoch,
+        'global_iteration': global_iteration - (1 if mid_epoch and phase == 'inpainting' else 0),
+        'best_loss': best_loss,
+        'net': net.state_dict(),
+        'coach': net_coach.state_dict() if net_coach is not None else None,
+        'net_optimizer': net_optimizer.state_dict() if net_optimizer is not None else None,
+        'coach_optimizer': optimizer_coach.state_dict() if optimizer_coach is not None else None,
+        'train_loss': train_loss,
+        'coach_loss': coach_loss,
+        'val_loss': val_loss,
+        'rng': rng_state(),
+    }
+    if mid_epoch:
+        state.update(batch_index=batch_index, epoch_rng=epoch_rng)
+    return state
+
+
+def start_epoch_rng():
+    """
+    :return: the random state the epoch starts with, that of the interrupted epoch when resuming a mid-epoch checkpoint
+    so the loader goes over the batches in the same order
+    """
+    if skip_batches:
+        set_rng_state(resume_epoch_rng)
+    return rng_state()
+
+
 use_coach_masks = False
 epochs = []
 lrs = []
@@ -456,24 +557,59 @@ else:
 
 progbar_1 = tqdm(total=len(epochs), desc='Iters')
 global_iteration = -1
-
-for iter_ in range(0, len(epochs)):
+optimizer_coach = None
+resume = None
+skip_batches, resume_epoch_rng = 0, None
+if args.resume and (args.resume != 'latest' or checkpoints.latest() is not None):
+    # --resume: go on with the coach/inpainting schedule where the checkpoint stopped, "latest" of a fresh run starts
+    # from scratch
+    resume = checkpoints.load(args.resume)
+    net.load_state_dict(resume['net'])
+    if net_coach is not None and resume['coach'] is not None:
+        net_coach.load_state_dict(resume['coach'])
+    global_iteration = resume['global_iteration']
+    train_loss, val_loss, coach_loss = resume['train_loss'], resume['val_loss'], resume['coach_loss']
+    progbar_1.update(resume['iter'])
+    set_rng_state(resume['rng'])
+    skip_batches, resume_epoch_rng = resume.get('batch_index', 0), resume.get('epoch_rng')
+
+for iter_ in range(0 if resume is None else resume['iter'], len(epochs)):
     best_loss = 1e5
+    first_coach_epoch, first_epoch = 0, 0
+    if resume is not None:
+        best_loss = resume['best_loss']
+        if resume['phase'] == 'coach':
+            first_coach_epoch = resume['epoch']
+        else:
+            first_coach_epoch, first_epoch = epochs[iter_], resume['epoch']
 
     if use_coach and iter_ > 0:
         use_coach_masks = True
-        progbar_2 = tqdm(total=epochs[iter_], desc='Epochs')
+        progbar_2 = tqdm(total=epochs[iter_], initial=first_coach_epoch, desc='Epochs')
         optimizer_coach = optim.Adam(net_coach.parameters(), lr=1e-5)
-
-        for epoch in range(epochs[iter_]):
-            average_coach_loss = train_coach(epoch, net=net, coach=net_coach, coach_optimizer=optimizer_coach)
+        if resume is not None and resume['phase'] == 'coach' and resume['coach_optimizer'] is not None:
+            optimizer_coach.load_state_dict(resume['coach_optimizer'])
+
+        for epoch in range(first_coach_epoch, epochs[iter_]):
+            epoch_rng = start_epoch_rng()
+            average_coach_loss = train_coach(epoch, net=net, coach=net_coach, coach_optimizer=optimizer_coach,
+                                             skip_batches=skip_batches)
+            checkpoints.exit_if_preempted(
+                lambda: training_state(iter_, 'coach', epoch, batch_index=epoch_batches, epoch_rng=epoch_rng),
+                schedule_step(iter_, 'coach', epoch))
+            skip_batches = 0
             train_writer.add_scalar('train/coach_loss', average_coach_loss, iter_ * epochs[iter_] + epoch)
             progbar_2.update(1)
+            checkpoints.save(training_state(iter_, 'coach', epoch + 1), schedule_step(iter_, 'coach', epoch + 1))
 
     net_optimizer = optim.SGD(net.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4)
+    if resume is not None and resume['phase'] == 'inpainting' and resume['net_optimizer'] is not None:
+        # loaded before the lr steps below, which replace the optimizer at the same epochs as in the first run
+        net_optimizer.load_state_dict(resume['net_optimizer'])
+    resume = None
 
-    progbar_2 = tqdm(total=epochs[iter_], desc='Epochs')
-    for epoch in range(epochs[iter_]):
+    progbar_2 = tqdm(total=epochs[iter_], initial=first_epoch, desc='Epochs')
+    for epoch in range(first_epoch, epochs[iter_]):
         global_iteration += 1
         if epoch % 10 == 0:
             if use_coach:
@@ -481,24 +617,33 @@ for iter_ in range(0, len(epochs)):
             else:
                 visualize_self_sup(cols=4, net=net.eval(), coach=None, use_coach_masks=use_coach_masks)
 
-        if epoch == 90:
+        # the optimizer of a mid-epoch checkpoint was replaced at the start of its epoch already
+        if epoch == 90 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][3], momentum=0.9, weight_decay=5e-4)
-        if epoch == 80:
+        if epoch == 80 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][2], momentum=0.9, weight_decay=5e-4)
-        if epoch == 40:
+        if epoch == 40 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][1], momentum=0.9, weight_decay=5e-4)
-        if epoch == 0:
+        if epoch == 0 and not skip_batches:
             net_optimizer = optim.SGD(net.parameters(), lr=lrs[iter_][0], momentum=0.9, weight_decay=5e-4)
 
+        # after visualize_self_sup, which draws from the same random state
+        epoch_rng = start_epoch_rng()
         average_train_loss = train_context_inpainting(epoch, net=net, net_optimizer=net_optimizer, coach=net_coach,
-                                 use_coach_masks=use_coach_masks)
+                                 use_coach_masks=use_coach_masks, skip_batches=skip_batches)
+        checkpoints.exit_if_preempted(
+            lambda: training_state(iter_, 'inpainting', epoch, batch_index=epoch_batches, epoch_rng=epoch_rng),
+            schedule_step(iter_, 'inpainting', epoch))
+        skip_batches = 0
         average_test_loss = val_context_inpainting(iter_, epoch, net=net, coach=net_coach, use_coach_masks=use_coach_masks)
 
         progbar_2.update(1)
 
         train_writer.add_scalar('train/inpainting_loss', average_train_loss, global_iteration)
         test_writer.add_scalar('test/inpainting_loss', average_test_loss, global_iteration)
+        checkpoints.save(training_state(iter_, 'inpainting', epoch + 1), schedule_step(iter_, 'inpainting', epoch + 1))
     progbar_1.update(1)
+checkpoints.close()
 
 from utils.printing import training_curves_loss
 training_curves_loss(train_loss, val_loss)
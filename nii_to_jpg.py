@@ -1,34 +1,87 @@
 import nibabel as nib
 import os
 import cv2
+import numpy as np
 from argparse import ArgumentParser
 
+from InfNet.Code.utils.slice_store import write_slice_store, hu_window
+
+
+def iter_nii_slices(nii_file, chunk_size=16):
+    """
+    Usage:
+        stream the axial slices of a volume from its `dataobj` instead of `get_fdata()`, so only `chunk_size`
+        slices are decoded at a time and the volume is never materialized as float64
+    :param nii_file:
+    :param chunk_size:
+    :return: generator of (slice index, 2d slice)
+    """
+    img = nib.load(nii_file)
+    num_images = img.shape[2]
+    for start in range(0, num_images, chunk_size):
+        chunk = np.asanyarray(img.dataobj[:, :, start:start + chunk_size])
+        for i in range(chunk.shape[2]):
+            yield start + i, chunk[:, :, i]
+
+
+def nii_shape(nii_file):
+    return nib.load(nii_file).shape
+
+
+def binarize(current_img):
+    # mask out all number of different classes to 0 or 1
+    current_img = current_img.copy()
+    current_img[current_img > 1] = 1
+    return current_img
+
+
+def save_slices(nii_file, output_folder, prefix, save_type, is_binary=False, chunk_size=16):
+    os.makedirs(output_folder, exist_ok=True)
+    for i, current_img in iter_nii_slices(nii_file, chunk_size):
+        current_img = current_img.astype(np.float64)
+        if is_binary:
+            current_img = binarize(current_img)
+        output_filename = os.path.join(output_folder, f'{prefix}_{i}.{save_type}')
+        cv2.imwrite(output_filename, current_img)
+
+
+def save_slice_store(nii_file, output_folder, prefix, is_binary=False, window=None, dtype=np.uint8, chunk_size=16):
+    """
+    Usage:
+        write the whole volume as one memory-mapped `{prefix}.npy` slice store with a `{prefix}.json` slice index
+        (slice names are `{prefix}_{i}`, the same names the jpg/png mode uses)
+    """
+    shape = nii_shape(nii_file)
+    num_images = shape[2]
+    slices = (binarize(current_img) if is_binary else current_img
+              for _, current_img in iter_nii_slices(nii_file, chunk_size))
+    names = [f'{prefix}_{i}' for i in range(num_images)]
+    return write_slice_store(os.path.join(output_folder, prefix), slices, num_images, shape[:2], names,
+                             dtype=dtype, window=window, chunk_size=chunk_size)
+
 
 if __name__ == '__main__':
     arg_parse = ArgumentParser()
     arg_parse.add_argument('--nii_file', type=str, required=True)
     arg_parse.add_argument('--output_folder', type=str, required=True)
     arg_parse.add_argument('--filename_prefix', type=str, required=True)
-    arg_parse.add_argument('--save_type', type=str, required=True, help='jpg or png')
+    arg_parse.add_argument('--save_type', type=str, required=True, help='jpg, png or store (memory-mapped slice store)')
     arg_parse.add_argument('--is_binary', type=bool, default=False)  # mask out all number of different classes to 0 or 1
                                                                      # this is for the prior mask, that masks everything
                                                                      # else that has a class
+    arg_parse.add_argument('--window_center', type=float, default=None, help='HU window center (store only)')
+    arg_parse.add_argument('--window_width', type=float, default=None, help='HU window width (store only)')
+    arg_parse.add_argument('--store_dtype', type=str, default='uint8', help='uint8 or uint16 (store only)')
+    arg_parse.add_argument('--chunk_size', type=int, default=16, help='number of slices decoded at a time')
 
     arg = arg_parse.parse_args()
 
-    img = nib.load(arg.nii_file)
-    data = img.get_fdata()
-
-    # make output folder if not exist yet
-    os.makedirs(arg.output_folder, exist_ok=True)
-
-    prefix = arg.filename_prefix
-    num_images = data.shape[2]
-    for i in range(num_images):
-        current_img = data[:, :, i]
-
-        if arg.is_binary:
-            current_img[current_img > 1] = 1
-        output_filename = os.path.join(arg.output_folder, f'{prefix}_{i}.{arg.save_type}')
-        cv2.imwrite(output_filename, current_img)
-
+    if arg.save_type == 'store':
+        window = None
+        if arg.window_center is not None and arg.window_width is not None:
+            window = hu_window(arg.window_center, arg.window_width)
+        save_slice_store(arg.nii_file, arg.output_folder, arg.filename_prefix, arg.is_binary, window,
+                         np.dtype(arg.store_dtype), arg.chunk_size)
+    else:
+        save_slices(arg.nii_file, arg.output_folder, arg.filename_prefix, arg.save_type, arg.is_binary,
+                    arg.chunk_size)
@@ -0,0 +1,36 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.dataloaders import pair_by_stem, read_image, stack_image_prior
+
+
+def pack_pair(job):
+    stem, image_path, prior_path, output_root = job
+    stacked = stack_image_prior(read_image(image_path), read_image(prior_path))
+    np.save(os.path.join(output_root, f'{stem}.npy'), stacked)
+
+
+if __name__ == '__main__':
+    """
+    Usage:
+        python pack_image_prior.py --img_root InfNet/Dataset/TrainingSet/MultiClassInfection-Train/Imgs
+                                   --prior_root InfNet/Dataset/TrainingSet/MultiClassInfection-Train/Prior
+                                   --output_root InfNet/Dataset/TrainingSet/MultiClassInfection-Train/Stacked
+    writes one H x W x 6 uint8 `.npy` (BGR image + BGR prior) per sample, read by
+    `multi_context_inpainting_data_loader(..., stacked_root=...)` with a single load
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_root', type=str, required=True)
+    parser.add_argument('--prior_root', type=str, required=True)
+    parser.add_argument('--output_root', type=str, required=True)
+    parser.add_argument('--num_workers', type=int, default=None, help='number of processes, default all cores')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_root, exist_ok=True)
+    jobs = [pair + (args.output_root,) for pair in pair_by_stem(args.img_root, args.prior_root)]
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        list(executor.map(pack_pair, jobs, chunksize=16))
+    print(f'packed {len(jobs)} samples to {args.output_root}')
@@ -2,8 +2,16 @@ import os
 import argparse
 from shutil import copyfile
 
+from InfNet.Code.utils.manifest import write_manifest, MANIFEST_NAME
 
-def process_images(input_folder, output_folder):
+
+def process_images(input_folder, output_folder, mode='manifest'):
+    """
+    Usage:
+        flatten the ICTCF patient folders into `Patient_X_N.jpg` samples. With mode='manifest' only
+        `output_folder/manifest.csv` (name -> source path) is written, mode='copy' copies every slice.
+    """
+    rows = []
     all_patients_folder = os.listdir(input_folder)
     for patient_folder in all_patients_folder:
         if 'Patient' not in patient_folder:
@@ -13,16 +21,24 @@ def process_images(input_folder, output_folder):
         patient_images = os.listdir(patient_dir)
         for patient_image in patient_images:
             patient_image_filename = os.path.join(patient_dir, patient_image)
+            output_name = f'{patient_folder}_{patient_image}'
+
+            if mode == 'copy':
+                copyfile(patient_image_filename, os.path.join(output_folder, output_name))
+            else:
+                rows.append({'name': output_name, 'path': os.path.relpath(patient_image_filename, output_folder)})
 
-            output_image_filename = os.path.join(output_folder, f'{patient_folder}_{patient_image}')
-            copyfile(patient_image_filename, output_image_filename)
+    if mode != 'copy':
+        write_manifest(os.path.join(output_folder, MANIFEST_NAME), rows, ['name', 'path'])
 
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--input_folder', type=str, required=True)
     arg_parser.add_argument('--output_folder', type=str, required=True)
+    arg_parser.add_argument('--mode', type=str, default='manifest',
+                            help='manifest (default, no copies) or copy')
     args = arg_parser.parse_args()
 
     os.makedirs(args.output_folder, exist_ok=True)
-    process_images(args.input_folder, args.output_folder)
+    process_images(args.input_folder, args.output_folder, args.mode)
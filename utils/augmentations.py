@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+
+def random_dihedral(mirror=True, rotate=True):
+    """
+    draw one of the 8 dihedral transforms with the torch rng, in the order the loaders always drew them:
+    first the mirror flip, then the rotation by k * 90 degrees
+    :return: (k, flip)
+    """
+    flip = bool(torch.LongTensor(1).random_(0, 2)[0]) if mirror else False
+    k = int(torch.LongTensor(1).random_(0, 4)[0]) if rotate else 0
+    return k, flip
+
+
+def dihedral_view(array, k=0, flip=False):
+    """
+    H x W (x C) array mirrored left-right and rotated counter-clockwise by k * 90 degrees (the direction of
+    cv2.getRotationMatrix2D). Both are strided views, no pixel is copied or interpolated.
+    """
+    if flip:
+        array = array[:, ::-1]
+    return np.rot90(array, k, axes=(0, 1))
+
+
+def random_dihedral_views(*arrays, mirror=True, rotate=True):
+    """
+    Usage:
+        image, seg_gt = random_dihedral_views(image, seg_gt, mirror=self.mirror, rotate=self.rotate)
+    the same random dihedral transform applied to all arrays, as views
+    """
+    k, flip = random_dihedral(mirror, rotate)
+    return [dihedral_view(array, k, flip) for array in arrays]
+
+
+def to_chw_tensor(image, mean=None):
+    """
+    H x W x C image (any strides) -> float32 C x H x W tensor, optionally mean subtracted. This is the only copy of
+    the pixels after the views above.
+    """
+    image = np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.float32)
+    if mean is not None:
+        image -= np.asarray(mean, np.float32)[:, None, None]
+    return torch.from_numpy(image)
+
+
+def to_label_tensor(label):
+    # H x W label map (any strides) -> int64 tensor in one copy
+    return torch.from_numpy(np.ascontiguousarray(label, dtype=np.int64))
@@ -0,0 +1,67 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from augmentations import random_dihedral_views, to_chw_tensor, to_label_tensor
+
+
+MEAN_BGR = np.array([85.5517787014, 92.6691667083, 86.8147645556])
+
+
+def legacy_path(image, seg_gt):
+    # mirror + rotation + transform as segmentation_data_loader did it before utils/augmentations.py
+    flip = torch.LongTensor(1).random_(0, 2)[0]*2-1
+    image = image[:, ::flip, :]
+    seg_gt = seg_gt[:, ::flip]
+
+    choice = torch.LongTensor(1).random_(0, 4)[0]
+    angle = [0, 90, 180, 270][choice]
+    center = tuple(np.array(image.shape)[:2]/2)
+    rot_mat = cv2.getRotationMatrix2D(center, angle, 1)
+    image = cv2.warpAffine(image, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
+    seg_gt = cv2.warpAffine(seg_gt, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
+
+    image = image.astype(np.float64)
+    image -= MEAN_BGR
+    image = image.transpose(2, 0, 1)
+    image = torch.from_numpy(image.copy()).float()
+    seg_gt = torch.from_numpy(seg_gt.copy()).long()
+    return image, seg_gt
+
+
+def view_path(image, seg_gt):
+    image, seg_gt = random_dihedral_views(image, seg_gt)
+    return to_chw_tensor(image, MEAN_BGR), to_label_tensor(seg_gt)
+
+
+def time_per_sample(fn, images, labels, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for image, seg_gt in zip(images, labels):
+            fn(image, seg_gt)
+    return (time.perf_counter() - start) / (repeats * len(images))
+
+
+# per-sample time of mirror + rotation + tensor conversion, warpAffine path vs dihedral views:
+#   python utils/benchmark_augmentations.py --size 256 --samples 64 --repeats 10
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='side of the square test images')
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8) for _ in range(args.samples)]
+    labels = [rng.integers(0, 7, (args.size, args.size), dtype=np.uint8) for _ in range(args.samples)]
+
+    torch.set_num_threads(1)
+    cv2.setNumThreads(0)
+    legacy = time_per_sample(legacy_path, images, labels, args.repeats)
+    views = time_per_sample(view_path, images, labels, args.repeats)
+    print(f'{args.size}x{args.size}, {args.samples} samples x {args.repeats}')
+    print(f'warpAffine + copies: {legacy * 1e3:.3f} ms/sample')
+    print(f'dihedral views:      {views * 1e3:.3f} ms/sample ({legacy / views:.1f}x)')
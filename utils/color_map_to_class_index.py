@@ -1,134 +1,124 @@
 import cv2
 import sys
 import os.path
+import argparse
 import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
-def apply_potsdam_colormap(image):
-	# Potsdam colormap
-	# Impervious surfaces (RGB: 255, 255, 255)
-	# Building (RGB: 0, 0, 255)
-	# Low vegetation (RGB: 0, 255, 255)
-	# Tree (RGB: 0, 255, 0)
-	# Car (RGB: 255, 255, 0)
-	# Clutter/background (RGB: 255, 0, 0)
-
-	img = np.zeros((image.shape[0], image.shape[1], 3), dtype = np.uint8)
-
-	indices = np.where(image == 0)
-	img[indices] = (255, 255, 255)
-
-	indices = np.where(image == 1)
-	img[indices] = (0, 0, 255)
+# class index -> RGB, the position in the palette is the class index
+# Potsdam colormap
+# Impervious surfaces (RGB: 255, 255, 255)
+# Building (RGB: 0, 0, 255)
+# Low vegetation (RGB: 0, 255, 255)
+# Tree (RGB: 0, 255, 0)
+# Car (RGB: 255, 255, 0)
+# Clutter/background (RGB: 255, 0, 0)
+POTSDAM_PALETTE = np.array([(255, 255, 255), (0, 0, 255), (0, 255, 255), (0, 255, 0), (255, 255, 0), (255, 0, 0)],
+						   dtype=np.uint8)
 
-	indices = np.where(image == 2)
-	img[indices] = (0, 255, 255)
+# DG lands colormap
+# Urban land: 0,255,255
+# Agriculture land: 255,255,0
+# Rangeland: 255,0,255
+# Forest land: 0,255,0
+# Water: 0,0,255
+# Barren land: 255,255,255
+# Unknown: 0,0,0
+DGLANDS_PALETTE = np.array([(0, 255, 255), (255, 255, 0), (255, 0, 255), (0, 255, 0), (0, 0, 255), (255, 255, 255),
+							(0, 0, 0)], dtype=np.uint8)
 
-	indices = np.where(image == 3)
-	img[indices] = (0, 255, 0)
+PALETTES = {'potsdam': POTSDAM_PALETTE, 'deepglobe_lands': DGLANDS_PALETTE}
 
-	indices = np.where(image == 4)
-	img[indices] = (255, 255, 0)
+# pixels whose color is not in the palette
+IGNORE_INDEX = 7
 
-	indices = np.where(image == 5)
-	img[indices] = (255, 0, 0)
-
-	return img
-
-def apply_DGlands_colormap(image):
-	# DG lands colormap
-	# Urban land: 0,255,255 
-	# Agriculture land: 255,255,0
-	# Rangeland: 255,0,255
-	# Forest land: 0,255,0
-	# Water: 0,0,255
-	# Barren land: 255,255,255
-	# Unknown: 0,0,0
 
-	img = np.zeros((image.shape[0], image.shape[1], 3), dtype = np.uint8)
+def pack_rgb(img):
+	# (H, W, 3) RGB -> (H, W) 24-bit key
+	img = img.astype(np.uint32)
+	return (img[..., 0] << 16) | (img[..., 1] << 8) | img[..., 2]
 
-	indices = np.where(image == 0)
-	img[indices] = (0, 255, 255)
 
-	indices = np.where(image == 1)
-	img[indices] = (255, 255, 0)
+@lru_cache(maxsize=None)
+def color_lut(dataset):
+	# 24-bit key -> class index, built once per process
+	lut = np.full(1 << 24, IGNORE_INDEX, dtype=np.uint8)
+	palette = PALETTES.get(dataset)
+	if palette is not None:
+		lut[pack_rgb(palette)] = np.arange(len(palette), dtype=np.uint8)
+	return lut
 
-	indices = np.where(image == 2)
-	img[indices] = (255, 0, 255)
 
-	indices = np.where(image == 3)
-	img[indices] = (0, 255, 0)
+def rgb_to_class_index(img, dataset):
+	# img is RGB, every pixel is mapped in one lookup table pass
+	return color_lut(dataset)[pack_rgb(img)]
 
-	indices = np.where(image == 4)
-	img[indices] = (0, 0, 255)
 
-	indices = np.where(image == 5)
-	img[indices] = (255, 255, 255)
-
-	indices = np.where(image == 6)
-	img[indices] = (0, 0, 0)
-
-	return img
+def _apply_palette(image, palette):
+	# indices outside the palette stay black
+	table = np.zeros((256, 3), dtype=np.uint8)
+	table[:len(palette)] = palette
+	return table[image.astype(np.uint8)]
 
 
+def apply_potsdam_colormap(image):
+	return _apply_palette(image, POTSDAM_PALETTE)
 
 
-print("Converting RGB GT to 8-bit GT image")
-source_path = sys.argv[1]
-destination_path = sys.argv[2]
-dataset = sys.argv[3]
+def apply_DGlands_colormap(image):
+	return _apply_palette(image, DGLANDS_PALETTE)
 
-if not os.path.isfile(source_path):
-	print("ERROR: file not found --->", source_path)
-else:
 
-	img = cv2.imread(source_path)[:,:,::-1]  ### BGR->RGB
+def convert_file(source_path, destination_path, dataset):
+	if not os.path.isfile(source_path):
+		print("ERROR: file not found --->", source_path)
+		return False
 
-	if img.shape[2] != 3:
+	img = cv2.imread(source_path)
+	if img is None or img.ndim != 3 or img.shape[2] != 3:
 		print('skipping ', source_path)
-	else:
-		target = 7*np.ones((img.shape[0], img.shape[1]), dtype = np.uint8)
-
-	if dataset == 'potsdam':
-		indices = np.all(img == (255, 255, 255), axis=-1)
-		target[indices] = 0
+		return False
 
-		indices = np.all(img == (0, 0, 255), axis=-1)
-		target[indices] = 1
-
-		indices = np.all(img == (0, 255, 255), axis=-1)
-		target[indices] = 2
-
-		indices = np.all(img == (0, 255, 0), axis=-1)
-		target[indices] = 3
-
-		indices = np.all(img == (255, 255, 0), axis=-1)
-		target[indices] = 4
-
-		indices = np.all(img == (255, 0, 0), axis=-1)
-		target[indices] = 5
-	elif dataset == 'deepglobe_lands':
-		indices = np.all(img == (0, 255, 255), axis=-1)
-		target[indices] = 0
-
-		indices = np.all(img == (255, 255, 0), axis=-1)
-		target[indices] = 1
-
-		indices = np.all(img == (255, 0, 255), axis=-1)
-		target[indices] = 2
-
-		indices = np.all(img == (0, 255, 0), axis=-1)
-		target[indices] = 3
-
-		indices = np.all(img == (0, 0, 255), axis=-1)
-		target[indices] = 4
-
-		indices = np.all(img == (255, 255, 255), axis=-1)
-		target[indices] = 5
-
-		indices = np.all(img == (0, 0, 0), axis=-1)
-		target[indices] = 6
-
-
-		
+	target = rgb_to_class_index(img[:,:,::-1], dataset)  ### BGR->RGB
 	print("writing", destination_path)
-	cv2.imwrite(destination_path, target)
\ No newline at end of file
+	cv2.imwrite(destination_path, target)
+	return True
+
+
+def _convert_job(job):
+	return convert_file(*job)
+
+
+def convert_split(split_file, source_pattern, destination_pattern, dataset, num_workers=None):
+	"""
+	convert every label of a split list in one process pool
+	:param split_file: one name per line
+	:param source_pattern: e.g. '/data/potsdam/labels/{}_label.tif', `{}` is replaced by the name
+	:param destination_pattern: e.g. '/data/potsdam/labels/{}_label.png'
+	:param dataset: potsdam or deepglobe_lands
+	:param num_workers: default all cores
+	:return: number of converted files
+	"""
+	with open(split_file) as f:
+		names = [line.strip() for line in f if line.strip()]
+	jobs = [(source_pattern.format(name), destination_pattern.format(name), dataset) for name in names]
+	with ProcessPoolExecutor(max_workers=num_workers) as executor:
+		return sum(executor.map(_convert_job, jobs, chunksize=max(1, len(jobs) // 64)))
+
+
+if __name__ == '__main__':
+	print("Converting RGB GT to 8-bit GT image")
+	if len(sys.argv) == 4 and not sys.argv[1].startswith('-'):
+		# single file: color_map_to_class_index.py source destination dataset
+		convert_file(sys.argv[1], sys.argv[2], sys.argv[3])
+	else:
+		parser = argparse.ArgumentParser()
+		parser.add_argument('--split_file', type=str, required=True)
+		parser.add_argument('--source', type=str, required=True, help='source path pattern, {} is the split name')
+		parser.add_argument('--destination', type=str, required=True, help='destination path pattern')
+		parser.add_argument('--dataset', type=str, required=True, help='potsdam or deepglobe_lands')
+		parser.add_argument('--num_workers', type=int, default=None)
+		args = parser.parse_args()
+		converted = convert_split(args.split_file, args.source, args.destination, args.dataset, args.num_workers)
+		print("converted", converted, "labels")
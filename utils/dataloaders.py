@@ -3,6 +3,10 @@
 #!/usr/bin/env python
 
 import collections
+import functools
+import io
+import random
+import warnings
 
 import numpy as np
 import PIL.Image
@@ -11,50 +15,97 @@ import torch
 from torch.utils import data
 import os
 
-def color_map(N=256, normalized=False):
-    def bitget(byteval, idx):
-        return ((byteval & (1 << idx)) != 0)
-
-    dtype = 'float32' if normalized else 'uint8'
-    cmap = np.zeros((N, 3), dtype=dtype)
-    for i in range(N):
-        r = g = b = 0
-        c = i
-        for j in range(8):
-            r = r | (bitget(c, 0) << 7-j)
-            g = g | (bitget(c, 1) << 7-j)
-            b = b | (bitget(c, 2) << 7-j)
-            c = c >> 3
-
-        cmap[i] = np.array([r, g, b])
-
-    cmap = cmap/255 if normalized else cmap
+from InfNet.Code.utils.manifest import list_dataset_files
+from utils.augmentations import random_dihedral_views, to_chw_tensor, to_label_tensor
+from utils.shards import read_shard_index, iter_shard, shuffle_buffer
+
+@functools.lru_cache(maxsize=None)
+def _color_map(N, normalized):
+    c = np.arange(N)
+    r = np.zeros(N, np.int64)
+    g = np.zeros(N, np.int64)
+    b = np.zeros(N, np.int64)
+    for j in range(8):
+        r |= ((c >> 0) & 1) << (7 - j)
+        g |= ((c >> 1) & 1) << (7 - j)
+        b |= ((c >> 2) & 1) << (7 - j)
+        c = c >> 3
+
+    cmap = np.stack([r, g, b], axis=1)
+    cmap = (cmap / 255).astype('float32') if normalized else cmap.astype('uint8')
+    cmap.setflags(write=False)
     return cmap
 
+def color_map(N=256, normalized=False):
+    # the palette is built once per (N, normalized), callers get their own copy
+    return _color_map(N, normalized).copy()
+
 def apply_color_map(image, c_map):
-    canvas = 255*np.ones((image.shape[0], image.shape[1], 3), np.uint8)
-    for r in range(image.shape[0]):
-        for c in range(image.shape[1]):
-            val = image[r,c]
-            if val >= c_map.shape[0]:
-                continue
-            canvas[r,c,0] = c_map[val][0]
-            canvas[r,c,1] = c_map[val][1]
-            canvas[r,c,2] = c_map[val][2]
-    return canvas
+    # image: H x W or N x H x W label map (numpy array or cpu tensor) -> ... x 3 uint8,
+    # labels outside of c_map are white
+    image = np.asarray(image).astype(np.int64)
+    palette = np.empty((len(c_map) + 1, 3), np.uint8)
+    palette[:-1] = c_map
+    palette[-1] = 255
+    image = np.where((image < 0) | (image >= len(c_map)), len(c_map), image)
+    return palette[image]
+
+
+def erase_masks(num, height, width, erase_shape, erase_count):
+    """
+    Usage:
+        masks = erase_masks(128, 256, 256, [16, 16], 16)
+    the inpainting masks of a whole batch: 1 everywhere except for `erase_count` blocks of `erase_shape` per sample.
+    All block offsets are drawn in one op and the blocks are painted with broadcast comparisons instead of a python
+    loop per block. erase_count == 1 erases one block in the center.
+    :return: N x 3 x H x W uint8 tensor
+    """
+    if erase_count == 1:
+        rows = torch.full((num, 1), (height - erase_shape[0]) // 2, dtype=torch.long)
+        cols = torch.full((num, 1), (width - erase_shape[1]) // 2, dtype=torch.long)
+    else:
+        rows = torch.randint(0, height - erase_shape[0] - 1, (num, erase_count))
+        cols = torch.randint(0, width - erase_shape[1] - 1, (num, erase_count))
+
+    # N x count x H and N x count x W: which rows/cols every block covers
+    in_rows = (torch.arange(height) >= rows[..., None]) & (torch.arange(height) < rows[..., None] + erase_shape[0])
+    in_cols = (torch.arange(width) >= cols[..., None]) & (torch.arange(width) < cols[..., None] + erase_shape[1])
+    # a pixel is erased if any block covers both its row and its col, one batched matmul over the blocks
+    erased = torch.bmm(in_rows.transpose(1, 2).float(), in_cols.float()) > 0
+    return (~erased).to(torch.uint8).unsqueeze(1).expand(num, 3, height, width).contiguous()
+
+
+class InpaintingMaskCollate:
+    """
+    Usage:
+        DataLoader(context_inpainting_dataloader(..., batch_mask=True), batch_size=128,
+                   collate_fn=InpaintingMaskCollate(erase_shape, erase_count))
+    collate for datasets built with `batch_mask=True`, which return their samples without a mask: the masks of the
+    whole batch are drawn here by `erase_masks` and inserted as the second element, so the batches are the same
+    (input_, mask, image[, prior]) as with per-sample masks.
+    """
+    def __init__(self, erase_shape, erase_count):
+        self.erase_shape = erase_shape
+        self.erase_count = erase_count
+
+    def __call__(self, batch):
+        batch = data.dataloader.default_collate(batch)
+        num, _, height, width = batch[0].shape
+        masks = erase_masks(num, height, width, self.erase_shape, self.erase_count)
+        return [batch[0], masks] + list(batch[1:])
 
 
 class context_inpainting_dataloader(data.Dataset):
     
     def __init__(self, img_root, image_list, split = 'train', suffix = '', 
                  mirror = True, resize = False, resize_shape = [256, 256], rotate = True,
-                 crop = True, crop_shape = [128, 128], erase_shape = [16, 16], erase_count = 16):
+                 crop = True, crop_shape = [128, 128], erase_shape = [16, 16], erase_count = 16, batch_mask = False):
 
         self.img_root = img_root
         self.split = split
         # self.image_list = [line.rstrip('\n') for line in open(image_list)]
-        self.image_list = [os.path.join(img_root, f) for f in os.listdir(img_root) if f.endswith('.jpg') or f.endswith('.png')]
-        self.image_list = sorted(self.image_list)
+        # img_root is a directory of images or holds a manifest.csv of them (see process_ictcf_for_self.py)
+        self.image_list = [path for _, path in list_dataset_files(img_root)]
         self.img_suffix = None
         self.gt_suffix = None
         if suffix == 'potsdam' or suffix == 'spacenet':
@@ -71,7 +122,8 @@ class context_inpainting_dataloader(data.Dataset):
         self.crop_shape = crop_shape
         self.erase_shape = erase_shape
         self.erase_count = erase_count
-
+        # leave the masks to InpaintingMaskCollate, which draws them for the whole batch at once
+        self.batch_mask = batch_mask
 
         self.mean_bgr = np.array([85.5517787014, 92.6691667083, 86.8147645556])
         self.std_bgr = np.array([32.8860206505, 31.7342205253, 31.5361127226])
@@ -92,18 +144,8 @@ class context_inpainting_dataloader(data.Dataset):
         else:
             print('couldn\'t find image -> ', image_file_name)
             
-        if self.mirror:                                                ### mirror image with probability of 0.5
-            flip = torch.LongTensor(1).random_(0, 2)[0]*2-1
-            image = image[:, ::flip, :]
-
-        if self.rotate:                                               ### randomly rotate image
-            choice = torch.LongTensor(1).random_(0, 4)[0]
-            angles = [0, 90, 180, 270]
-            angle = angles[choice]
-            center = tuple(np.array(image.shape)[:2]/2)
-            rot_mat = None
-            rot_mat = cv2.getRotationMatrix2D(center,angle, 1 )
-            image = cv2.warpAffine(image, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
+        ### mirror with probability of 0.5 and rotate by 0/90/180/270, as views
+        image, = random_dihedral_views(image, mirror=self.mirror, rotate=self.rotate)
 
         if self.resize == True and torch.LongTensor(1).random_(0, 2)[0] == 1:        ### resize image with probability of 0.5
             if self.resize_shape[0] != image.shape[0] or self.resize_shape[1] != image.shape[1]:
@@ -113,50 +155,20 @@ class context_inpainting_dataloader(data.Dataset):
         if self.crop:
             image = self.get_random_crop(image, self.crop_shape)
 
-        mask = np.ones((image.shape[0], image.shape[1], 3), np.uint8)
-        input_ = None
-
-        if self.erase_count == 1:                             ### erase a patch in the center of image
-            offset = (image.shape[0] - self.erase_shape[0])/2
-            end = offset+self.erase_shape[0]
-            mask[offset:end, offset:end, :] = 0
-            
-        else:   
-            for c_ in range(self.erase_count):
-                row = torch.LongTensor(1).random_(0, image.shape[0]-self.erase_shape[0]-1)[0]
-                col = torch.LongTensor(1).random_(0, image.shape[1]-self.erase_shape[1]-1)[0]
-                
-                mask[row:row+self.erase_shape[0], col:col+self.erase_shape[1], :] = 0
-                                
-        input_, mask, image = self.transform(mask, image)
+        input_, image = self.transform(image)
+        if self.batch_mask:
+            return input_, image
 
+        mask = erase_masks(1, image.shape[1], image.shape[2], self.erase_shape, self.erase_count)[0]
         return input_, mask, image
 
     # TODO might have to deal with this preprocessing step as we are using CT images instead of normal bgr images
-    def transform(self, mask, image):
-        image = image.astype(np.float64)
-        image -= self.mean_bgr
-               
-        input_ = image.copy()                        
-        
-        image[:,:,0] /= 3*self.std_bgr[0]
-        image[:,:,1] /= 3*self.std_bgr[1]
-        image[:,:,2] /= 3*self.std_bgr[2]
-
-        index_ = image > 1
-        image[index_] = 1
-        index_ = image < -1
-        image[index_] = -1
-        image = image.transpose(2, 0, 1)
-        image = torch.from_numpy(image.copy()).float()
-        
-        input_ = input_.transpose(2, 0, 1)
-        input_ = torch.from_numpy(input_.copy()).float()                        
-        
-        mask = mask.transpose(2, 0, 1)
-        mask = torch.from_numpy(mask.copy())                        
+    def transform(self, image):
+        # one float32 C x H x W copy of the image, input_ is mean subtracted, image is also scaled and clipped
+        input_ = to_chw_tensor(image, self.mean_bgr)
+        image = (input_ / torch.from_numpy(3 * self.std_bgr).float().view(-1, 1, 1)).clamp_(-1, 1)
 
-        return input_, mask, image
+        return input_, image
 
     def get_random_crop(self, im, crop_shape):
         """
@@ -175,105 +187,97 @@ class context_inpainting_dataloader(data.Dataset):
         return crop_im
 
 
+def pair_by_stem(img_root, prior_root):
+    """
+    pair every image with the prior of the same file stem, instead of relying on two sorted listings lining up
+    :return: list of (stem, image path, prior path)
+    """
+    priors = {name.rsplit('.', 1)[0]: path for name, path in list_dataset_files(prior_root)}
+    pairs = []
+    for name, path in list_dataset_files(img_root):
+        stem = name.rsplit('.', 1)[0]
+        if stem in priors:
+            pairs.append((stem, path, priors[stem]))
+        else:
+            print('couldn\'t find prior of ->', path)
+    return pairs
+
+
+def read_image(path):
+    # cv2.imread returns None for a missing or unreadable file instead of raising
+    image = cv2.imread(path)
+    if image is None:
+        raise FileNotFoundError(f'couldn\'t read image -> {path}')
+    return image
+
+
+def stack_image_prior(image, prior):
+    """
+    H x W x 6 array of the BGR image and its BGR prior, the prior is resized to the image if their sizes differ
+    """
+    if prior.shape[:2] != image.shape[:2]:
+        prior = cv2.resize(prior, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_LINEAR)
+    return np.concatenate([image, prior], axis=2)
+
+
 class multi_context_inpainting_data_loader(context_inpainting_dataloader):
     def __init__(self, img_root, prior_root, image_list, split = 'train', suffix = '',
                  mirror = True, resize = False, resize_shape = [256, 256], rotate = True,
-                 crop = True, crop_shape = [128, 128], erase_shape = [16, 16], erase_count = 16):
+                 crop = True, crop_shape = [128, 128], erase_shape = [16, 16], erase_count = 16, batch_mask = False,
+                 stacked_root = None):
 
         super(multi_context_inpainting_data_loader, self).__init__(img_root, image_list, split =split, suffix = suffix,
                  mirror = mirror, resize = resize, resize_shape = resize_shape, rotate = rotate,
-                 crop = crop, crop_shape = crop_shape, erase_shape = erase_shape, erase_count = erase_count)
-
-        self.prior_list = [os.path.join(prior_root, f) for f in os.listdir(prior_root) if f.endswith('.jpg') or f.endswith('.png')]
-        self.prior_list = sorted(self.prior_list)
-
-    def __getitem__(self, index):
-        # image_file_name = self.img_root + self.image_list[index] + self.img_suffix + '.jpg'
-        image_file_name = self.image_list[index]
-        prior_file_name = self.prior_list[index]
-        image = None
-        if os.path.isfile(image_file_name):
-            image = cv2.imread(image_file_name)
+                 crop = crop, crop_shape = crop_shape, erase_shape = erase_shape, erase_count = erase_count,
+                 batch_mask = batch_mask)
+
+        # stacked_root holds the H x W x 6 .npy samples of pack_image_prior.py, one read per sample
+        self.stacked_root = stacked_root
+        if stacked_root is not None:
+            self.image_list = [path for _, path in list_dataset_files(stacked_root, suffixes=('.npy',))]
+            self.files[self.split] = [{'img': f} for f in self.image_list]
+            self.prior_list = None
         else:
-            print('couldn\'t find image -> ', image_file_name)
-        if os.path.isfile(prior_file_name):
-            prior = cv2.imread(prior_file_name)
-        else:
-            print('could\'t find prior -> ', prior_file_name)
-
-        if self.mirror:  ### mirror image with probability of 0.5
-            flip = torch.LongTensor(1).random_(0, 2)[0] * 2 - 1
-            image = image[:, ::flip, :]
-            prior = prior[:, ::flip, :]
-
-        if self.rotate:  ### randomly rotate image
-            choice = torch.LongTensor(1).random_(0, 4)[0]
-            angles = [0, 90, 180, 270]
-            angle = angles[choice]
-            center = tuple(np.array(image.shape)[:2] / 2)
-            rot_mat = None
-            rot_mat = cv2.getRotationMatrix2D(center, angle, 1)
-            image = cv2.warpAffine(image, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
-            prior = cv2.warpAffine(prior, rot_mat, prior.shape[:2], flags=cv2.INTER_LINEAR)
+            pairs = pair_by_stem(img_root, prior_root)
+            self.image_list = [image_path for _, image_path, _ in pairs]
+            self.prior_list = [prior_path for _, _, prior_path in pairs]
+            self.files[self.split] = [{'img': f} for f in self.image_list]
 
-        if self.resize == True and torch.LongTensor(1).random_(0, 2)[0] == 1:  ### resize image with probability of 0.5
-            if self.resize_shape[0] != image.shape[0] or self.resize_shape[1] != image.shape[1]:
-                image = cv2.resize(image, (self.resize_shape[1], self.resize_shape[0]),
-                                   interpolation=cv2.INTER_LINEAR)
-                prior = cv2.resize(prior, (self.resize_shape[1], self.resize_shape[0]),
-                                   interpolation=cv2.INTER_LINEAR)
+    def read_stacked(self, index):
+        if self.stacked_root is not None:
+            return np.load(self.image_list[index])
 
-        if self.crop:
-            image = self.get_random_crop(image, self.crop_shape)
-            prior = self.get_random_crop(prior, self.crop_shape)
+        # image_file_name = self.img_root + self.image_list[index] + self.img_suffix + '.jpg'
+        return stack_image_prior(read_image(self.image_list[index]), read_image(self.prior_list[index]))
 
-        mask = np.ones((image.shape[0], image.shape[1], 3), np.uint8)
-        input_ = None
+    def __getitem__(self, index):
+        # image and prior are augmented together as one 6 channel array, so they always get the same crop
+        stacked = self.read_stacked(index)
 
-        if self.erase_count == 1:  ### erase a patch in the center of image
-            offset = (image.shape[0] - self.erase_shape[0]) / 2
-            end = offset + self.erase_shape[0]
-            mask[offset:end, offset:end, :] = 0
+        ### mirror with probability of 0.5 and rotate by 0/90/180/270, as views
+        stacked, = random_dihedral_views(stacked, mirror=self.mirror, rotate=self.rotate)
 
-        else:
-            for c_ in range(self.erase_count):
-                row = torch.LongTensor(1).random_(0, image.shape[0] - self.erase_shape[0] - 1)[0]
-                col = torch.LongTensor(1).random_(0, image.shape[1] - self.erase_shape[1] - 1)[0]
+        if self.resize == True and torch.LongTensor(1).random_(0, 2)[0] == 1:  ### resize image with probability of 0.5
+            if self.resize_shape[0] != stacked.shape[0] or self.resize_shape[1] != stacked.shape[1]:
+                stacked = cv2.resize(stacked, (self.resize_shape[1], self.resize_shape[0]),
+                                     interpolation=cv2.INTER_LINEAR)
 
-                mask[row:row + self.erase_shape[0], col:col + self.erase_shape[1], :] = 0
+        if self.crop:
+            stacked = self.get_random_crop(stacked, self.crop_shape)
 
-        input_, mask, image, prior = self.multi_transform(mask, image, prior)
+        input_, image, prior = self.multi_transform(stacked[:, :, :3], stacked[:, :, 3:])
+        if self.batch_mask:
+            return input_, image, prior
 
+        mask = erase_masks(1, image.shape[1], image.shape[2], self.erase_shape, self.erase_count)[0]
         return input_, mask, image, prior
 
     # TODO might have to deal with this preprocessing step as we are using CT images instead of normal bgr images
-    def multi_transform(self, mask, image, prior):
-        image = image.astype(np.float64)
-        image -= self.mean_bgr
-
-        input_ = image.copy()
-
-        image[:, :, 0] /= 3 * self.std_bgr[0]
-        image[:, :, 1] /= 3 * self.std_bgr[1]
-        image[:, :, 2] /= 3 * self.std_bgr[2]
-
-        index_ = image > 1
-        image[index_] = 1
-        index_ = image < -1
-        image[index_] = -1
-        image = image.transpose(2, 0, 1)
-        image = torch.from_numpy(image.copy()).float()
-
-        input_ = input_.transpose(2, 0, 1)
-        input_ = torch.from_numpy(input_.copy()).float()
+    def multi_transform(self, image, prior):
+        input_, image = self.transform(image)
+        prior = to_chw_tensor(prior)
 
-        mask = mask.transpose(2, 0, 1)
-        mask = torch.from_numpy(mask.copy())
-
-        prior = prior.transpose(2, 0, 1)
-        prior = torch.from_numpy(prior.copy()).float()
-
-        return input_, mask, image, prior
+        return input_, image, prior
 
 
 
@@ -292,8 +296,8 @@ class segmentation_data_loader(data.Dataset):
         self.backend = image_backend
         self.out = out
         
-        ### list of all images
-        self.image_list = [line.rstrip('\n') for line in open(image_list)]
+        ### list of all images, none when the samples are streamed from shards
+        self.image_list = [line.rstrip('\n') for line in open(image_list)] if image_list is not None else []
         
         
         ### augmentations
@@ -351,6 +355,10 @@ class segmentation_data_loader(data.Dataset):
     
         else:
             print('couldn\'t find segmentation gt ->', seg_gt_name)
+
+        return self.process(image, seg_gt)
+
+    def process(self, image, seg_gt):
         if self.out == 'seg':
             seg_gt = (seg_gt/255.0 > 0.4).astype(np.uint8)
         elif self.out =='heatmap':
@@ -367,22 +375,9 @@ class segmentation_data_loader(data.Dataset):
             ### get random crop
             image, seg_gt = self.get_random_crop(image, seg_gt, self.crop_shape)
         
-        ### apply mirroring
-        if self.mirror == 1:
-            flip = torch.LongTensor(1).random_(0, 2)[0]*2-1
-            image = image[:, ::flip, :]
-            seg_gt = seg_gt[:, ::flip]
-
-        if self.rotate:
-            choice = torch.LongTensor(1).random_(0, 4)[0]
-            angles = [0, 90, 180, 270]
-            angle = angles[choice]
-            center = tuple(np.array(image.shape)[:2]/2)
-            rot_mat = None
-            rot_mat = cv2.getRotationMatrix2D(center,angle, 1 )
-            image = cv2.warpAffine(image, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
-            seg_gt = cv2.warpAffine(seg_gt, rot_mat, image.shape[:2], flags=cv2.INTER_LINEAR)
-            
+        ### apply mirroring and rotation by 0/90/180/270, as views (labels are never interpolated)
+        image, seg_gt = random_dihedral_views(image, seg_gt, mirror=self.mirror == 1, rotate=self.rotate)
+
         # need to resize input?
         if self.resize == True:
             if self.resize_shape[0] != image.shape[0] or self.resize_shape[1] != image.shape[1]:
@@ -436,9 +431,71 @@ class segmentation_data_loader(data.Dataset):
         return crop_im, crop_seg
 
     def transform(self, img, lbl):
-        img = img.astype(np.float64)
-        img -= self.mean_bgr
-        img = img.transpose(2, 0, 1)
-        img = torch.from_numpy(img.copy()).float()
-        lbl = torch.from_numpy(lbl.copy()).long()
+        img = to_chw_tensor(img, self.mean_bgr)
+        lbl = to_label_tensor(lbl)
         return img, lbl
+
+
+class sharded_segmentation_data_loader(segmentation_data_loader, data.IterableDataset):
+    """
+    Usage:
+        DataLoader(sharded_segmentation_data_loader(shard_root=dataset_root + 'potsdam/shards/train_crops',
+                                                    suffix=dataset, out=out, crop=True, mirror=True),
+                   batch_size=32, num_workers=8)
+    segmentation_data_loader over the tar shards of utils/shards.py. Every worker reads its own shards front to back and
+    the samples are mixed in a shuffle buffer of `shuffle_buffer` samples, so the order is only approximately random.
+    The shard order is reshuffled every epoch when `shuffle` is set: call `set_epoch(epoch)` before every epoch and do
+    not keep the workers alive between epochs (`persistent_workers=False`), a persistent worker holds the dataset of
+    the first epoch. Do not pass shuffle to the DataLoader, and use at most `len(shard_paths)` workers, the others have
+    no shard to read.
+    """
+    def __init__(self, shard_root, shuffle_buffer = 1000, shuffle = True, split = 'train', mirror = True,
+                 resize = False, resize_shape = [256, 256], suffix='', out='',
+                 rotate = True, crop = False, crop_shape=[256, 256], image_backend = 'cv2'):
+
+        super(sharded_segmentation_data_loader, self).__init__(img_root='', gt_root='', image_list=None, split=split,
+                 mirror=mirror, resize=resize, resize_shape=resize_shape, suffix=suffix, out=out,
+                 rotate=rotate, crop=crop, crop_shape=crop_shape, image_backend=image_backend)
+
+        self.shard_paths, self.num_samples = read_shard_index(shard_root)
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def decode(self, image_bytes, gt_bytes):
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if self.backend == 'cv2':
+            seg_gt = cv2.imdecode(np.frombuffer(gt_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        else:
+            seg_gt = np.array(PIL.Image.open(io.BytesIO(gt_bytes)), dtype = np.uint8)
+        return image, seg_gt
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = int(torch.empty((), dtype=torch.int64).random_())
+        else:
+            # the epoch seed is shared by all workers so they agree on the shard order, the buffers differ per worker
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = worker_info.seed - worker_info.id
+            if worker_id >= len(self.shard_paths):
+                warnings.warn(f'{num_workers} workers for {len(self.shard_paths)} shards, worker {worker_id} is idle; '
+                              'cap num_workers at the shard count or write smaller shards')
+
+        seed += self.epoch
+        shard_paths = list(self.shard_paths)
+        if self.shuffle:
+            random.Random(seed).shuffle(shard_paths)
+        samples = (sample for shard_path in shard_paths[worker_id::num_workers] for sample in iter_shard(shard_path))
+        if self.shuffle:
+            samples = shuffle_buffer(samples, self.shuffle_buffer, random.Random(seed + worker_id))
+
+        for _, image_bytes, gt_bytes in samples:
+            yield self.process(*self.decode(image_bytes, gt_bytes))
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
-import numpy as np
 import matplotlib.pyplot as plt
 
+# re-exported, main.py and the notebook import apply_color_map from here
+from utils.dataloaders import apply_color_map
+
 
 
 def training_curves_loss(train_loss_hist, val_loss_hist):
@@ -34,16 +36,3 @@ def segmentation_training_curves_loss(train_loss_hist, val_loss_hist, train_iou,
     ax2.legend(loc='best')
     fig.tight_layout()
     plt.show()
-    
-def apply_color_map(image, c_map):
-    canvas = 255*np.ones((image.shape[0], image.shape[1], 3), np.uint8)
-    for r in range(image.shape[0]):
-        for c in range(image.shape[1]):
-            val = image[r,c]
-            if val >= c_map.shape[0]:
-                continue
-            canvas[r,c,0] = c_map[val][0]
-            canvas[r,c,1] = c_map[val][1]
-            canvas[r,c,2] = c_map[val][2]
-    return canvas
-    
\ No newline at end of file
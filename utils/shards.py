@@ -0,0 +1,121 @@
+import os
+import io
+import json
+import random
+import tarfile
+import argparse
+
+
+SHARD_INDEX_NAME = 'shards.json'
+
+
+def add_bytes(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def write_shards(img_root, gt_root, image_list, output_root, shard_size=512 * 2**20, seed=None):
+    """
+    Usage:
+        write_shards(train_img_root, train_gt_root, train_image_list_path + 'train_crops.txt',
+                     dataset_root + 'potsdam/shards/train_crops')
+    pack the `name.jpg` + `name.png` pairs of a split into tar shards of about `shard_size` bytes, written in one
+    sequential pass. `shards.json` lists the shards and their sample counts.
+    :param img_root: prefix of the images, as in segmentation_data_loader
+    :param gt_root: prefix of the labels
+    :param image_list: split file, one sample name per line
+    :param output_root:
+    :param shard_size: bytes per shard
+    :param seed: if not None the samples are shuffled once before packing, so shards do not hold neighbouring crops
+    :return: path of shards.json
+    """
+    names = [line.rstrip('\n') for line in open(image_list) if line.strip()]
+    if seed is not None:
+        random.Random(seed).shuffle(names)
+    os.makedirs(output_root, exist_ok=True)
+
+    shards = []
+    tar = None
+    for name in names:
+        with open(img_root + name + '.jpg', 'rb') as f:
+            image_bytes = f.read()
+        with open(gt_root + name + '.png', 'rb') as f:
+            gt_bytes = f.read()
+
+        if tar is None or tar.fileobj.tell() >= shard_size:
+            if tar is not None:
+                tar.close()
+            shard_name = f'shard-{len(shards):05d}.tar'
+            tar = tarfile.open(os.path.join(output_root, shard_name), 'w')
+            shards.append({'path': shard_name, 'count': 0})
+        # the sample name may contain '/', keep it flat inside the tar
+        key = name.replace('/', '__')
+        add_bytes(tar, key + '.jpg', image_bytes)
+        add_bytes(tar, key + '.png', gt_bytes)
+        shards[-1]['count'] += 1
+    if tar is not None:
+        tar.close()
+
+    index_path = os.path.join(output_root, SHARD_INDEX_NAME)
+    with open(index_path, 'w') as f:
+        json.dump({'num_samples': len(names), 'shards': shards}, f, indent=1)
+    return index_path
+
+
+def read_shard_index(shard_root):
+    """
+    :return: (list of shard paths, number of samples)
+    """
+    with open(os.path.join(shard_root, SHARD_INDEX_NAME)) as f:
+        index = json.load(f)
+    return [os.path.join(shard_root, shard['path']) for shard in index['shards']], index['num_samples']
+
+
+def iter_shard(shard_path):
+    """
+    stream a shard front to back
+    :return: generator of (name, image bytes, gt bytes)
+    """
+    pending = {}
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            key, extension = member.name.rsplit('.', 1)
+            pending[extension] = tar.extractfile(member).read()
+            if 'jpg' in pending and 'png' in pending:
+                yield key, pending.pop('jpg'), pending.pop('png')
+
+
+def shuffle_buffer(samples, buffer_size, rng):
+    """
+    approximate shuffle of a stream: keep `buffer_size` samples and emit a random one of them for every new sample,
+    a `buffer_size` of 0 or 1 keeps the stream order
+    """
+    if buffer_size <= 1:
+        yield from samples
+        return
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_root', type=str, required=True, help='image prefix, e.g. .../processed/train/images/')
+    parser.add_argument('--gt_root', type=str, required=True, help='label prefix, e.g. .../processed/train/gt/')
+    parser.add_argument('--image_list', type=str, required=True, help='split file, e.g. .../splits/train_crops.txt')
+    parser.add_argument('--output_root', type=str, required=True)
+    parser.add_argument('--shard_size_mb', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=7, help='shuffle once before packing, -1 keeps the split order')
+    args = parser.parse_args()
+
+    index_path = write_shards(args.img_root, args.gt_root, args.image_list, args.output_root,
+                              args.shard_size_mb * 2**20, None if args.seed < 0 else args.seed)
+    print('wrote', index_path)
@@ -1,87 +1,114 @@
 import cv2
-import sys
 import csv
-import os.path
+import argparse
 import numpy as np
 import tifffile as tiff
-from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+CROP_SIZE = 650
+GT_STD = 15.0
+
+# one CLAHE object per worker process, created by `init_worker`
+clahe = None
+
 
 def get_line_string_dict(path):
-	file=open( path, "r")
 	linestrings = {}
-	reader = csv.reader(file)
-	for line in reader:
-		line[0] = 'RGB-PanSharpen_' + line[0]
-		l = []
-		if line[1] == ' LINESTRING EMPTY':
-			l = None
-		else:
-			for f in range(1, len(line)):
-				k = line[f].split(' ')
-				l+= [[int(float(k[1])), int(float(k[2]))]]
-
-		if line[0] in linestrings:
-			linestrings[line[0]] += [l]
-		else:
-			linestrings[line[0]] = [l]
+	with open(path, "r") as file:
+		reader = csv.reader(file)
+		for line in reader:
+			line[0] = 'RGB-PanSharpen_' + line[0]
+			l = []
+			if line[1] == ' LINESTRING EMPTY':
+				l = None
+			else:
+				for f in range(1, len(line)):
+					k = line[f].split(' ')
+					l += [[int(float(k[1])), int(float(k[2]))]]
+
+			if line[0] in linestrings:
+				linestrings[line[0]] += [l]
+			else:
+				linestrings[line[0]] = [l]
 
 	return linestrings
 
 
-list_file = sys.argv[1]
-source_img_root_path = sys.argv[2]
-target_img_root_path = sys.argv[3]
-target_gt_root_path = sys.argv[4]
-linestrings_path = sys.argv[5]
-stride = int(sys.argv[6])
-
-linestrings = get_line_string_dict(linestrings_path)
-clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(8,8))
-
-image_list = [line.rstrip('\n') for line in open(list_file)]
-print len(image_list)
-
-for img_name in image_list:
-	print 'processing', img_name
-	img= tiff.imread(source_img_root_path + img_name + '.tif')
-	red = np.asarray(img[:,:,0],dtype=np.float)
-	green = np.asarray(img[:,:,1],dtype=np.float)
-	blue = np.asarray(img[:,:,2],dtype=np.float)
-	
-	red_ = 255.0 * ((red-np.min(red))/(np.max(red) - np.min(red) + 1e-12))
-	green_ = 255.0 * ((green-np.min(green))/(np.max(green) - np.min(green) + 1e-12))
-	blue_ = 255.0 * ((blue-np.min(blue))/(np.max(blue) - np.min(blue) + 1e-12))
-	
-	img_rgb = np.zeros((1300,1300,3),dtype=np.uint8)
-	img_rgb[:,:,0] = clahe.apply(np.asarray(red_,dtype=np.uint8))
-	img_rgb[:,:,1] = clahe.apply(np.asarray(green_,dtype=np.uint8))
-	img_rgb[:,:,2] = clahe.apply(np.asarray(blue_,dtype=np.uint8))
-	
-	seg_gt = np.ones((1300,1300),dtype=np.float)
-	if img_name in linestrings:
-		lines = linestrings[img_name]
-		if lines[0] is not None:
-			for l in lines:
-				for points in range(1, len(l)):
-					cv2.line(seg_gt, (l[points][0], l[points][1]), (l[points-1][0], l[points-1][1]), 0, 1)
-	else:
-		print 'ERROR: couldn\'t find linestrings for -> ', img_name
-
-	std = 15.0
-	dist = ndimage.distance_transform_edt(seg_gt)
-	seg_gt = np.exp(-0.5*(dist/std)**2)
-
-	seg_gt = 255 * seg_gt
-
-	print 'writing', target_img_root_path + img_name + '.jpg'
-	cv2.imwrite(target_img_root_path + img_name + '.jpg', img_rgb[:,:,::-1])
-
-	print 'writing', target_gt_root_path + img_name + '.png'
-	cv2.imwrite(target_gt_root_path + img_name + '.png', seg_gt)
-
-	for rows in range(0, img_rgb.shape[0], stride):
-		for cols in range(0, img_rgb.shape[1], stride):
-			if rows+650 > img_rgb.shape[0] or cols+650 > img_rgb.shape[1]:
-				continue
-			cv2.imwrite(target_img_root_path + img_name + '_' + str(rows) + '_' + str(cols) + '.jpg', img_rgb[rows:rows+650, cols:cols+650, ::-1])
-			cv2.imwrite(target_gt_root_path + img_name + '_' + str(rows) + '_' + str(cols) + '.png', seg_gt[rows:rows+650, cols:cols+650])
+def init_worker():
+	global clahe
+	clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(8,8))
+
+
+def to_rgb8(img):
+	# stretch every 16-bit band to 0..255 and equalize it with CLAHE
+	img = np.asarray(img[:,:,:3], dtype=np.float32)
+	low = img.min(axis=(0, 1))
+	high = img.max(axis=(0, 1))
+	img = (255.0 * ((img - low) / (high - low + 1e-12))).astype(np.uint8)
+	return np.stack([clahe.apply(np.ascontiguousarray(img[:,:,band])) for band in range(3)], axis=-1)
+
+
+def rasterize_roads(lines, shape):
+	# gaussian of the distance to the closest road centerline, all linestrings are drawn with one polylines call
+	seg_gt = np.full(shape, 255, dtype=np.uint8)
+	polylines = [np.asarray(l, dtype=np.int32) for l in lines if l is not None and len(l) > 1]
+	if polylines:
+		cv2.polylines(seg_gt, polylines, False, 0, 1)
+	dist = cv2.distanceTransform(seg_gt, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+	seg_gt = np.exp(-0.5*(dist/GT_STD)**2)
+	return np.rint(255 * seg_gt).astype(np.uint8)
+
+
+def crop_offsets(size, stride, crop_size=CROP_SIZE):
+	return range(0, size - crop_size + 1, stride)
+
+
+def process_image(img_name, lines, source_img_root_path, target_img_root_path, target_gt_root_path, stride,
+				  num_writers=4):
+	img = tiff.imread(source_img_root_path + img_name + '.tif')
+	img_bgr = to_rgb8(img)[:,:,::-1]
+
+	if lines is None:
+		print('ERROR: couldn\'t find linestrings for -> ', img_name)
+		lines = []
+	seg_gt = rasterize_roads(lines, img_bgr.shape[:2])
+
+	# the raster stays in memory, every crop is a view of it handed to the writer threads
+	with ThreadPoolExecutor(max_workers=num_writers) as writer:
+		writes = [writer.submit(cv2.imwrite, target_img_root_path + img_name + '.jpg', img_bgr),
+				  writer.submit(cv2.imwrite, target_gt_root_path + img_name + '.png', seg_gt)]
+		for rows in crop_offsets(img_bgr.shape[0], stride):
+			for cols in crop_offsets(img_bgr.shape[1], stride):
+				crop_name = img_name + '_' + str(rows) + '_' + str(cols)
+				writes.append(writer.submit(cv2.imwrite, target_img_root_path + crop_name + '.jpg',
+											img_bgr[rows:rows+CROP_SIZE, cols:cols+CROP_SIZE]))
+				writes.append(writer.submit(cv2.imwrite, target_gt_root_path + crop_name + '.png',
+											seg_gt[rows:rows+CROP_SIZE, cols:cols+CROP_SIZE]))
+		for write in writes:
+			write.result()
+	return img_name, len(writes)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('list_file')
+	parser.add_argument('source_img_root_path')
+	parser.add_argument('target_img_root_path')
+	parser.add_argument('target_gt_root_path')
+	parser.add_argument('linestrings_path')
+	parser.add_argument('stride', type=int)
+	parser.add_argument('--num_workers', type=int, default=None, help='number of processes, default all cores')
+	parser.add_argument('--num_writers', type=int, default=4, help='writer threads per process')
+	args = parser.parse_args()
+
+	linestrings = get_line_string_dict(args.linestrings_path)
+	image_list = [line.rstrip('\n') for line in open(args.list_file) if line.strip()]
+	print(len(image_list))
+
+	with ProcessPoolExecutor(max_workers=args.num_workers, initializer=init_worker) as executor:
+		futures = [executor.submit(process_image, img_name, linestrings.get(img_name), args.source_img_root_path,
+								   args.target_img_root_path, args.target_gt_root_path, args.stride, args.num_writers)
+				   for img_name in image_list]
+		for future in futures:
+			img_name, num_files = future.result()
+			print('processed', img_name, '(' + str(num_files), 'files)')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import cv2
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from color_map_to_class_index import rgb_to_class_index
+
+
+def crop_offsets(size, crop_size, stride, max_offset=None):
+    # top/left offsets of the crops that fit in `size`, optionally capped at `max_offset`
+    last = size - crop_size
+    if max_offset is not None:
+        last = min(last, max_offset)
+    return range(0, last + 1, stride)
+
+
+def read_label(label_file, dataset=None):
+    # RGB labels of `dataset` are mapped to class indices in memory, other labels are read as they are (grayscale)
+    if dataset:
+        label = cv2.imread(label_file, cv2.IMREAD_COLOR)
+        return None if label is None else rgb_to_class_index(label[:, :, ::-1], dataset)
+    return cv2.imread(label_file, cv2.IMREAD_GRAYSCALE)
+
+
+def tile_image(name, image_file, label_file, output_root, crop_size, stride, max_offset=None, dataset=None,
+               num_writers=4):
+    """
+    Usage:
+        decode the image and its label once and write every (crop_size x crop_size) crop at `stride` to
+        `{output_root}/images/{name}_{row}_{col}.jpg` and `{output_root}/gt/{name}_{row}_{col}.png`
+    :return: (name, number of crops)
+    """
+    image = cv2.imread(image_file, cv2.IMREAD_COLOR)
+    label = read_label(label_file, dataset)
+    if image is None or label is None:
+        print('ERROR: file not found --->', image_file if image is None else label_file)
+        return name, 0
+
+    rows = crop_offsets(min(image.shape[0], label.shape[0]), crop_size, stride, max_offset)
+    cols = crop_offsets(min(image.shape[1], label.shape[1]), crop_size, stride, max_offset)
+    with ThreadPoolExecutor(max_workers=num_writers) as writer:
+        writes = []
+        for row in rows:
+            for col in cols:
+                crop_name = f'{name}_{row}_{col}'
+                writes.append(writer.submit(cv2.imwrite, os.path.join(output_root, 'images', crop_name + '.jpg'),
+                                            image[row:row + crop_size, col:col + crop_size]))
+                writes.append(writer.submit(cv2.imwrite, os.path.join(output_root, 'gt', crop_name + '.png'),
+                                            label[row:row + crop_size, col:col + crop_size]))
+        for write in writes:
+            write.result()
+    return name, len(writes) // 2
+
+
+def tile_split(split_file, image_pattern, label_pattern, output_root, crop_size, stride, max_offset=None,
+               dataset=None, num_workers=None, num_writers=4):
+    """
+    Usage:
+        tile_split('splits/train.txt', 'RGB/{}_RGB.tif', 'Labels/{}_label.tif', 'processed/train', 600, 200,
+                   dataset='potsdam')
+    :param split_file: one name per line, `{}` in the patterns is replaced by the name
+    :param dataset: potsdam or deepglobe_lands to convert RGB labels to class indices, None to keep the labels
+    :return:
+    """
+    os.makedirs(os.path.join(output_root, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(output_root, 'gt'), exist_ok=True)
+    with open(split_file) as f:
+        names = [line.strip() for line in f if line.strip()]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(tile_image, name, image_pattern.format(name), label_pattern.format(name),
+                                   output_root, crop_size, stride, max_offset, dataset, num_writers)
+                   for name in names]
+        for future in futures:
+            name, num_crops = future.result()
+            print('processed', name, f'({num_crops} crops)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split_file', type=str, required=True)
+    parser.add_argument('--image', type=str, required=True, help='image path pattern, {} is the split name')
+    parser.add_argument('--label', type=str, required=True, help='label path pattern, {} is the split name')
+    parser.add_argument('--output_root', type=str, required=True, help='crops go to output_root/{images,gt}/')
+    parser.add_argument('--crop_size', type=int, required=True)
+    parser.add_argument('--stride', type=int, required=True)
+    parser.add_argument('--max_offset', type=int, default=None, help='largest row/col offset of a crop')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help='potsdam or deepglobe_lands to convert RGB labels to class indices')
+    parser.add_argument('--num_workers', type=int, default=None, help='number of processes, default all cores')
+    parser.add_argument('--num_writers', type=int, default=4, help='writer threads per process')
+    args = parser.parse_args()
+
+    tile_split(args.split_file, args.image, args.label, args.output_root, args.crop_size, args.stride,
+               args.max_offset, args.dataset, args.num_workers, args.num_writers)